@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Cálculo de la tabla de amortización de los préstamos
+Funciones puras: reciben los datos del préstamo y devuelven las filas de
+cuotas como diccionarios, sin tocar la base de datos
+"""
+
+from datetime import timedelta
+
+FRECUENCIAS = ('Mensual', 'Bullet', 'SoloInteresesSinFecha', 'Quincenal', 'Semanal')
+
+def _siguiente_fecha_mensual(fecha):
+    """Vencimiento siguiente en las frecuencias mensuales (cada 28 días, nunca después del día 28)"""
+    fecha = fecha.replace(day=min(fecha.day, 28)) + timedelta(days=28)
+    return fecha.replace(day=min(fecha.day, 28))
+
+def _fila(numero_cuota, fecha_vencimiento, monto_capital, monto_interes, monto_total, saldo_restante):
+    return {
+        'numero_cuota': numero_cuota,
+        'fecha_vencimiento': fecha_vencimiento,
+        'monto_capital': monto_capital,
+        'monto_interes': monto_interes,
+        'monto_total': monto_total,
+        'saldo_restante': saldo_restante,
+    }
+
+def _capital_fijo(monto, interes_periodo, periodos, fecha, siguiente_fecha):
+    """Capital fijo por periodo + interés fijo; la última cuota absorbe los decimales"""
+    capital_periodo = monto / periodos
+    filas = []
+    for i in range(periodos):
+        if i == periodos - 1:
+            monto_capital = monto - (capital_periodo * (periodos - 1))
+        else:
+            monto_capital = capital_periodo
+        saldo_restante = monto - (capital_periodo * (i + 1))
+        filas.append(_fila(i + 1, fecha, monto_capital, interes_periodo,
+                           monto_capital + interes_periodo, max(0, saldo_restante)))
+        fecha = siguiente_fecha(fecha)
+    return filas
+
+def calcular_cuotas(monto, tasa_interes, plazo_meses, frecuencia, fecha_primera_cuota):
+    """Calcula las cuotas de un préstamo.
+
+    La tasa es mensual directa (no anual dividida entre 12) y el interés se
+    calcula siempre sobre el monto, no sobre el saldo.
+
+    Args:
+        monto (float): Capital a amortizar
+        tasa_interes (float): Tasa mensual en porcentaje
+        plazo_meses (int): Plazo en meses (Quincenal = 2 cuotas por mes, Semanal = 4)
+        frecuencia (str): Una de FRECUENCIAS; cualquier otra no genera cuotas
+        fecha_primera_cuota (date): Vencimiento de la primera cuota
+
+    Returns:
+        list: dicts con numero_cuota, fecha_vencimiento, monto_capital,
+        monto_interes, monto_total y saldo_restante
+    """
+    monto = float(monto)
+    tasa_mensual = float(tasa_interes) / 100
+    plazo_meses = int(plazo_meses)
+    fecha = fecha_primera_cuota
+
+    if frecuencia == 'Mensual':
+        return _capital_fijo(monto, monto * tasa_mensual, plazo_meses, fecha,
+                             _siguiente_fecha_mensual)
+
+    if frecuencia == 'Quincenal':
+        return _capital_fijo(monto, monto * (tasa_mensual / 2), plazo_meses * 2, fecha,
+                             lambda f: f + timedelta(days=15))
+
+    if frecuencia == 'Semanal':
+        return _capital_fijo(monto, monto * (tasa_mensual / 4), plazo_meses * 4, fecha,
+                             lambda f: f + timedelta(days=7))
+
+    filas = []
+    if frecuencia == 'Bullet':
+        # No se paga nada hasta la última cuota: capital completo + intereses acumulados
+        interes_total = monto * tasa_mensual * plazo_meses
+        for i in range(plazo_meses):
+            if i == plazo_meses - 1:
+                filas.append(_fila(i + 1, fecha, monto, interes_total, monto + interes_total, 0))
+            else:
+                filas.append(_fila(i + 1, fecha, 0, 0, 0, monto))
+            fecha = _siguiente_fecha_mensual(fecha)
+
+    elif frecuencia == 'SoloInteresesSinFecha':
+        # Solo intereses mensuales; el capital queda pendiente
+        interes_mensual = monto * tasa_mensual
+        for i in range(plazo_meses):
+            filas.append(_fila(i + 1, fecha, 0, interes_mensual, interes_mensual, monto))
+            fecha = _siguiente_fecha_mensual(fecha)
+
+    return filas
+
+def calcular_cuotas_restantes(capital_pendiente, monto, tasa_interes, plazo_meses, frecuencia, cuotas_restantes):
+    """Montos de las cuotas que faltan después de un abono al capital.
+
+    El capital pendiente se reparte entre las cuotas que quedan y el interés se
+    sigue calculando sobre el monto del préstamo (ya reducido por los abonos),
+    igual que en calcular_cuotas. Las fechas y números de cuota no cambian.
+
+    Args:
+        capital_pendiente (float): Capital que falta por pagar
+        monto (float): Monto del préstamo, base del interés
+        tasa_interes (float): Tasa mensual en porcentaje
+        plazo_meses (int): Plazo original (Bullet acumula el interés de todo el plazo)
+        frecuencia (str): Una de FRECUENCIAS
+        cuotas_restantes (int): Cantidad de cuotas a recalcular
+
+    Returns:
+        list: dicts con monto_capital, monto_interes, monto_total y saldo_restante
+    """
+    capital_pendiente = float(capital_pendiente)
+    monto = float(monto)
+    tasa_mensual = float(tasa_interes) / 100
+    if cuotas_restantes <= 0:
+        return []
+
+    def montos(monto_capital, monto_interes, saldo_restante):
+        return {
+            'monto_capital': monto_capital,
+            'monto_interes': monto_interes,
+            'monto_total': monto_capital + monto_interes,
+            'saldo_restante': saldo_restante,
+        }
+
+    periodos_por_mes = {'Mensual': 1, 'Quincenal': 2, 'Semanal': 4}
+    if frecuencia in periodos_por_mes:
+        interes_periodo = monto * (tasa_mensual / periodos_por_mes[frecuencia])
+        filas = _capital_fijo(capital_pendiente, interes_periodo, cuotas_restantes, None, lambda f: None)
+        return [montos(f['monto_capital'], f['monto_interes'], f['saldo_restante']) for f in filas]
+
+    if frecuencia == 'Bullet':
+        interes_total = monto * tasa_mensual * int(plazo_meses)
+        filas = [montos(0, 0, capital_pendiente) for _ in range(cuotas_restantes - 1)]
+        filas.append(montos(capital_pendiente, interes_total, 0))
+        return filas
+
+    if frecuencia == 'SoloInteresesSinFecha':
+        return [montos(0, monto * tasa_mensual, capital_pendiente) for _ in range(cuotas_restantes)]
+
+    return []
+
+def distribuir_pago(monto, cuotas):
+    """Reparte un pago entre las cuotas pendientes de un préstamo.
+
+    Recorre las cuotas en el orden recibido (de la más antigua a la más nueva) y
+    en cada una cubre primero el interés y después el capital. Se calcula en
+    centavos para que la suma de lo asignado sea exactamente el monto.
+
+    Args:
+        monto (float): Monto entregado por el cliente
+        cuotas (list): dicts con cuota_id, interes_pendiente y capital_pendiente
+
+    Returns:
+        tuple: (asignaciones, sobrante). Las asignaciones son dicts con cuota_id,
+        monto_interes, monto_capital, monto_pagado y saldada (la cuota queda
+        cubierta); el sobrante es lo que no alcanzó a asignarse a ninguna cuota
+    """
+    restante = round(float(monto) * 100)
+    asignaciones = []
+    for cuota in cuotas:
+        if restante <= 0:
+            break
+        interes_pendiente = max(0, round(float(cuota['interes_pendiente']) * 100))
+        capital_pendiente = max(0, round(float(cuota['capital_pendiente']) * 100))
+
+        interes = min(restante, interes_pendiente)
+        capital = min(restante - interes, capital_pendiente)
+        restante -= interes + capital
+        if not interes and not capital:
+            continue
+
+        asignaciones.append({
+            'cuota_id': cuota['cuota_id'],
+            'monto_interes': interes / 100,
+            'monto_capital': capital / 100,
+            'monto_pagado': (interes + capital) / 100,
+            'saldada': interes == interes_pendiente and capital == capital_pendiente,
+        })
+    return asignaciones, restante / 100
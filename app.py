@@ -1,8 +1,12 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file, make_response, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
+from decimal import Decimal
 import os
 from dotenv import load_dotenv
 from functools import wraps
@@ -16,8 +20,16 @@ from functools import wraps
 import io
 import tempfile
 import json
+import queue
+import threading
+import time
+import uuid
 from provincias_municipios_rd import obtener_provincias, obtener_municipios
-# from config_brevo import enviar_recibo_pago_brevo, enviar_notificacion_atraso_brevo
+from busqueda import terminos_texto, compactar_documento, terminos_busqueda
+from amortizacion import calcular_cuotas, calcular_cuotas_restantes, distribuir_pago
+from simulacion import TerminosCartera, simular_cartera
+from config_brevo import obtener_servicio_brevo, enviar_recibo_pago_brevo, enviar_notificacion_atraso_brevo
+from despacho_correos import LimitadorTasa, PoolDespacho, espera_reintento
 
 # Cargar variables de entorno
 load_dotenv()
@@ -31,6 +43,61 @@ if database_url.startswith('postgres://'):
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Mensajes por página en el historial del chat
+CHAT_MENSAJES_POR_PAGINA = int(os.getenv('CHAT_MENSAJES_POR_PAGINA', 50))
+
+# Configuración del stream de chat (Server-Sent Events)
+CHAT_SSE_LATIDO_SEGUNDOS = int(os.getenv('CHAT_SSE_LATIDO_SEGUNDOS', 15))
+CHAT_SSE_DURACION_SEGUNDOS = int(os.getenv('CHAT_SSE_DURACION_SEGUNDOS', 300))
+# Con varios nodos el mensaje puede publicarse en otro proceso: en cada latido se consulta la base
+CHAT_SSE_MULTINODO = os.getenv('CHAT_SSE_MULTINODO', 'false').lower() == 'true'
+# Streams abiertos a la vez en cada proceso. Cada uno ocupa un hilo del worker (--threads del
+# Procfile) durante CHAT_SSE_DURACION_SEGUNDOS, así que debe quedar muy por debajo de ese número
+# para que las demás rutas sigan respondiendo; por encima se responde 503 y la página consulta
+# /api/chat/mensajes-nuevos periódicamente
+CHAT_SSE_MAX_CONEXIONES = int(os.getenv('CHAT_SSE_MAX_CONEXIONES', 4))
+# Los ids se asignan al insertar pero los mensajes se confirman en otro orden: un mensaje con
+# id menor puede aparecer después de otro con id mayor. Los enviados en los últimos segundos se
+# vuelven a consultar por debajo del cursor (debe superar lo que tarda en confirmarse un envío)
+CHAT_VENTANA_CONFIRMACION_SEGUNDOS = int(os.getenv('CHAT_VENTANA_CONFIRMACION_SEGUNDOS', 60))
+
+# Listados de clientes, préstamos y pagos: paginación por cursor (keyset) en lugar de
+# números de página; también se activa por petición con ?paginacion=cursor
+LISTADOS_PAGINACION_CURSOR = os.getenv('LISTADOS_PAGINACION_CURSOR', 'false').lower() == 'true'
+# Segundos que se reutiliza el total de registros de un listado con los mismos filtros
+LISTADOS_CONTEO_CACHE_SEGUNDOS = int(os.getenv('LISTADOS_CONTEO_CACHE_SEGUNDOS', 300))
+
+# Pronóstico de cobros: días por defecto y días de historia para calcular qué parte
+# de lo que vence se cobra a tiempo
+PRONOSTICO_DIAS = int(os.getenv('PRONOSTICO_DIAS', 90))
+PRONOSTICO_DIAS_HISTORIA = int(os.getenv('PRONOSTICO_DIAS_HISTORIA', 180))
+
+# Movimientos de capital sin consolidar a partir de los cuales se suman al saldo de Contabilidad
+CAPITAL_MOVIMIENTOS_POR_CONSOLIDAR = int(os.getenv('CAPITAL_MOVIMIENTOS_POR_CONSOLIDAR', 500))
+
+# Máximo de pagos que acepta /api/pagos/lote en una sola solicitud
+MAX_PAGOS_POR_LOTE = int(os.getenv('MAX_PAGOS_POR_LOTE', 500))
+
+# Envío de notificaciones de atraso en segundo plano (bandeja de salida CorreoSaliente)
+CORREOS_HILOS = int(os.getenv('CORREOS_HILOS', 4))
+# Llamadas a la API de Brevo por segundo (por lote o por correo)
+CORREOS_POR_SEGUNDO = float(os.getenv('CORREOS_POR_SEGUNDO', 5))
+# Correos que toma cada hilo a la vez; con envío por lote van todos en una llamada
+CORREOS_POR_RECLAMO = int(os.getenv('CORREOS_POR_RECLAMO', 50))
+CORREOS_ENVIO_POR_LOTE = os.getenv('CORREOS_ENVIO_POR_LOTE', 'true').lower() == 'true'
+CORREOS_MAX_INTENTOS = int(os.getenv('CORREOS_MAX_INTENTOS', 5))
+CORREOS_ESPERA_REINTENTO_SEGUNDOS = float(os.getenv('CORREOS_ESPERA_REINTENTO_SEGUNDOS', 30))
+# Un correo reclamado que no se marcó en este tiempo (proceso caído) vuelve a la cola
+CORREOS_RECLAMO_VENCE_SEGUNDOS = int(os.getenv('CORREOS_RECLAMO_VENCE_SEGUNDOS', 600))
+# Con false los correos solo los envía despachar_correos.py y no los procesos web
+CORREOS_DESPACHO_EN_PROCESO = os.getenv('CORREOS_DESPACHO_EN_PROCESO', 'true').lower() == 'true'
+# Recargo por atraso que se informa en la notificación
+RECARGO_ATRASO_NOTIFICACION = float(os.getenv('RECARGO_ATRASO_NOTIFICACION', 0.05))
+# Notificaciones por cliente y canal permitidas en los últimos N días (0 = sin límite);
+# además cada cuota se notifica como máximo una vez al día por canal
+NOTIFICACIONES_MAX_POR_CLIENTE = int(os.getenv('NOTIFICACIONES_MAX_POR_CLIENTE', 1))
+NOTIFICACIONES_VENTANA_DIAS = int(os.getenv('NOTIFICACIONES_VENTANA_DIAS', 1))
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -89,6 +156,47 @@ class Cliente(db.Model):
     direccion_trabajo = db.Column(db.String(200), nullable=False)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     activo = db.Column(db.Boolean, default=True)
+    
+    __table_args__ = (
+        db.Index('ix_cliente_fecha_creacion_id', 'fecha_creacion', 'id'),
+    )
+
+class TerminoCliente(db.Model):
+    """Índice de búsqueda de clientes: una fila por palabra normalizada del nombre,
+    apellidos y apodo, más el documento compactado"""
+    id = db.Column(db.Integer, primary_key=True)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False, index=True)
+    termino = db.Column(db.String(100), nullable=False)
+    es_documento = db.Column(db.Boolean, nullable=False, default=False)
+    
+    __table_args__ = (
+        # Las búsquedas son por prefijo; en PostgreSQL LIKE 'x%' necesita pattern_ops
+        db.Index('ix_termino_cliente_termino', 'termino', 'cliente_id',
+                 postgresql_ops={'termino': 'varchar_pattern_ops'}),
+    )
+
+CAMPOS_BUSQUEDA_CLIENTE = ('nombre', 'apellidos', 'apodo', 'documento')
+
+def indexar_terminos_cliente(conexion, cliente):
+    """Reemplaza los términos de búsqueda del cliente usando la conexión dada"""
+    conexion.execute(TerminoCliente.__table__.delete().where(TerminoCliente.cliente_id == cliente.id))
+    filas = [{'cliente_id': cliente.id, 'termino': termino, 'es_documento': False}
+             for termino in terminos_texto(cliente.nombre, cliente.apellidos, cliente.apodo)]
+    documento = compactar_documento(cliente.documento)
+    if documento:
+        filas.append({'cliente_id': cliente.id, 'termino': documento, 'es_documento': True})
+    if filas:
+        conexion.execute(TerminoCliente.__table__.insert(), filas)
+
+@event.listens_for(Cliente, 'after_insert')
+def _indexar_cliente_nuevo(mapper, conexion, cliente):
+    indexar_terminos_cliente(conexion, cliente)
+
+@event.listens_for(Cliente, 'after_update')
+def _indexar_cliente_editado(mapper, conexion, cliente):
+    estado = db.inspect(cliente)
+    if any(estado.attrs[campo].history.has_changes() for campo in CAMPOS_BUSQUEDA_CLIENTE):
+        indexar_terminos_cliente(conexion, cliente)
 
 class Prestamo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -104,7 +212,36 @@ class Prestamo(db.Model):
     estado_garantia = db.Column(db.String(50), default='En Custodia')
     estado = db.Column(db.String(20), default='Activo')
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    # Saldos calculados desde las cuotas y pagos; los mantiene actualizar_saldos_prestamo
+    total_cuotas = db.Column(db.Integer, default=0)
+    cuotas_pagadas = db.Column(db.Integer, default=0)
+    cuotas_pendientes = db.Column(db.Integer, default=0)  # Pendientes y parciales
+    cuotas_atrasadas = db.Column(db.Integer, default=0)
+    fecha_corte_atrasos = db.Column(db.Date)  # Día para el que se contaron las cuotas atrasadas
+    monto_cuotas = db.Column(db.Numeric(12, 2), default=0.00)
+    capital_pendiente = db.Column(db.Numeric(12, 2), default=0.00)
+    interes_pendiente = db.Column(db.Numeric(12, 2), default=0.00)
+    fecha_ultimo_pago = db.Column(db.DateTime)  # Último pago registrado en una de sus cuotas
     cliente = db.relationship('Cliente', backref='prestamos')
+    
+    @property
+    def monto_pendiente(self):
+        """Capital e interés que faltan por cobrar de las cuotas"""
+        return float(self.capital_pendiente or 0) + float(self.interes_pendiente or 0)
+    
+    @property
+    def monto_cobrado(self):
+        """Parte del total de las cuotas que ya se cobró"""
+        return float(self.monto_cuotas or 0) - self.monto_pendiente
+    
+    __table_args__ = (
+        db.Index('ix_prestamo_fecha_creacion_id', 'fecha_creacion', 'id'),
+        db.Index('ix_prestamo_cliente_estado', 'cliente_id', 'estado'),
+    )
+
+def _sin_indices_parciales(ddl, target, bind, dialect, **kw):
+    """Crear el índice solo en las bases sin índices parciales usables (MySQL, SQLite)"""
+    return dialect.name != 'postgresql'
 
 class Cuota(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -118,6 +255,16 @@ class Cuota(db.Model):
     estado = db.Column(db.String(20), default='Pendiente')
     prestamo = db.relationship('Prestamo', backref='cuotas')
     
+    __table_args__ = (
+        db.Index('ix_cuota_prestamo_numero', 'prestamo_id', 'numero_cuota'),
+        # Cuotas atrasadas (estado = 'Pendiente' AND fecha_vencimiento < hoy): índice parcial
+        # en PostgreSQL y compuesto en las bases que no lo admiten
+        db.Index('ix_cuota_pendiente_vencimiento', 'fecha_vencimiento',
+                 postgresql_where=db.text("estado = 'Pendiente'")).ddl_if(dialect='postgresql'),
+        db.Index('ix_cuota_estado_vencimiento', 'estado', 'fecha_vencimiento').ddl_if(
+            callable_=_sin_indices_parciales),
+    )
+    
     @property
     def dias_atraso(self):
         """Calcula los días de atraso de la cuota"""
@@ -134,14 +281,38 @@ class Pago(db.Model):
     tipo_pago = db.Column(db.String(20), default='Normal')
     fecha_pago = db.Column(db.DateTime, default=datetime.utcnow)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    clave_idempotencia = db.Column(db.String(64))  # Enviada con el formulario; evita registrar dos veces el mismo pago
     cuota = db.relationship('Cuota', backref='pagos')
     usuario = db.relationship('Usuario', backref='pagos')
+    
+    __table_args__ = (
+        db.Index('ix_pago_fecha_pago_id', 'fecha_pago', 'id'),
+        db.Index('ix_pago_cuota_id', 'cuota_id'),
+        db.Index('uq_pago_clave_idempotencia', 'clave_idempotencia', unique=True),
+    )
 
 class Contabilidad(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    capital_disponible = db.Column(db.Numeric(10, 2), default=0.00)
+    capital_disponible = db.Column(db.Numeric(10, 2), default=0.00)  # Saldo hasta la última consolidación
     fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
 
+class MovimientoCapital(db.Model):
+    """Entrada o salida del capital disponible; las filas solo se agregan, nunca se modifican los montos"""
+    id = db.Column(db.Integer, primary_key=True)
+    monto = db.Column(db.Numeric(12, 2), nullable=False)  # Positivo entra, negativo sale
+    concepto = db.Column(db.String(30), nullable=False)
+    descripcion = db.Column(db.String(200))
+    prestamo_id = db.Column(db.Integer)
+    pago_id = db.Column(db.Integer)
+    gasto_id = db.Column(db.Integer)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    fecha = db.Column(db.DateTime, default=datetime.utcnow)
+    consolidado = db.Column(db.Boolean, nullable=False, default=False)  # Ya sumado a Contabilidad.capital_disponible
+    
+    __table_args__ = (
+        db.Index('ix_movimiento_capital_consolidado_id', 'consolidado', 'id'),
+    )
+
 class Gasto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     descripcion = db.Column(db.String(200), nullable=False)
@@ -169,12 +340,28 @@ class Reporte(db.Model):
         return f'<Reporte {self.tipo} - {self.nombre}>'
 
 # Modelos para el sistema de chat
+def _participante_canonico(contexto, posicion):
+    """Default de columna: participante menor (0) o mayor (1) de la conversación"""
+    parametros = contexto.get_current_parameters()
+    return sorted((int(parametros['usuario1_id']), int(parametros['usuario2_id'])))[posicion]
+
 class Conversacion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     usuario1_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
     usuario2_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     activa = db.Column(db.Boolean, default=True)
+    # Par de participantes en orden canónico (menor, mayor) para buscar la conversación
+    # con una sola consulta al índice sin importar quién la inició
+    usuario_menor_id = db.Column(db.Integer, default=lambda contexto: _participante_canonico(contexto, 0))
+    usuario_mayor_id = db.Column(db.Integer, default=lambda contexto: _participante_canonico(contexto, 1))
+    # True mientras está activa y NULL al cerrarla: el índice único solo admite una
+    # conversación abierta por par y deja repetir las cerradas
+    par_abierto = db.Column(db.Boolean, default=True)
+    
+    __table_args__ = (
+        db.Index('uq_conversacion_par_abierto', 'usuario_menor_id', 'usuario_mayor_id', 'par_abierto', unique=True),
+    )
     
     # Relaciones
     usuario1 = db.relationship('Usuario', foreign_keys=[usuario1_id], backref='conversaciones_iniciadas')
@@ -195,9 +382,202 @@ class Mensaje(db.Model):
     # Relaciones
     remitente = db.relationship('Usuario', backref='mensajes_enviados')
     
+    # Índice para paginar el historial por keyset (conversacion_id, fecha_envio, id)
+    __table_args__ = (db.Index('ix_mensaje_conversacion_fecha_id', 'conversacion_id', 'fecha_envio', 'id'),)
+    
     def __repr__(self):
         return f'<Mensaje {self.id} de {self.remitente_id}>'
 
+class ChatNoLeidosUsuario(db.Model):
+    """Total de mensajes no leídos por usuario (contador del badge del chat)"""
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+class ChatNoLeidosConversacion(db.Model):
+    """Mensajes no leídos por usuario en cada conversación"""
+    id = db.Column(db.Integer, primary_key=True)
+    conversacion_id = db.Column(db.Integer, db.ForeignKey('conversacion.id'), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    no_leidos = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (db.UniqueConstraint('conversacion_id', 'usuario_id', name='uq_chat_no_leidos_conversacion_usuario'),)
+
+class ResumenCartera(db.Model):
+    """Resumen de la cartera mantenido de forma incremental para el dashboard (una sola fila)"""
+    id = db.Column(db.Integer, primary_key=True)
+    prestamos_activos = db.Column(db.Integer, default=0)
+    clientes_activos = db.Column(db.Integer, default=0)
+    monto_atrasado = db.Column(db.Numeric(12, 2), default=0.00)
+    clientes_atrasados = db.Column(db.Integer, default=0)
+    fecha_corte = db.Column(db.Date)  # Día para el que se calcularon los atrasos
+    mes = db.Column(db.Date)  # Primer día del mes de los acumulados mensuales
+    prestamos_mes = db.Column(db.Integer, default=0)
+    monto_prestamos_mes = db.Column(db.Numeric(12, 2), default=0.00)
+    pagos_mes = db.Column(db.Integer, default=0)
+    monto_pagos_mes = db.Column(db.Numeric(12, 2), default=0.00)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ResumenCartera {self.fecha_corte}>'
+
+# Tramos de antigüedad de los atrasos: (sufijo de las columnas, etiqueta, días desde, días hasta)
+TRAMOS_ATRASO = (
+    ('1_30', '1-30 días', 1, 30),
+    ('31_60', '31-60 días', 31, 60),
+    ('61_90', '61-90 días', 61, 90),
+    ('90_mas', 'Más de 90 días', 91, None),
+)
+
+class CorteAntiguedad(db.Model):
+    """Totales de la cartera atrasada por tramo de días en un día (una fila por corte, se conservan)"""
+    fecha = db.Column(db.Date, primary_key=True)
+    fecha_generacion = db.Column(db.DateTime, default=datetime.utcnow)
+    prestamos_atrasados = db.Column(db.Integer, default=0)
+    clientes_atrasados = db.Column(db.Integer, default=0)
+    cuotas_1_30 = db.Column(db.Integer, default=0)
+    monto_1_30 = db.Column(db.Numeric(12, 2), default=0.00)
+    cuotas_31_60 = db.Column(db.Integer, default=0)
+    monto_31_60 = db.Column(db.Numeric(12, 2), default=0.00)
+    cuotas_61_90 = db.Column(db.Integer, default=0)
+    monto_61_90 = db.Column(db.Numeric(12, 2), default=0.00)
+    cuotas_90_mas = db.Column(db.Integer, default=0)
+    monto_90_mas = db.Column(db.Numeric(12, 2), default=0.00)
+    
+    @property
+    def cuotas_atrasadas(self):
+        return sum(getattr(self, f'cuotas_{clave}') or 0 for clave, _, _, _ in TRAMOS_ATRASO)
+    
+    @property
+    def monto_atrasado(self):
+        return sum(float(getattr(self, f'monto_{clave}') or 0) for clave, _, _, _ in TRAMOS_ATRASO)
+    
+    def tramos(self):
+        """Cuotas, monto y porcentaje del monto atrasado de cada tramo"""
+        total = self.monto_atrasado
+        return [{
+            'clave': clave,
+            'etiqueta': etiqueta,
+            'cuotas': getattr(self, f'cuotas_{clave}') or 0,
+            'monto': float(getattr(self, f'monto_{clave}') or 0),
+            'porcentaje': float(getattr(self, f'monto_{clave}') or 0) / total * 100 if total else 0
+        } for clave, etiqueta, _, _ in TRAMOS_ATRASO]
+
+class AntiguedadPrestamo(db.Model):
+    """Cuotas y montos atrasados de un préstamo por tramo de días en un corte"""
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False)
+    prestamo_id = db.Column(db.Integer, nullable=False)
+    cliente_id = db.Column(db.Integer, nullable=False)
+    cuota_mas_antigua_id = db.Column(db.Integer)
+    vencimiento_mas_antiguo = db.Column(db.Date)
+    cuotas_1_30 = db.Column(db.Integer, default=0)
+    monto_1_30 = db.Column(db.Numeric(12, 2), default=0.00)
+    cuotas_31_60 = db.Column(db.Integer, default=0)
+    monto_31_60 = db.Column(db.Numeric(12, 2), default=0.00)
+    cuotas_61_90 = db.Column(db.Integer, default=0)
+    monto_61_90 = db.Column(db.Numeric(12, 2), default=0.00)
+    cuotas_90_mas = db.Column(db.Integer, default=0)
+    monto_90_mas = db.Column(db.Numeric(12, 2), default=0.00)
+    
+    __table_args__ = (
+        db.Index('uq_antiguedad_prestamo_fecha', 'fecha', 'prestamo_id', unique=True),
+        db.Index('ix_antiguedad_prestamo_cliente', 'fecha', 'cliente_id'),
+    )
+    
+    @property
+    def dias_atraso(self):
+        """Días de atraso de la cuota más antigua a la fecha del corte"""
+        return (self.fecha - self.vencimiento_mas_antiguo).days if self.vencimiento_mas_antiguo else 0
+    
+    @property
+    def cuotas_atrasadas(self):
+        return sum(getattr(self, f'cuotas_{clave}') or 0 for clave, _, _, _ in TRAMOS_ATRASO)
+    
+    @property
+    def monto_atrasado(self):
+        return sum(float(getattr(self, f'monto_{clave}') or 0) for clave, _, _, _ in TRAMOS_ATRASO)
+
+class TrabajoNotificacion(db.Model):
+    """Envío masivo de notificaciones de atraso solicitado desde la página de atrasados"""
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    total = db.Column(db.Integer, default=0)  # Correos encolados
+    omitidas = db.Column(db.Integer, default=0)  # Cuotas de clientes sin correo
+    duplicadas = db.Column(db.Integer, default=0)  # Cuotas ya notificadas hoy
+    limitadas = db.Column(db.Integer, default=0)  # Cuotas de clientes que llegaron al límite de notificaciones
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    usuario = db.relationship('Usuario', backref='trabajos_notificacion')
+    
+    def progreso(self):
+        """Correos del trabajo por estado, contados en una sola consulta"""
+        conteos = dict(db.session.query(CorreoSaliente.estado, db.func.count(CorreoSaliente.id)).filter(
+            CorreoSaliente.trabajo_id == self.id
+        ).group_by(CorreoSaliente.estado).all())
+        pendientes = conteos.get('Pendiente', 0) + conteos.get('Enviando', 0)
+        return {
+            'id': self.id,
+            'total': self.total,
+            'omitidas': self.omitidas,
+            'duplicadas': self.duplicadas or 0,
+            'limitadas': self.limitadas or 0,
+            'pendientes': pendientes,
+            'enviados': conteos.get('Enviado', 0),
+            'fallidos': conteos.get('Fallido', 0),
+            'inciertos': conteos.get('Incierto', 0),
+            'terminado': pendientes == 0,
+            'fecha_creacion': self.fecha_creacion.strftime('%d/%m/%Y %H:%M') if self.fecha_creacion else None
+        }
+
+class CorreoSaliente(db.Model):
+    """Bandeja de salida: un correo por cuota, enviado por los hilos de despacho.
+    Estados: Pendiente -> Enviando -> Enviado, o de vuelta a Pendiente para reintentar,
+    o Fallido al agotar los intentos o con un error que no se corrige reintentando, o
+    Incierto si Brevo no respondió después de recibir la solicitud (pudo haberse enviado,
+    así que no se repite)."""
+    id = db.Column(db.Integer, primary_key=True)
+    trabajo_id = db.Column(db.Integer, db.ForeignKey('trabajo_notificacion.id'))
+    cuota_id = db.Column(db.Integer)
+    destinatario = db.Column(db.String(120), nullable=False)
+    nombre = db.Column(db.String(200), nullable=False)
+    datos = db.Column(db.Text, nullable=False)  # JSON con los datos de la cuota para la plantilla
+    estado = db.Column(db.String(20), default='Pendiente')
+    intentos = db.Column(db.Integer, default=0)
+    proximo_intento = db.Column(db.DateTime, default=datetime.utcnow)
+    reclamo = db.Column(db.String(32))  # Marca del hilo que lo está enviando
+    fecha_reclamo = db.Column(db.DateTime)
+    ultimo_error = db.Column(db.Text)
+    message_id = db.Column(db.String(100))
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_envio = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_correo_saliente_estado_proximo', 'estado', 'proximo_intento'),
+        db.Index('ix_correo_saliente_trabajo_estado', 'trabajo_id', 'estado'),
+    )
+
+class RegistroNotificacion(db.Model):
+    """Notificaciones de atraso enviadas (o encoladas) por cuota, canal y día.
+    Se anota antes de enviar: el índice único impide notificar la misma cuota dos veces
+    el mismo día por el mismo canal aunque dos solicitudes lleguen a la vez, y las filas
+    del cliente sirven para limitar cuántas recibe. Si el envío falla la fila se borra
+    para que se pueda volver a intentar."""
+    id = db.Column(db.Integer, primary_key=True)
+    # Sin llave foránea: las cuotas se regeneran y borran con el préstamo, y el registro se conserva
+    cuota_id = db.Column(db.Integer, nullable=False)
+    cliente_id = db.Column(db.Integer, nullable=False)
+    canal = db.Column(db.String(20), nullable=False, default='email')  # email (más adelante whatsapp, sms...)
+    fecha = db.Column(db.Date, nullable=False)
+    trabajo_id = db.Column(db.Integer, db.ForeignKey('trabajo_notificacion.id'))  # Si fue un envío masivo
+    usuario_id = db.Column(db.Integer)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('uq_registro_notificacion_cuota_canal_fecha', 'cuota_id', 'canal', 'fecha', unique=True),
+        db.Index('ix_registro_notificacion_cliente_canal_fecha', 'cliente_id', 'canal', 'fecha'),
+        db.Index('ix_registro_notificacion_trabajo_cuota', 'trabajo_id', 'cuota_id'),
+    )
+
 @login_manager.user_loader
 def load_user(user_id):
     return Usuario.query.get(int(user_id))
@@ -237,39 +617,345 @@ def logout():
     flash('Sesión cerrada exitosamente', 'info')
     return redirect(url_for('login'))
 
+# Resumen de cartera para el dashboard
+CAMPOS_RESUMEN_ATRASOS = ('monto_atrasado', 'clientes_atrasados')
+CAMPOS_RESUMEN_MES = ('prestamos_mes', 'monto_prestamos_mes', 'pagos_mes', 'monto_pagos_mes')
+
+def _refrescar_atrasos_resumen(resumen, fecha_actual):
+    """Recalcula monto y clientes atrasados con una sola consulta agregada"""
+    monto_atrasado, clientes_atrasados = db.session.query(
+        db.func.coalesce(db.func.sum(Cuota.monto_total), 0),
+        db.func.count(db.distinct(Prestamo.cliente_id))
+    ).join(Prestamo, Cuota.prestamo_id == Prestamo.id).filter(
+        Cuota.estado == 'Pendiente',
+        Cuota.fecha_vencimiento < fecha_actual
+    ).one()
+
+    resumen.monto_atrasado = monto_atrasado
+    resumen.clientes_atrasados = clientes_atrasados
+    resumen.fecha_corte = fecha_actual
+
+def _refrescar_mes_resumen(resumen, inicio_mes):
+    """Recalcula los acumulados del mes (desembolsos y cobros)"""
+    prestamos_mes = Prestamo.query.filter(Prestamo.fecha_creacion >= inicio_mes).count()
+
+    # Los desembolsos salen de los gastos tipo "Préstamos": Prestamo.monto baja con los abonos al capital
+    monto_prestamos_mes = db.session.query(
+        db.func.coalesce(db.func.sum(Gasto.monto), 0)
+    ).filter(Gasto.tipo == 'Préstamos', Gasto.fecha >= inicio_mes).scalar()
+
+    pagos_mes, monto_pagos_mes = db.session.query(
+        db.func.count(Pago.id),
+        db.func.coalesce(db.func.sum(Pago.monto_pagado), 0)
+    ).filter(Pago.fecha_pago >= inicio_mes).one()
+
+    resumen.prestamos_mes = prestamos_mes
+    resumen.monto_prestamos_mes = monto_prestamos_mes
+    resumen.pagos_mes = pagos_mes
+    resumen.monto_pagos_mes = monto_pagos_mes
+    resumen.mes = inicio_mes
+
+def reconstruir_resumen_cartera():
+    """Recalcula desde cero el resumen de cartera (el commit queda a cargo del llamador)"""
+    fecha_actual = datetime.now().date()
+    resumen = ResumenCartera.query.first()
+    if not resumen:
+        resumen = ResumenCartera()
+        db.session.add(resumen)
+
+    resumen.prestamos_activos = Prestamo.query.filter_by(estado='Activo').count()
+    resumen.clientes_activos = Cliente.query.filter_by(activo=True).count()
+    _refrescar_atrasos_resumen(resumen, fecha_actual)
+    _refrescar_mes_resumen(resumen, fecha_actual.replace(day=1))
+    resumen.fecha_actualizacion = datetime.utcnow()
+    return resumen
+
+def _sincronizar_resumen_cartera():
+    """Obtiene el resumen y recalcula las cifras que dependen de la fecha si cambió el día o el mes.
+
+    Returns:
+        tuple: (resumen, conjunto de grupos recalculados: 'todo', 'atrasos', 'mes')
+    """
+    fecha_actual = datetime.now().date()
+    inicio_mes = fecha_actual.replace(day=1)
+    resumen = ResumenCartera.query.first()
+    if not resumen:
+        return reconstruir_resumen_cartera(), {'todo'}
+
+    recalculados = set()
+    if resumen.fecha_corte != fecha_actual:
+        _refrescar_atrasos_resumen(resumen, fecha_actual)
+        recalculados.add('atrasos')
+    if resumen.mes != inicio_mes:
+        _refrescar_mes_resumen(resumen, inicio_mes)
+        recalculados.add('mes')
+    if recalculados:
+        resumen.fecha_actualizacion = datetime.utcnow()
+    return resumen, recalculados
+
+def obtener_resumen_cartera():
+    """Devuelve el resumen de cartera listo para leer (una fila)"""
+    resumen, _ = _sincronizar_resumen_cartera()
+    return resumen
+
+def ajustar_resumen_cartera(**deltas):
+    """Aplica incrementos al resumen con un UPDATE atómico dentro de la transacción actual.
+
+    Los cambios pendientes de la sesión se envían antes, de modo que si el resumen
+    debe recalcularse (primer uso, cambio de día o de mes) el recálculo ya los incluye
+    y los incrementos de ese grupo se descartan.
+    """
+    db.session.flush()
+    resumen, recalculados = _sincronizar_resumen_cartera()
+    if 'todo' in recalculados:
+        return
+
+    valores = {}
+    for campo, delta in deltas.items():
+        if not delta:
+            continue
+        if 'atrasos' in recalculados and campo in CAMPOS_RESUMEN_ATRASOS:
+            continue
+        if 'mes' in recalculados and campo in CAMPOS_RESUMEN_MES:
+            continue
+        columna = getattr(ResumenCartera, campo)
+        valores[columna] = columna + delta
+
+    if valores:
+        db.session.flush()
+        valores[ResumenCartera.fecha_actualizacion] = datetime.utcnow()
+        ResumenCartera.query.filter_by(id=resumen.id).update(valores, synchronize_session=False)
+        db.session.expire(resumen)
+
+def refrescar_atrasos_resumen():
+    """Recalcula los atrasos del resumen tras regenerar o eliminar cronogramas de cuotas"""
+    db.session.flush()
+    resumen = obtener_resumen_cartera()
+    _refrescar_atrasos_resumen(resumen, datetime.now().date())
+    resumen.fecha_actualizacion = datetime.utcnow()
+
+# Capital disponible
+def registrar_movimiento_capital(monto, concepto, descripcion=None, prestamo_id=None, pago_id=None, gasto_id=None):
+    """Agrega un movimiento de capital a la transacción actual.
+
+    Es solo un INSERT: no lee ni bloquea la fila de Contabilidad, así que los cobros y
+    desembolsos simultáneos no se esperan entre sí ni se pisan el saldo.
+    """
+    monto = Decimal(str(monto)).quantize(Decimal('0.01'))
+    if not monto:
+        return None
+
+    movimiento = MovimientoCapital(
+        monto=monto,
+        concepto=concepto,
+        descripcion=descripcion,
+        prestamo_id=prestamo_id,
+        pago_id=pago_id,
+        gasto_id=gasto_id,
+        usuario_id=current_user.id if current_user and current_user.is_authenticated else None
+    )
+    db.session.add(movimiento)
+    return movimiento
+
+def obtener_capital_disponible():
+    """Saldo consolidado más los movimientos sin consolidar, leídos en una sola consulta"""
+    pendiente = db.select(db.func.coalesce(db.func.sum(MovimientoCapital.monto), 0)).where(
+        MovimientoCapital.consolidado == False
+    ).scalar_subquery()
+    saldo = db.session.execute(
+        db.select(db.func.coalesce(Contabilidad.capital_disponible, 0) + pendiente).order_by(Contabilidad.id).limit(1)
+    ).scalar()
+    if saldo is None:
+        saldo = db.session.execute(db.select(pendiente)).scalar()
+    return Decimal(str(saldo)).quantize(Decimal('0.01'))
+
+def consolidar_capital():
+    """Suma al saldo de Contabilidad los movimientos sin consolidar y los marca (confirma la transacción).
+
+    Solo bloquea la fila de Contabilidad, que los movimientos no tocan. Los movimientos de
+    transacciones que todavía no confirman se consolidan en la siguiente pasada.
+
+    Returns:
+        int: Cantidad de movimientos consolidados
+    """
+    contabilidad = Contabilidad.query.order_by(Contabilidad.id).with_for_update().first()
+    if not contabilidad:
+        contabilidad = Contabilidad(capital_disponible=0)
+        db.session.add(contabilidad)
+
+    saldo = Decimal(str(contabilidad.capital_disponible or 0))
+    total = 0
+    while True:
+        movimientos = db.session.execute(
+            db.select(MovimientoCapital.id, MovimientoCapital.monto)
+            .where(MovimientoCapital.consolidado == False)
+            .order_by(MovimientoCapital.id).limit(1000)
+        ).all()
+        if not movimientos:
+            break
+        MovimientoCapital.query.filter(MovimientoCapital.id.in_([m.id for m in movimientos])).update(
+            {MovimientoCapital.consolidado: True}, synchronize_session=False)
+        saldo += sum(Decimal(str(m.monto)) for m in movimientos)
+        total += len(movimientos)
+
+    contabilidad.capital_disponible = saldo
+    contabilidad.fecha_actualizacion = datetime.utcnow()
+    db.session.commit()
+    return total
+
+def consolidar_capital_si_corresponde():
+    """Consolida cuando se acumulan CAPITAL_MOVIMIENTOS_POR_CONSOLIDAR movimientos pendientes"""
+    pendientes = MovimientoCapital.query.filter(MovimientoCapital.consolidado == False).count()
+    if pendientes >= CAPITAL_MOVIMIENTOS_POR_CONSOLIDAR:
+        consolidar_capital()
+
+def cuota_esta_atrasada(cuota, fecha_actual=None):
+    """Indica si una cuota cuenta como atrasada en el resumen (pendiente y vencida)"""
+    fecha_actual = fecha_actual or datetime.now().date()
+    return cuota.estado == 'Pendiente' and cuota.fecha_vencimiento < fecha_actual
+
+def actualizar_atraso_cuota_resumen(cuota, estaba_atrasada):
+    """Refleja en el resumen que una cuota entró o salió de atraso"""
+    fecha_actual = datetime.now().date()
+    esta_atrasada = cuota_esta_atrasada(cuota, fecha_actual)
+    if esta_atrasada == estaba_atrasada:
+        return
+
+    # ¿El cliente tiene otras cuotas atrasadas además de esta?
+    db.session.flush()
+    otra_cuota_atrasada = db.session.query(Cuota.id).join(Prestamo, Cuota.prestamo_id == Prestamo.id).filter(
+        Prestamo.cliente_id == cuota.prestamo.cliente_id,
+        Cuota.id != cuota.id,
+        Cuota.estado == 'Pendiente',
+        Cuota.fecha_vencimiento < fecha_actual
+    ).first()
+    delta_clientes = 0 if otra_cuota_atrasada else 1
+
+    if esta_atrasada:
+        ajustar_resumen_cartera(monto_atrasado=float(cuota.monto_total), clientes_atrasados=delta_clientes)
+    else:
+        ajustar_resumen_cartera(monto_atrasado=-float(cuota.monto_total), clientes_atrasados=-delta_clientes)
+
+# Antigüedad de los atrasos
+def generar_corte_antiguedad(fecha_actual=None):
+    """Guarda la antigüedad de los atrasos de cada préstamo y los totales de la cartera
+    para un día (confirma la transacción). Si el corte ya existía se reemplaza.
+
+    Los tramos se calculan en la base con un solo INSERT ... SELECT agrupado por préstamo.
+    Se calculan con el estado actual de las cuotas, por eso no se aceptan fechas pasadas:
+    los pagos registrados después cambiarían la historia de los cortes guardados.
+    """
+    hoy = datetime.now().date()
+    fecha_actual = fecha_actual or hoy
+    if fecha_actual < hoy:
+        raise ValueError('No se puede generar un corte de una fecha pasada')
+    AntiguedadPrestamo.query.filter_by(fecha=fecha_actual).delete(synchronize_session=False)
+
+    columnas = {}
+    for clave, _, desde, hasta in TRAMOS_ATRASO:
+        en_tramo = Cuota.fecha_vencimiento <= fecha_actual - timedelta(days=desde)
+        if hasta:
+            en_tramo = db.and_(en_tramo, Cuota.fecha_vencimiento >= fecha_actual - timedelta(days=hasta))
+        columnas[f'cuotas_{clave}'] = db.func.sum(db.case((en_tramo, 1), else_=0))
+        columnas[f'monto_{clave}'] = db.func.sum(db.case((en_tramo, Cuota.monto_total), else_=0))
+
+    por_prestamo = db.select(
+        db.literal(fecha_actual, db.Date), Cuota.prestamo_id, Prestamo.cliente_id,
+        db.func.min(Cuota.id), db.func.min(Cuota.fecha_vencimiento), *columnas.values()
+    ).join(Prestamo, Cuota.prestamo_id == Prestamo.id).where(
+        _condicion_cuota_atrasada(fecha_actual)
+    ).group_by(Cuota.prestamo_id, Prestamo.cliente_id)
+    db.session.execute(db.insert(AntiguedadPrestamo).from_select(
+        ['fecha', 'prestamo_id', 'cliente_id', 'cuota_mas_antigua_id', 'vencimiento_mas_antiguo', *columnas],
+        por_prestamo))
+
+    totales = db.session.query(
+        db.func.count(AntiguedadPrestamo.id),
+        db.func.count(db.distinct(AntiguedadPrestamo.cliente_id)),
+        *[db.func.coalesce(db.func.sum(getattr(AntiguedadPrestamo, columna)), 0) for columna in columnas]
+    ).filter(AntiguedadPrestamo.fecha == fecha_actual).one()
+    corte = db.session.get(CorteAntiguedad, fecha_actual)
+    if corte is None:
+        corte = CorteAntiguedad(fecha=fecha_actual)
+        db.session.add(corte)
+    corte.fecha_generacion = datetime.utcnow()
+    corte.prestamos_atrasados, corte.clientes_atrasados = totales[0], totales[1]
+    for columna, valor in zip(columnas, totales[2:]):
+        setattr(corte, columna, valor)
+    db.session.commit()
+    return corte
+
+def obtener_corte_antiguedad():
+    """Corte de antigüedad de hoy; si el trabajo nocturno no corrió se genera en este momento"""
+    fecha_actual = datetime.now().date()
+    corte = db.session.get(CorteAntiguedad, fecha_actual)
+    if corte is None:
+        try:
+            corte = generar_corte_antiguedad(fecha_actual)
+        except IntegrityError:
+            # Otra solicitud lo generó al mismo tiempo
+            db.session.rollback()
+            corte = db.session.get(CorteAntiguedad, fecha_actual)
+    return corte
+
+def calcular_traslados_atraso(cortes):
+    """Tasas de traslado (roll rates) entre tramos a partir de los cortes guardados.
+
+    Para cada corte, qué parte del monto de un tramo 30 días antes pasó al tramo
+    siguiente: monto del tramo siguiente hoy / monto del tramo hace 30 días.
+
+    Args:
+        cortes (dict): {fecha: CorteAntiguedad}
+
+    Returns:
+        dict: {fecha: {'1_30': tasa, '31_60': tasa, '61_90': tasa}} (None sin corte o monto base)
+    """
+    traslados = {}
+    for fecha, corte in cortes.items():
+        anterior = cortes.get(fecha - timedelta(days=30))
+        tasas = {}
+        for (clave, _, _, _), (siguiente, _, _, _) in zip(TRAMOS_ATRASO, TRAMOS_ATRASO[1:]):
+            base = float(getattr(anterior, f'monto_{clave}') or 0) if anterior else 0
+            tasas[clave] = round(float(getattr(corte, f'monto_{siguiente}') or 0) / base, 4) if base else None
+        traslados[fecha] = tasas
+    return traslados
+
+def es_del_mes_actual(fecha):
+    """Indica si una fecha cae dentro del mes en curso"""
+    if not fecha:
+        return False
+    fecha_actual = datetime.now().date()
+    fecha = fecha.date() if isinstance(fecha, datetime) else fecha
+    return fecha >= fecha_actual.replace(day=1)
+
+def desembolso_del_mes(gasto):
+    """Monto que un gasto aporta a los desembolsos del mes en el resumen de cartera"""
+    if gasto.tipo == 'Préstamos' and es_del_mes_actual(gasto.fecha):
+        return float(gasto.monto)
+    return 0
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Obtener estadísticas del dashboard
-    total_prestamos = Prestamo.query.filter_by(estado='Activo').count()
-    total_clientes = Cliente.query.filter_by(activo=True).count()
-    
-    # Calcular clientes atrasados
+    # Obtener estadísticas del dashboard desde el resumen de cartera
+    resumen = obtener_resumen_cartera()
+    db.session.commit()
+
+    total_prestamos = resumen.prestamos_activos
+    total_clientes = resumen.clientes_activos
+    clientes_atrasados = resumen.clientes_atrasados
+    monto_total_atrasado = float(resumen.monto_atrasado)
+    prestamos_mes = resumen.prestamos_mes
+    pagos_mes = resumen.pagos_mes
+    monto_pagos_mes = float(resumen.monto_pagos_mes)
     fecha_actual = datetime.now().date()
-    cuotas_atrasadas = Cuota.query.filter(
-        Cuota.estado == 'Pendiente',
-        Cuota.fecha_vencimiento < fecha_actual
-    ).all()
-    
-    clientes_atrasados = len(set([cuota.prestamo.cliente_id for cuota in cuotas_atrasadas]))
-    monto_total_atrasado = sum(float(cuota.monto_total) for cuota in cuotas_atrasadas)
-    
+
     # Obtener capital disponible
-    contabilidad = Contabilidad.query.first()
-    capital_disponible = float(contabilidad.capital_disponible) if contabilidad else 0
-    
-    # Préstamos del mes
-    inicio_mes = fecha_actual.replace(day=1)
-    prestamos_mes = Prestamo.query.filter(
-        Prestamo.fecha_creacion >= inicio_mes
-    ).count()
-    
-    # Pagos del mes
-    pagos_mes = Pago.query.filter(
-        Pago.fecha_pago >= inicio_mes
-    ).count()
-    monto_pagos_mes = sum(float(p.monto_pagado) for p in Pago.query.filter(Pago.fecha_pago >= inicio_mes).all())
-    
+    capital_disponible = float(obtener_capital_disponible())
+
+    # Antigüedad de la mora por tramos, del corte diario
+    corte_atrasos = obtener_corte_antiguedad()
+
     # Usuarios activos
     usuarios_activos = Usuario.query.filter_by(activo=True).count()
     
@@ -312,44 +998,325 @@ def dashboard():
                          clientes_recientes=clientes_recientes,
                          prestamos_recientes=prestamos_recientes,
                          pagos_recientes=pagos_recientes,
-                         proximos_vencimientos=proximos_vencimientos)
+                         proximos_vencimientos=proximos_vencimientos,
+                         tramos_atraso=corte_atrasos.tramos(),
+                         fecha_corte_atrasos=corte_atrasos.fecha,
+                         fecha_actual=fecha_actual)
+
+# Difusión en tiempo real de mensajes del chat
+class DifusorChat:
+    """Reparte los mensajes nuevos entre las conexiones SSE abiertas en este proceso,
+    con un máximo de `max_conexiones` abiertas a la vez (0 = sin límite)"""
+    
+    def __init__(self, max_conexiones=0):
+        self.max_conexiones = max_conexiones
+        self._lock = threading.Lock()
+        self._suscriptores = {}  # usuario_id -> set de colas
+        self._conexiones = 0
+    
+    def suscribir(self, usuario_id):
+        """Cola para los mensajes del usuario, o None si ya hay max_conexiones abiertas"""
+        cola = queue.Queue(maxsize=100)
+        with self._lock:
+            if self.max_conexiones and self._conexiones >= self.max_conexiones:
+                return None
+            self._suscriptores.setdefault(usuario_id, set()).add(cola)
+            self._conexiones += 1
+        return cola
+    
+    def desuscribir(self, usuario_id, cola):
+        """Quita la cola (se puede llamar más de una vez)"""
+        with self._lock:
+            colas = self._suscriptores.get(usuario_id)
+            if colas and cola in colas:
+                colas.discard(cola)
+                self._conexiones -= 1
+                if not colas:
+                    del self._suscriptores[usuario_id]
+    
+    def publicar(self, usuario_id, evento):
+        with self._lock:
+            colas = list(self._suscriptores.get(usuario_id, ()))
+        for cola in colas:
+            try:
+                cola.put_nowait(evento)
+            except queue.Full:
+                # Ya hay avisos sin leer: la próxima consulta del stream incluye este mensaje
+                pass
+
+difusor_chat = DifusorChat(CHAT_SSE_MAX_CONEXIONES)
+
+def serializar_mensaje_chat(mensaje):
+    """Representación JSON de un mensaje para el polling y el stream del chat"""
+    return {
+        'id': mensaje.id,
+        'contenido': mensaje.contenido,
+        'fecha_envio': mensaje.fecha_envio.strftime('%H:%M'),
+        'remitente': {
+            'id': mensaje.remitente.id,
+            'nombre': mensaje.remitente.nombre,
+            'apellidos': mensaje.remitente.apellidos
+        },
+        'conversacion_id': mensaje.conversacion_id
+    }
 
-# Rutas del sistema de chat
-@app.route('/chat')
-@login_required
-def chat():
-    """Página principal del chat - lista de conversaciones"""
-    # Obtener todas las conversaciones del usuario actual
-    conversaciones = Conversacion.query.filter(
+def _mensajes_recibidos(usuario_id):
+    """Consulta de los mensajes que recibe el usuario en sus conversaciones activas"""
+    return Mensaje.query.join(Conversacion, Mensaje.conversacion_id == Conversacion.id).filter(
         db.or_(
-            Conversacion.usuario1_id == current_user.id,
-            Conversacion.usuario2_id == current_user.id
+            Conversacion.usuario1_id == usuario_id,
+            Conversacion.usuario2_id == usuario_id
+        ),
+        Conversacion.activa == True,
+        Mensaje.remitente_id != usuario_id
+    )
+
+def inicio_ventana_confirmacion():
+    """Fecha desde la que un mensaje con id menor al cursor todavía puede estar por aparecer"""
+    return datetime.utcnow() - timedelta(seconds=CHAT_VENTANA_CONFIRMACION_SEGUNDOS)
+
+def mensajes_chat_desde(usuario_id, ultimo_id, limite=100, excluir=()):
+    """Mensajes recibidos por el usuario con id mayor al cursor, en una sola consulta.
+    
+    Incluye también los de la ventana de confirmación con id menor o igual al cursor
+    (confirmados después de otros con id mayor), salvo los ids de `excluir`: quien
+    llama debe descartar los que ya entregó.
+    """
+    recientes = Mensaje.fecha_envio >= inicio_ventana_confirmacion()
+    if excluir:
+        recientes = db.and_(recientes, Mensaje.id.notin_(list(excluir)))
+    mensajes = _mensajes_recibidos(usuario_id).filter(
+        db.or_(Mensaje.id > ultimo_id, recientes)
+    ).options(db.joinedload(Mensaje.remitente)).order_by(Mensaje.id).limit(limite).all()
+    eventos = [serializar_mensaje_chat(m) for m in mensajes]
+    # No retener una conexión del pool mientras el stream espera
+    db.session.close()
+    return eventos
+
+def ids_chat_recientes(usuario_id, hasta_id):
+    """Ids de la ventana de confirmación hasta el cursor: los que ya estaban al conectarse"""
+    return [fila.id for fila in _mensajes_recibidos(usuario_id).filter(
+        Mensaje.id <= hasta_id,
+        Mensaje.fecha_envio >= inicio_ventana_confirmacion()
+    ).with_entities(Mensaje.id)]
+
+def pagina_mensajes_conversacion(conversacion_id, antes=None, limite=None):
+    """Página del historial por keyset sobre (fecha_envio, id), de lo más reciente hacia atrás.
+    
+    Args:
+        conversacion_id (int): Conversación a consultar
+        antes (str): Cursor del mensaje más antiguo ya mostrado (ver cursor_mensaje)
+        limite (int): Cantidad de mensajes por página
+    
+    Returns:
+        tuple: (mensajes en orden cronológico, True si hay mensajes más antiguos)
+    """
+    limite = limite or CHAT_MENSAJES_POR_PAGINA
+    consulta = Mensaje.query.filter(Mensaje.conversacion_id == conversacion_id)
+    if antes:
+        fecha_envio, mensaje_id = leer_cursor(antes)
+        consulta = consulta.filter(db.or_(
+            Mensaje.fecha_envio < fecha_envio,
+            db.and_(Mensaje.fecha_envio == fecha_envio, Mensaje.id < mensaje_id)
+        ))
+    
+    # Se pide uno de más para saber si quedan mensajes anteriores sin contar
+    mensajes = consulta.order_by(Mensaje.fecha_envio.desc(), Mensaje.id.desc()).limit(limite + 1).all()
+    hay_mas = len(mensajes) > limite
+    mensajes = mensajes[:limite]
+    mensajes.reverse()
+    return mensajes, hay_mas
+
+def crear_cursor(fecha, registro_id):
+    """Cursor opaco para paginar por keyset sobre (fecha, id)"""
+    return f"{fecha.isoformat()}_{registro_id}"
+
+def leer_cursor(cursor):
+    """Devuelve (fecha, id) de un cursor; ValueError si no es válido"""
+    fecha, registro_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(fecha), int(registro_id)
+
+def cursor_mensaje(mensaje):
+    """Cursor opaco para paginar a partir de un mensaje"""
+    return crear_cursor(mensaje.fecha_envio, mensaje.id)
+
+def obtener_o_crear_conversacion(usuario_id, otro_usuario_id):
+    """Devuelve la conversación activa entre dos usuarios o la crea.
+    
+    La búsqueda es una sola consulta al índice único del par canónico. Si dos
+    peticiones la crean a la vez, el índice rechaza la segunda inserción y esa
+    petición usa la conversación que guardó la primera. Se confirma de inmediato,
+    así que debe llamarse antes de otros cambios en la sesión.
+    """
+    usuario_menor_id, usuario_mayor_id = sorted((int(usuario_id), int(otro_usuario_id)))
+    filtro = dict(usuario_menor_id=usuario_menor_id,
+                  usuario_mayor_id=usuario_mayor_id,
+                  par_abierto=True)
+    
+    conversacion = Conversacion.query.filter_by(**filtro).first()
+    if conversacion:
+        return conversacion
+    
+    try:
+        conversacion = Conversacion(
+            usuario1_id=usuario_id,
+            usuario2_id=otro_usuario_id
+        )
+        db.session.add(conversacion)
+        db.session.commit()
+    except IntegrityError:
+        # Otra petición creó la conversación al mismo tiempo
+        db.session.rollback()
+        conversacion = Conversacion.query.filter_by(**filtro).one()
+    
+    return conversacion
+
+def listar_conversaciones_chat(usuario_id):
+    """Conversaciones activas del usuario con el otro participante, el último mensaje
+    y los no leídos, resueltos en una sola consulta.
+    
+    Returns:
+        list: dicts con 'conversacion', 'otro_usuario', 'ultimo_mensaje' y 'no_leidos'
+    """
+    # Los contadores de no leídos deben existir para que el join los encuentre
+    asegurar_contadores_chat(usuario_id)
+    
+    otro_usuario = db.aliased(Usuario)
+    ultimo_mensaje = db.aliased(Mensaje)
+    
+    # Último mensaje por conversación (usa el índice conversacion_id, fecha_envio, id)
+    ultimo_mensaje_id = db.select(Mensaje.id).where(
+        Mensaje.conversacion_id == Conversacion.id
+    ).order_by(Mensaje.fecha_envio.desc(), Mensaje.id.desc()).limit(1).correlate(Conversacion).scalar_subquery()
+    
+    filas = db.session.query(
+        Conversacion, otro_usuario, ultimo_mensaje, ChatNoLeidosConversacion.no_leidos
+    ).join(
+        otro_usuario,
+        otro_usuario.id == db.case(
+            (Conversacion.usuario1_id == usuario_id, Conversacion.usuario2_id),
+            else_=Conversacion.usuario1_id
+        )
+    ).outerjoin(
+        ultimo_mensaje, ultimo_mensaje.id == ultimo_mensaje_id
+    ).outerjoin(
+        ChatNoLeidosConversacion,
+        db.and_(
+            ChatNoLeidosConversacion.conversacion_id == Conversacion.id,
+            ChatNoLeidosConversacion.usuario_id == usuario_id
+        )
+    ).filter(
+        db.or_(
+            Conversacion.usuario1_id == usuario_id,
+            Conversacion.usuario2_id == usuario_id
         ),
         Conversacion.activa == True
+    ).order_by(
+        db.func.coalesce(ultimo_mensaje.fecha_envio, Conversacion.fecha_creacion).desc()
     ).all()
     
+    return [{
+        'conversacion': conversacion,
+        'otro_usuario': otro,
+        'ultimo_mensaje': mensaje,
+        'no_leidos': no_leidos or 0
+    } for conversacion, otro, mensaje, no_leidos in filas]
+
+def formatear_evento_sse(evento, cursor=None):
+    """Evento SSE; el id es el cursor para reanudar (el mayor id entregado hasta ahora)"""
+    return f"id: {cursor or evento['id']}\nevent: mensaje\ndata: {json.dumps(evento)}\n\n"
+
+# Contadores de mensajes no leídos
+def asegurar_contadores_chat(usuario_id):
+    """Obtiene el contador del usuario; la primera vez lo calcula desde los mensajes existentes.
+
+    Returns:
+        tuple: (ChatNoLeidosUsuario, True si se acaba de crear)
+    """
+    contador = db.session.get(ChatNoLeidosUsuario, usuario_id)
+    if contador:
+        return contador, False
+    
+    filas = db.session.query(Mensaje.conversacion_id, db.func.count(Mensaje.id)).join(
+        Conversacion, Mensaje.conversacion_id == Conversacion.id
+    ).filter(
+        db.or_(
+            Conversacion.usuario1_id == usuario_id,
+            Conversacion.usuario2_id == usuario_id
+        ),
+        Conversacion.activa == True,
+        Mensaje.remitente_id != usuario_id,
+        Mensaje.leido == False
+    ).group_by(Mensaje.conversacion_id).all()
+    
+    try:
+        with db.session.begin_nested():
+            for conversacion_id, no_leidos in filas:
+                db.session.add(ChatNoLeidosConversacion(conversacion_id=conversacion_id,
+                                                        usuario_id=usuario_id,
+                                                        no_leidos=no_leidos))
+            contador = ChatNoLeidosUsuario(usuario_id=usuario_id, total=sum(n for _, n in filas))
+            db.session.add(contador)
+    except IntegrityError:
+        # Otra petición hizo el cálculo inicial al mismo tiempo; la lectura con
+        # bloqueo ve su fila confirmada
+        contador = db.session.get(ChatNoLeidosUsuario, usuario_id, with_for_update=True)
+        return contador, False
+    return contador, True
+
+def _ajustar_no_leidos(usuario_id, conversacion_id, delta):
+    """Suma delta a los contadores de conversación y de usuario con UPDATE atómicos"""
+    actualizadas = ChatNoLeidosConversacion.query.filter_by(
+        conversacion_id=conversacion_id, usuario_id=usuario_id
+    ).update({ChatNoLeidosConversacion.no_leidos: ChatNoLeidosConversacion.no_leidos + delta},
+             synchronize_session=False)
+    if not actualizadas:
+        try:
+            with db.session.begin_nested():
+                db.session.add(ChatNoLeidosConversacion(conversacion_id=conversacion_id,
+                                                        usuario_id=usuario_id,
+                                                        no_leidos=delta))
+        except IntegrityError:
+            # Otra petición creó la fila al mismo tiempo: sumar sobre ella
+            ChatNoLeidosConversacion.query.filter_by(
+                conversacion_id=conversacion_id, usuario_id=usuario_id
+            ).update({ChatNoLeidosConversacion.no_leidos: ChatNoLeidosConversacion.no_leidos + delta},
+                     synchronize_session=False)
+    ChatNoLeidosUsuario.query.filter_by(usuario_id=usuario_id).update(
+        {ChatNoLeidosUsuario.total: ChatNoLeidosUsuario.total + delta},
+        synchronize_session=False)
+
+def registrar_mensaje_no_leido(usuario_id, conversacion_id):
+    """Cuenta un mensaje nuevo para el destinatario (llamar antes de guardar el mensaje)"""
+    asegurar_contadores_chat(usuario_id)
+    _ajustar_no_leidos(usuario_id, conversacion_id, 1)
+
+def descontar_no_leidos_conversacion(usuario_id, conversacion_id):
+    """Pone a cero los no leídos de una conversación y los descuenta del total del usuario"""
+    _, recien_creado = asegurar_contadores_chat(usuario_id)
+    if recien_creado:
+        # El cálculo inicial se hizo después de marcar los mensajes como leídos
+        return
+    no_leidos = db.session.query(ChatNoLeidosConversacion.no_leidos).filter_by(
+        conversacion_id=conversacion_id, usuario_id=usuario_id
+    ).scalar()
+    if no_leidos:
+        _ajustar_no_leidos(usuario_id, conversacion_id, -no_leidos)
+
+# Rutas del sistema de chat
+@app.route('/chat')
+@login_required
+def chat():
+    """Página principal del chat - lista de conversaciones"""
     # Obtener todos los usuarios para iniciar nuevas conversaciones
     usuarios = Usuario.query.filter(
         Usuario.id != current_user.id,
         Usuario.activo == True
     ).all()
     
-    # Preparar datos de conversaciones con información del otro usuario
-    conversaciones_data = []
-    for conv in conversaciones:
-        if conv.usuario1_id == current_user.id:
-            otro_usuario = conv.usuario2
-        else:
-            otro_usuario = conv.usuario1
-        
-        # Obtener último mensaje
-        ultimo_mensaje = conv.mensajes.order_by(Mensaje.fecha_envio.desc()).first()
-        
-        conversaciones_data.append({
-            'conversacion': conv,
-            'otro_usuario': otro_usuario,
-            'ultimo_mensaje': ultimo_mensaje
-        })
+    # Conversaciones con el otro usuario, último mensaje y no leídos
+    conversaciones_data = listar_conversaciones_chat(current_user.id)
+    db.session.commit()
     
     return render_template('chat.html', 
                          conversaciones=conversaciones_data,
@@ -363,72 +1330,71 @@ def chat_usuario(usuario_id):
     otro_usuario = Usuario.query.filter_by(id=usuario_id, activo=True).first_or_404()
     
     # Buscar conversación existente o crear una nueva
-    conversacion = Conversacion.query.filter(
-        db.or_(
-            db.and_(Conversacion.usuario1_id == current_user.id, Conversacion.usuario2_id == usuario_id),
-            db.and_(Conversacion.usuario1_id == usuario_id, Conversacion.usuario2_id == current_user.id)
-        ),
-        Conversacion.activa == True
-    ).first()
-    
-    if not conversacion:
-        # Crear nueva conversación
-        conversacion = Conversacion(
-            usuario1_id=current_user.id,
-            usuario2_id=usuario_id
-        )
-        db.session.add(conversacion)
-        db.session.commit()
-    
-    # Obtener mensajes de la conversación
-    mensajes = conversacion.mensajes.order_by(Mensaje.fecha_envio.asc()).all()
+    conversacion = obtener_o_crear_conversacion(current_user.id, usuario_id)
     
-    # Marcar mensajes como leídos
-    for mensaje in mensajes:
-        if mensaje.remitente_id != current_user.id and not mensaje.leido:
-            mensaje.leido = True
+    # Marcar mensajes como leídos con un solo UPDATE
+    Mensaje.query.filter(
+        Mensaje.conversacion_id == conversacion.id,
+        Mensaje.remitente_id != current_user.id,
+        Mensaje.leido == False
+    ).update({Mensaje.leido: True}, synchronize_session=False)
+    descontar_no_leidos_conversacion(current_user.id, conversacion.id)
     
     db.session.commit()
     
+    # Obtener los mensajes más recientes (los anteriores se cargan bajo demanda)
+    mensajes, hay_mas_mensajes = pagina_mensajes_conversacion(conversacion.id)
+    
     # Obtener lista de usuarios para el sidebar
     usuarios = Usuario.query.filter(
         Usuario.id != current_user.id,
         Usuario.activo == True
     ).all()
     
-    # Obtener todas las conversaciones del usuario actual para el sidebar
-    conversaciones = Conversacion.query.filter(
-        db.or_(
-            Conversacion.usuario1_id == current_user.id,
-            Conversacion.usuario2_id == current_user.id
-        ),
-        Conversacion.activa == True
-    ).all()
-    
-    # Preparar datos de conversaciones con información del otro usuario
-    conversaciones_data = []
-    for conv in conversaciones:
-        if conv.usuario1_id == current_user.id:
-            otro_usuario = conv.usuario2
-        else:
-            otro_usuario = conv.usuario1
-        
-        # Obtener último mensaje
-        ultimo_mensaje = conv.mensajes.order_by(Mensaje.fecha_envio.desc()).first()
-        
-        conversaciones_data.append({
-            'conversacion': conv,
-            'otro_usuario': otro_usuario,
-            'ultimo_mensaje': ultimo_mensaje
-        })
+    # Conversaciones del usuario actual para el sidebar
+    conversaciones_data = listar_conversaciones_chat(current_user.id)
     
     return render_template('chat_usuario.html',
                          conversacion=conversacion,
                          conversaciones=conversaciones_data,
                          destinatario=otro_usuario,
                          mensajes=mensajes,
+                         hay_mas_mensajes=hay_mas_mensajes,
+                         cursor_anterior=cursor_mensaje(mensajes[0]) if mensajes else None,
                          usuarios=usuarios)
 
+@app.route('/api/chat/conversacion/<int:conversacion_id>/mensajes')
+@login_required
+def mensajes_anteriores(conversacion_id):
+    """API para cargar mensajes anteriores de una conversación (paginación por cursor)"""
+    conversacion = Conversacion.query.filter(
+        db.or_(
+            Conversacion.usuario1_id == current_user.id,
+            Conversacion.usuario2_id == current_user.id
+        ),
+        Conversacion.id == conversacion_id
+    ).first_or_404()
+    
+    try:
+        antes = request.args.get('antes')
+        limite = min(request.args.get('limite', CHAT_MENSAJES_POR_PAGINA, type=int), 200)
+        try:
+            mensajes, hay_mas = pagina_mensajes_conversacion(conversacion.id, antes, limite)
+        except ValueError:
+            return jsonify({'error': 'Cursor inválido'}), 400
+        
+        return jsonify({
+            'success': True,
+            'mensajes': [dict(serializar_mensaje_chat(m),
+                              propio=m.remitente_id == current_user.id,
+                              leido=m.leido) for m in mensajes],
+            'cursor': cursor_mensaje(mensajes[0]) if mensajes else None,
+            'hay_mas': hay_mas
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/chat/enviar-mensaje', methods=['POST'])
 @login_required
 def enviar_mensaje():
@@ -442,21 +1408,10 @@ def enviar_mensaje():
             return jsonify({'error': 'Datos incompletos'}), 400
         
         # Buscar o crear conversación
-        conversacion = Conversacion.query.filter(
-            db.or_(
-                db.and_(Conversacion.usuario1_id == current_user.id, Conversacion.usuario2_id == destinatario_id),
-                db.and_(Conversacion.usuario1_id == destinatario_id, Conversacion.usuario2_id == current_user.id)
-            ),
-            Conversacion.activa == True
-        ).first()
+        conversacion = obtener_o_crear_conversacion(current_user.id, destinatario_id)
         
-        if not conversacion:
-            conversacion = Conversacion(
-                usuario1_id=current_user.id,
-                usuario2_id=destinatario_id
-            )
-            db.session.add(conversacion)
-            db.session.commit()
+        # Contar el mensaje como no leído para el destinatario
+        registrar_mensaje_no_leido(int(destinatario_id), conversacion.id)
         
         # Crear mensaje
         mensaje = Mensaje(
@@ -467,6 +1422,9 @@ def enviar_mensaje():
         db.session.add(mensaje)
         db.session.commit()
         
+        # Notificar al destinatario por el stream de chat
+        difusor_chat.publicar(int(destinatario_id), serializar_mensaje_chat(mensaje))
+        
         return jsonify({
             'success': True,
             'mensaje_id': mensaje.id,
@@ -484,7 +1442,23 @@ def enviar_mensaje():
 @app.route('/api/chat/mensajes-nuevos')
 @login_required
 def mensajes_nuevos():
-    """API para obtener mensajes nuevos (para actualización en tiempo real)"""
+    """API para obtener mensajes nuevos (para actualización en tiempo real)
+
+    Con ?desde=<id> devuelve los mensajes recibidos después de ese id (lo que usa la
+    página cuando no hay cupo para el stream), más los de la ventana de confirmación
+    que la página puede haber recibido ya (los descarta por id); con ?desde= vacío,
+    solo el cursor actual y en `recientes` los ids de esa ventana que ya existían.
+    """
+    if 'desde' in request.args:
+        desde = request.args.get('desde', type=int)
+        if desde is None:
+            ultimo_id = db.session.query(db.func.max(Mensaje.id)).scalar() or 0
+            return jsonify({'success': True, 'mensajes': [], 'ultimo_id': ultimo_id,
+                            'recientes': ids_chat_recientes(current_user.id, ultimo_id)})
+        mensajes = mensajes_chat_desde(current_user.id, desde)
+        return jsonify({'success': True, 'mensajes': mensajes,
+                        'ultimo_id': max([desde] + [mensaje['id'] for mensaje in mensajes])})
+    
     try:
         # Obtener conversaciones del usuario
         conversaciones = Conversacion.query.filter(
@@ -504,47 +1478,105 @@ def mensajes_nuevos():
             ).all()
             
             for mensaje in mensajes:
-                mensajes_nuevos.append({
-                    'id': mensaje.id,
-                    'contenido': mensaje.contenido,
-                    'fecha_envio': mensaje.fecha_envio.strftime('%H:%M'),
-                    'remitente': {
-                        'id': mensaje.remitente.id,
-                        'nombre': mensaje.remitente.nombre,
-                        'apellidos': mensaje.remitente.apellidos
-                    },
-                    'conversacion_id': conv.id
-                })
+                mensajes_nuevos.append(serializar_mensaje_chat(mensaje))
         
         return jsonify(mensajes_nuevos)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chat/stream')
+@login_required
+def chat_stream():
+    """Stream SSE con los mensajes nuevos del usuario (reanuda desde Last-Event-ID)"""
+    usuario_id = current_user.id
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('ultimo_id')
+    ya_mostrados = ()
+    try:
+        cursor = int(cursor)
+    except (TypeError, ValueError):
+        # Primera conexión: solo interesan los mensajes que lleguen a partir de ahora
+        cursor = db.session.query(db.func.max(Mensaje.id)).scalar() or 0
+        ya_mostrados = ids_chat_recientes(usuario_id, cursor)
+    
+    # Suscribirse antes de ponerse al día para no perder mensajes entre ambos pasos
+    cola = difusor_chat.suscribir(usuario_id)
+    db.session.close()
+    if cola is None:
+        # Sin hilos libres para otro stream: el navegador no reintenta un 503 y la página
+        # pasa a consultar /api/chat/mensajes-nuevos
+        respuesta = jsonify({'success': False, 'error': 'Demasiadas conexiones de chat abiertas'})
+        respuesta.status_code = 503
+        respuesta.headers['Retry-After'] = '60'
+        return respuesta
+    
+    def eventos():
+        ultimo_id = cursor
+        # id -> momento en que se entregó, mientras pueda volver a salir en la ventana
+        entregados = dict.fromkeys(ya_mostrados, time.monotonic())
+        fin = time.monotonic() + CHAT_SSE_DURACION_SEGUNDOS
+        por_consulta = 100
+        try:
+            yield 'retry: 3000\n\n'
+            if ya_mostrados:
+                # Para que la página los descarte si se reenvían al reconectar
+                yield f"event: recientes\ndata: {json.dumps(ya_mostrados)}\n\n"
+            consultar = True
+            while True:
+                # La cola solo avisa que hay mensajes: se confirman en otro orden que el de
+                # sus ids, así que se leen de la base desde el cursor más la ventana de
+                # confirmación sin los ya entregados, página tras página para no saltarse
+                # un atraso de más de una página
+                while consultar:
+                    vencidos = time.monotonic() - CHAT_VENTANA_CONFIRMACION_SEGUNDOS
+                    entregados = {id_: momento for id_, momento in entregados.items() if momento >= vencidos}
+                    pendientes = mensajes_chat_desde(usuario_id, ultimo_id, limite=por_consulta,
+                                                     excluir=entregados)
+                    for evento in pendientes:
+                        entregados[evento['id']] = time.monotonic()
+                        ultimo_id = max(ultimo_id, evento['id'])
+                        yield formatear_evento_sse(evento, ultimo_id)
+                    consultar = len(pendientes) == por_consulta
+                
+                restante = fin - time.monotonic()
+                if restante <= 0:
+                    # Cerrar para liberar el worker; el navegador reconecta con Last-Event-ID
+                    break
+                try:
+                    cola.get(timeout=min(CHAT_SSE_LATIDO_SEGUNDOS, restante))
+                except queue.Empty:
+                    yield ': latido\n\n'
+                    consultar = CHAT_SSE_MULTINODO
+                    continue
+                # Una consulta cubre todos los avisos acumulados
+                while not cola.empty():
+                    cola.get_nowait()
+                consultar = True
+        finally:
+            difusor_chat.desuscribir(usuario_id, cola)
+    
+    respuesta = Response(stream_with_context(eventos()),
+                         mimetype='text/event-stream',
+                         headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Libera el cupo aunque el stream se cierre antes de empezar a recorrerse
+    respuesta.call_on_close(lambda: difusor_chat.desuscribir(usuario_id, cola))
+    return respuesta
+
 @app.route('/api/chat/count-no-leidos')
 @login_required
 def count_mensajes_no_leidos():
     """API para obtener el conteo de mensajes no leídos"""
     try:
-        # Obtener conversaciones del usuario
-        conversaciones = Conversacion.query.filter(
-            db.or_(
-                Conversacion.usuario1_id == current_user.id,
-                Conversacion.usuario2_id == current_user.id
-            ),
-            Conversacion.activa == True
-        ).all()
-        
-        total_no_leidos = 0
-        for conv in conversaciones:
-            # Contar mensajes no leídos
-            count = conv.mensajes.filter(
-                Mensaje.remitente_id != current_user.id,
-                Mensaje.leido == False
-            ).count()
-            total_no_leidos += count
+        contador, recien_creado = asegurar_contadores_chat(current_user.id)
+        if recien_creado:
+            db.session.commit()
+        total_no_leidos = contador.total
         
-        return jsonify({'count': total_no_leidos})
+        # Permitir GET condicional: si el conteo no cambió se responde 304 sin cuerpo
+        response = jsonify({'count': total_no_leidos})
+        response.set_etag(f'chat-{current_user.id}-{total_no_leidos}')
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -564,8 +1596,13 @@ def cerrar_conversacion(conversacion_id):
             Conversacion.activa == True
         ).first_or_404()
         
-        # Marcar la conversación como inactiva
+        # Marcar la conversación como inactiva y liberar el par para una nueva
         conversacion.activa = False
+        conversacion.par_abierto = None
+        
+        # Sus mensajes no leídos dejan de contar en el badge de ambos participantes
+        for usuario_id in (conversacion.usuario1_id, conversacion.usuario2_id):
+            descontar_no_leidos_conversacion(usuario_id, conversacion.id)
         
         # Opcional: eliminar físicamente la conversación y todos los mensajes
         # db.session.delete(conversacion)  # Esto eliminaría todo
@@ -580,12 +1617,156 @@ def cerrar_conversacion(conversacion_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Totales de los listados: {(ruta, filtros): (total, vence)}
+_conteos_listados = {}
+_conteos_listados_lock = threading.Lock()
+
+def contar_listado(consulta, clave):
+    """Total de registros de un listado, reutilizado durante LISTADOS_CONTEO_CACHE_SEGUNDOS.
+    
+    Es una cifra aproximada: los registros creados mientras tanto se ven al vencer.
+    """
+    ahora = time.monotonic()
+    with _conteos_listados_lock:
+        guardado = _conteos_listados.get(clave)
+    if guardado and guardado[1] > ahora:
+        return guardado[0]
+    
+    total = consulta.order_by(None).count()
+    with _conteos_listados_lock:
+        if len(_conteos_listados) > 1000:
+            for vieja in [c for c, (_, vence) in _conteos_listados.items() if vence <= ahora]:
+                del _conteos_listados[vieja]
+        _conteos_listados[clave] = (total, ahora + LISTADOS_CONTEO_CACHE_SEGUNDOS)
+    return total
+
+class PaginaCursor:
+    """Página de un listado paginado por cursor, con los datos que usan las plantillas"""
+    es_cursor = True
+    
+    def __init__(self, items, total, per_page, url_primera, url_anterior=None, url_siguiente=None):
+        self.items = items
+        self.total = total
+        self.per_page = per_page
+        self.url_primera = url_primera
+        self.url_anterior = url_anterior
+        self.url_siguiente = url_siguiente
+    
+    @property
+    def has_prev(self):
+        return self.url_anterior is not None
+    
+    @property
+    def has_next(self):
+        return self.url_siguiente is not None
+    
+    @property
+    def pages(self):
+        return max(1, -(-self.total // self.per_page))
+
+def paginar_listado(consulta, columna_fecha, columna_id, per_page=20):
+    """Pagina la consulta de un listado (más recientes primero).
+    
+    Por defecto usa paginate() con números de página. En modo cursor
+    (?paginacion=cursor o LISTADOS_PAGINACION_CURSOR) busca por keyset sobre
+    (columna_fecha, columna_id) con los parámetros despues/antes, así que cualquier
+    página cuesta lo mismo que la primera, y el total sale de contar_listado().
+    En modo cursor el orden es siempre por fecha, sin la relevancia de la búsqueda.
+    """
+    modo = request.args.get('paginacion') or ('cursor' if LISTADOS_PAGINACION_CURSOR else 'numerada')
+    if modo != 'cursor':
+        page = request.args.get('page', 1, type=int)
+        return consulta.paginate(page=page, per_page=per_page, error_out=False)
+    
+    parametros = {k: v for k, v in request.args.items() if k not in ('page', 'despues', 'antes')}
+    parametros['paginacion'] = 'cursor'
+    total = contar_listado(consulta, (request.endpoint, tuple(sorted(parametros.items()))))
+    
+    def url_con(**cursor):
+        return url_for(request.endpoint, **parametros, **cursor)
+    
+    def cursor_de(registro):
+        return crear_cursor(getattr(registro, columna_fecha.key), registro.id)
+    
+    try:
+        despues = leer_cursor(request.args['despues']) if request.args.get('despues') else None
+        antes = leer_cursor(request.args['antes']) if request.args.get('antes') else None
+    except ValueError:
+        # Cursor dañado: volver a la primera página
+        despues = antes = None
+    
+    consulta = consulta.order_by(None)
+    if antes:
+        fecha, registro_id = antes
+        filas = consulta.filter(db.or_(
+            columna_fecha > fecha,
+            db.and_(columna_fecha == fecha, columna_id > registro_id)
+        )).order_by(columna_fecha.asc(), columna_id.asc()).limit(per_page + 1).all()
+        hay_anteriores = len(filas) > per_page
+        items = list(reversed(filas[:per_page]))
+        hay_siguientes = True
+    else:
+        if despues:
+            fecha, registro_id = despues
+            consulta = consulta.filter(db.or_(
+                columna_fecha < fecha,
+                db.and_(columna_fecha == fecha, columna_id < registro_id)
+            ))
+        filas = consulta.order_by(columna_fecha.desc(), columna_id.desc()).limit(per_page + 1).all()
+        hay_siguientes = len(filas) > per_page
+        items = filas[:per_page]
+        hay_anteriores = despues is not None
+    
+    return PaginaCursor(
+        items, total, per_page,
+        url_primera=url_con(),
+        url_anterior=url_con(antes=cursor_de(items[0])) if items and hay_anteriores else None,
+        url_siguiente=url_con(despues=cursor_de(items[-1])) if items and hay_siguientes else None
+    )
+
+def _termino_empieza_con(prefijo):
+    """Condición de prefijo sobre TerminoCliente.termino que aprovecha el índice.
+    
+    Los términos solo tienen [0-9a-z], así que no hace falta escapar comodines.
+    SQLite no usa índices con LIKE (no distingue mayúsculas); GLOB sí.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return TerminoCliente.termino.op('GLOB')(prefijo + '*')
+    return TerminoCliente.termino.like(prefijo + '%')
+
+def filtrar_busqueda_clientes(consulta, texto):
+    """Filtra una consulta que ya incluye Cliente por lo que escribió el usuario.
+    
+    Cada palabra debe coincidir con el inicio de alguna palabra del nombre, apellidos
+    o apodo, sin importar acentos ni mayúsculas; si el texto trae números también
+    se busca como inicio del documento. Los resultados se ordenan por relevancia:
+    documento exacto primero y luego más palabras completas coincidentes.
+    """
+    palabras, documento = terminos_busqueda(texto)
+    if not palabras and not documento:
+        return consulta
+    
+    def clientes_con(*condiciones):
+        return Cliente.id.in_(db.select(TerminoCliente.cliente_id).where(*condiciones))
+    
+    coincide = db.and_(*[clientes_con(_termino_empieza_con(p)) for p in palabras]) if palabras else db.false()
+    if documento:
+        coincide = db.or_(coincide, clientes_con(TerminoCliente.es_documento == True,
+                                                 _termino_empieza_con(documento)))
+    
+    exactos = palabras + ([documento] if documento else [])
+    relevancia = db.select(
+        db.func.sum(db.case((TerminoCliente.es_documento == True, 10), else_=1))
+    ).where(
+        TerminoCliente.cliente_id == Cliente.id,
+        TerminoCliente.termino.in_(exactos)
+    ).correlate(Cliente).scalar_subquery()
+    
+    return consulta.filter(coincide).order_by(db.func.coalesce(relevancia, 0).desc())
+
 @app.route('/clientes')
 @login_required
 def clientes():
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    
     # Obtener parámetros de búsqueda
     query = request.args.get('q', '')
     provincia = request.args.get('provincia', '')
@@ -596,13 +1777,7 @@ def clientes():
     
     # Aplicar filtros si existen
     if query:
-        clientes_query = clientes_query.filter(
-            db.or_(
-                Cliente.nombre.contains(query),
-                Cliente.apellidos.contains(query),
-                Cliente.documento.contains(query)
-            )
-        )
+        clientes_query = filtrar_busqueda_clientes(clientes_query, query)
     
     if provincia:
         clientes_query = clientes_query.filter_by(provincia=provincia)
@@ -617,8 +1792,7 @@ def clientes():
     clientes_query = clientes_query.order_by(Cliente.fecha_creacion.desc())
     
     # Paginar resultados
-    clientes = clientes_query.paginate(
-        page=page, per_page=per_page, error_out=False)
+    clientes = paginar_listado(clientes_query, Cliente.fecha_creacion, Cliente.id)
     
     provincias = obtener_provincias()
     return render_template('clientes.html', 
@@ -658,6 +1832,7 @@ def nuevo_cliente():
                 direccion_trabajo=request.form['direccion_trabajo']
             )
             db.session.add(cliente)
+            ajustar_resumen_cartera(clientes_activos=1)
             db.session.commit()
             flash('Cliente registrado exitosamente', 'success')
             return redirect(url_for('clientes'))
@@ -731,7 +1906,9 @@ def eliminar_cliente(cliente_id):
             return redirect(url_for('ver_cliente', cliente_id=cliente.id))
         
         # Marcar como inactivo en lugar de eliminar
-        cliente.activo = False
+        if cliente.activo:
+            cliente.activo = False
+            ajustar_resumen_cartera(clientes_activos=-1)
         db.session.commit()
         flash('Cliente marcado como inactivo exitosamente', 'success')
         return redirect(url_for('clientes'))
@@ -757,13 +1934,7 @@ def buscar_clientes():
     clientes_query = Cliente.query.filter_by(activo=True)
     
     if query:
-        clientes_query = clientes_query.filter(
-            db.or_(
-                Cliente.nombre.contains(query),
-                Cliente.apellidos.contains(query),
-                Cliente.documento.contains(query)
-            )
-        )
+        clientes_query = filtrar_busqueda_clientes(clientes_query, query)
     
     if provincia:
         clientes_query = clientes_query.filter_by(provincia=provincia)
@@ -774,9 +1945,7 @@ def buscar_clientes():
         elif estado == 'sin_prestamos':
             clientes_query = clientes_query.outerjoin(Prestamo).filter(Prestamo.id.is_(None))
     
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    clientes = clientes_query.paginate(page=page, per_page=per_page, error_out=False)
+    clientes = paginar_listado(clientes_query, Cliente.fecha_creacion, Cliente.id)
     
     provincias = obtener_provincias()
     return render_template('clientes.html', clientes=clientes, query=query, provincia=provincia, estado=estado, provincias=provincias)
@@ -791,8 +1960,7 @@ def obtener_municipios_provincia(provincia):
 @app.route('/prestamos')
 @login_required
 def prestamos():
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
+    sincronizar_atrasos_prestamos()
     
     # Obtener parámetros de búsqueda
     query = request.args.get('q', '')
@@ -804,13 +1972,7 @@ def prestamos():
     
     # Aplicar filtros si existen
     if query:
-        prestamos_query = prestamos_query.join(Cliente).filter(
-            db.or_(
-                Cliente.nombre.contains(query),
-                Cliente.apellidos.contains(query),
-                Cliente.documento.contains(query)
-            )
-        )
+        prestamos_query = filtrar_busqueda_clientes(prestamos_query.join(Cliente), query)
     
     if estado:
         prestamos_query = prestamos_query.filter_by(estado=estado)
@@ -822,8 +1984,7 @@ def prestamos():
     prestamos_query = prestamos_query.order_by(Prestamo.fecha_creacion.desc())
     
     # Paginar resultados
-    prestamos = prestamos_query.paginate(
-        page=page, per_page=per_page, error_out=False)
+    prestamos = paginar_listado(prestamos_query, Prestamo.fecha_creacion, Prestamo.id)
     
     return render_template('prestamos.html', 
                          prestamos=prestamos, 
@@ -866,14 +2027,9 @@ def nuevo_prestamo():
             
             # Registrar la transacción en contabilidad (préstamo = salida de capital)
             monto_prestamo = float(request.form['monto'])
-            contabilidad = Contabilidad.query.first()
-            if not contabilidad:
-                contabilidad = Contabilidad(capital_disponible=0)
-                db.session.add(contabilidad)
-            
-            # Reducir el capital disponible por el monto del préstamo
-            contabilidad.capital_disponible = float(contabilidad.capital_disponible) - monto_prestamo
-            contabilidad.fecha_actualizacion = datetime.utcnow()
+            registrar_movimiento_capital(-monto_prestamo, 'Préstamo',
+                                         f"Préstamo aprobado - Cliente ID: {prestamo.cliente_id}",
+                                         prestamo_id=prestamo.id)
             
             # Registrar como gasto en contabilidad
             gasto_prestamo = Gasto(
@@ -884,6 +2040,11 @@ def nuevo_prestamo():
             )
             db.session.add(gasto_prestamo)
             
+            # Actualizar resumen de cartera del dashboard
+            ajustar_resumen_cartera(prestamos_activos=1, prestamos_mes=1, monto_prestamos_mes=monto_prestamo)
+            if prestamo.fecha_primera_cuota < datetime.now().date():
+                refrescar_atrasos_resumen()
+            
             db.session.commit()
             
             flash('Préstamo registrado exitosamente', 'success')
@@ -892,8 +2053,9 @@ def nuevo_prestamo():
             db.session.rollback()
             flash(f'Error al registrar préstamo: {str(e)}', 'error')
     
-    clientes = Cliente.query.filter_by(activo=True).all()
-    return render_template('nuevo_prestamo.html', clientes=clientes)
+    # Cliente preseleccionado al llegar desde su ficha (?cliente_id=)
+    cliente = Cliente.query.filter_by(id=request.args.get('cliente_id', type=int), activo=True).first()
+    return render_template('nuevo_prestamo.html', cliente=cliente)
 
 @app.route('/prestamos/<int:prestamo_id>/editar', methods=['GET', 'POST'])
 @login_required
@@ -929,8 +2091,7 @@ def editar_prestamo(prestamo_id):
             db.session.rollback()
             flash(f'Error al actualizar préstamo: {str(e)}', 'error')
     
-    clientes = Cliente.query.filter_by(activo=True).all()
-    return render_template('editar_prestamo.html', prestamo=prestamo, clientes=clientes)
+    return render_template('editar_prestamo.html', prestamo=prestamo)
 
 @app.route('/prestamos/<int:prestamo_id>/contrato')
 @login_required
@@ -1190,32 +2351,24 @@ def generar_pdf_desde_html(html_content):
 @login_required
 def ver_prestamo(prestamo_id):
     try:
+        sincronizar_atrasos_prestamos()
         prestamo = Prestamo.query.get_or_404(prestamo_id)
         cuotas = Cuota.query.filter_by(prestamo_id=prestamo_id).order_by(Cuota.numero_cuota).all()
         pagos = Pago.query.join(Cuota).filter(Cuota.prestamo_id == prestamo_id).all()
         
-        # Calcular estadísticas del préstamo
-        total_cuotas = len(cuotas)
-        cuotas_pagadas = len([c for c in cuotas if c.estado == 'Pagada'])
-        cuotas_pendientes = len([c for c in cuotas if c.estado == 'Pendiente'])
-        cuotas_atrasadas = len([c for c in cuotas if c.estado == 'Pendiente' and c.fecha_vencimiento < datetime.now().date()])
-        
-        # Calcular montos
-        monto_total_prestamo = sum(float(c.monto_total) for c in cuotas)
-        monto_pagado = sum(float(c.monto_total) for c in cuotas if c.estado == 'Pagada')
-        monto_pendiente = sum(float(c.monto_total) for c in cuotas if c.estado == 'Pendiente')
-        
+        # Estadísticas desde los saldos guardados en el préstamo
         return render_template('ver_prestamo.html', 
                              prestamo=prestamo, 
                              cuotas=cuotas, 
                              pagos=pagos,
-                             total_cuotas=total_cuotas,
-                             cuotas_pagadas=cuotas_pagadas,
-                             cuotas_pendientes=cuotas_pendientes,
-                             cuotas_atrasadas=cuotas_atrasadas,
-                             monto_total_prestamo=monto_total_prestamo,
-                             monto_pagado=monto_pagado,
-                             monto_pendiente=monto_pendiente)
+                             total_cuotas=prestamo.total_cuotas,
+                             cuotas_pagadas=prestamo.cuotas_pagadas,
+                             cuotas_pendientes=prestamo.cuotas_pendientes,
+                             cuotas_atrasadas=prestamo.cuotas_atrasadas,
+                             monto_total_prestamo=float(prestamo.monto_cuotas),
+                             monto_pagado=prestamo.monto_cobrado,
+                             monto_pendiente=prestamo.monto_pendiente,
+                             today=datetime.now().date())
     except Exception as e:
         flash(f'Error al cargar préstamo: {str(e)}', 'error')
         return redirect(url_for('prestamos'))
@@ -1227,25 +2380,15 @@ def imprimir_prestamo(prestamo_id):
         prestamo = Prestamo.query.get_or_404(prestamo_id)
         cuotas = Cuota.query.filter_by(prestamo_id=prestamo_id).order_by(Cuota.numero_cuota).all()
         
-        # Calcular estadísticas del préstamo
-        total_cuotas = len(cuotas)
-        cuotas_pagadas = len([c for c in cuotas if c.estado == 'Pagada'])
-        cuotas_pendientes = len([c for c in cuotas if c.estado == 'Pendiente'])
-        
-        # Calcular montos
-        monto_total_prestamo = sum(float(c.monto_total) for c in cuotas)
-        monto_pagado = sum(float(c.monto_total) for c in cuotas if c.estado == 'Pagada')
-        monto_pendiente = sum(float(c.monto_total) for c in cuotas if c.estado == 'Pendiente')
-        
         return render_template('imprimir_prestamo.html', 
                              prestamo=prestamo, 
                              cuotas=cuotas,
-                             total_cuotas=total_cuotas,
-                             cuotas_pagadas=cuotas_pagadas,
-                             cuotas_pendientes=cuotas_pendientes,
-                             monto_total_prestamo=monto_total_prestamo,
-                             monto_pagado=monto_pagado,
-                             monto_pendiente=monto_pendiente)
+                             total_cuotas=prestamo.total_cuotas,
+                             cuotas_pagadas=prestamo.cuotas_pagadas,
+                             cuotas_pendientes=prestamo.cuotas_pendientes,
+                             monto_total_prestamo=float(prestamo.monto_cuotas),
+                             monto_pagado=prestamo.monto_cobrado,
+                             monto_pendiente=prestamo.monto_pendiente)
     except Exception as e:
         flash(f'Error al generar documento: {str(e)}', 'error')
         return redirect(url_for('ver_prestamo', prestamo_id=prestamo_id))
@@ -1257,17 +2400,10 @@ def descargar_prestamo_pdf(prestamo_id):
         prestamo = Prestamo.query.get_or_404(prestamo_id)
         cuotas = Cuota.query.filter_by(prestamo_id=prestamo_id).order_by(Cuota.numero_cuota).all()
         
-        # Calcular estadísticas del préstamo
-        total_cuotas = len(cuotas)
-        cuotas_pagadas = len([c for c in cuotas if c.estado == 'Pagada'])
-        cuotas_pendientes = len([c for c in cuotas if c.estado == 'Pendiente'])
-        monto_total_prestamo = sum(float(c.monto_total) for c in cuotas)
-        monto_pagado = sum(float(c.monto_total) for c in cuotas if c.estado == 'Pagada')
-        monto_pendiente = sum(float(c.monto_total) for c in cuotas if c.estado == 'Pendiente')
-        
         # Generar PDF
-        pdf_buffer = generar_pdf_prestamo(prestamo, cuotas, total_cuotas, cuotas_pagadas, 
-                                        cuotas_pendientes, monto_total_prestamo, monto_pagado, monto_pendiente)
+        pdf_buffer = generar_pdf_prestamo(prestamo, cuotas, prestamo.total_cuotas, prestamo.cuotas_pagadas, 
+                                        prestamo.cuotas_pendientes, float(prestamo.monto_cuotas),
+                                        prestamo.monto_cobrado, prestamo.monto_pendiente)
         
         # Enviar archivo para descarga
         pdf_buffer.seek(0)
@@ -1301,8 +2437,15 @@ def eliminar_prestamo(prestamo_id):
             return redirect(url_for('ver_prestamo', prestamo_id=prestamo.id))
         
         # Eliminar cuotas pendientes
+        era_activo = prestamo.estado == 'Activo'
+        del_mes = es_del_mes_actual(prestamo.fecha_creacion)
         Cuota.query.filter_by(prestamo_id=prestamo_id).delete()
         db.session.delete(prestamo)
+        
+        # Actualizar resumen de cartera del dashboard
+        ajustar_resumen_cartera(prestamos_activos=-1 if era_activo else 0,
+                                prestamos_mes=-1 if del_mes else 0)
+        refrescar_atrasos_resumen()
         db.session.commit()
         
         flash('Préstamo eliminado exitosamente', 'success')
@@ -1319,7 +2462,9 @@ def cambiar_estado_prestamo(prestamo_id):
     nuevo_estado = request.form.get('estado')
     
     if nuevo_estado in ['Activo', 'Pausado', 'Cancelado', 'Finalizado']:
+        delta_activos = int(nuevo_estado == 'Activo') - int(prestamo.estado == 'Activo')
         prestamo.estado = nuevo_estado
+        ajustar_resumen_cartera(prestamos_activos=delta_activos)
         db.session.commit()
         flash(f'Estado del préstamo cambiado a {nuevo_estado}', 'success')
     else:
@@ -1330,6 +2475,7 @@ def cambiar_estado_prestamo(prestamo_id):
 @app.route('/prestamos/buscar')
 @login_required
 def buscar_prestamos():
+    sincronizar_atrasos_prestamos()
     query = request.args.get('q', '')
     estado = request.args.get('estado', '')
     cliente_id = request.args.get('cliente_id', '')
@@ -1337,13 +2483,7 @@ def buscar_prestamos():
     prestamos_query = Prestamo.query
     
     if query:
-        prestamos_query = prestamos_query.join(Cliente).filter(
-            db.or_(
-                Cliente.nombre.contains(query),
-                Cliente.apellidos.contains(query),
-                Cliente.documento.contains(query)
-            )
-        )
+        prestamos_query = filtrar_busqueda_clientes(prestamos_query.join(Cliente), query)
     
     if estado:
         prestamos_query = prestamos_query.filter_by(estado=estado)
@@ -1351,9 +2491,7 @@ def buscar_prestamos():
     if cliente_id:
         prestamos_query = prestamos_query.filter_by(cliente_id=cliente_id)
     
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    prestamos = prestamos_query.paginate(page=page, per_page=per_page, error_out=False)
+    prestamos = paginar_listado(prestamos_query, Prestamo.fecha_creacion, Prestamo.id)
     
     return render_template('prestamos.html', prestamos=prestamos, query=query, estado=estado, cliente_id=cliente_id)
 
@@ -1362,179 +2500,219 @@ def generar_cuotas(prestamo):
     # Eliminar cuotas existentes si las hay
     Cuota.query.filter_by(prestamo_id=prestamo.id).delete()
     
-    # Calcular tasa mensual directa (no anual dividido por 12)
-    tasa_mensual = float(prestamo.tasa_interes) / 100
-    
-    # Fecha inicial para las cuotas
-    fecha_actual = prestamo.fecha_primera_cuota
-    
-    # Convertir monto a float para cálculos
-    monto_prestamo = float(prestamo.monto)
-    
-    # Calcular monto de cuota según frecuencia
-    if prestamo.frecuencia == 'Mensual':
-        # Cálculo exacto: capital fijo + interés mensual sobre monto inicial
-        monto_capital_mensual = monto_prestamo / prestamo.plazo_meses
-        interes_mensual = monto_prestamo * tasa_mensual
-        
-        for i in range(prestamo.plazo_meses):
-            # Ajustar la última cuota para evitar decimales
-            if i == prestamo.plazo_meses - 1:
-                monto_capital = monto_prestamo - (monto_capital_mensual * (prestamo.plazo_meses - 1))
-            else:
-                monto_capital = monto_capital_mensual
-            
-            monto_total = monto_capital + interes_mensual
-            saldo_restante = monto_prestamo - (monto_capital_mensual * (i + 1))
-            
-            cuota = Cuota(
-                prestamo_id=prestamo.id,
-                numero_cuota=i + 1,
-                fecha_vencimiento=fecha_actual,
-                monto_capital=monto_capital,
-                monto_interes=interes_mensual,
-                monto_total=monto_total,
-                saldo_restante=max(0, saldo_restante)
-            )
-            db.session.add(cuota)
-            
-            fecha_actual = fecha_actual.replace(day=min(fecha_actual.day, 28)) + timedelta(days=28)
-            fecha_actual = fecha_actual.replace(day=min(fecha_actual.day, 28))
-            
-    elif prestamo.frecuencia == 'Bullet':
-        # NO se pagan intereses mensualmente, solo al final
-        interes_total = monto_prestamo * tasa_mensual * prestamo.plazo_meses
-        
-        for i in range(prestamo.plazo_meses):
-            if i == prestamo.plazo_meses - 1:
-                # Última cuota: capital completo + intereses acumulados
-                monto_capital = monto_prestamo
-                monto_interes = interes_total
-                monto_total = monto_capital + monto_interes
-                saldo_restante = 0
-            else:
-                # Cuotas intermedias: NO se paga nada
-                monto_capital = 0
-                monto_interes = 0
-                monto_total = 0
-                saldo_restante = monto_prestamo
-            
-            cuota = Cuota(
-                prestamo_id=prestamo.id,
-                numero_cuota=i + 1,
-                fecha_vencimiento=fecha_actual,
-                monto_capital=monto_capital,
-                monto_interes=monto_interes,
-                monto_total=monto_total,
-                saldo_restante=saldo_restante
-            )
-            db.session.add(cuota)
-            
-            fecha_actual = fecha_actual.replace(day=min(fecha_actual.day, 28)) + timedelta(days=28)
-            fecha_actual = fecha_actual.replace(day=min(fecha_actual.day, 28))
-            
-    elif prestamo.frecuencia == 'SoloInteresesSinFecha':
-        # Solo intereses mensuales sobre monto inicial
-        interes_mensual = monto_prestamo * tasa_mensual
-        
-        for i in range(prestamo.plazo_meses):
-            cuota = Cuota(
-                prestamo_id=prestamo.id,
-                numero_cuota=i + 1,
-                fecha_vencimiento=fecha_actual,
-                monto_capital=0,
-                monto_interes=interes_mensual,
-                monto_total=interes_mensual,
-                saldo_restante=monto_prestamo
-            )
-            db.session.add(cuota)
-            
-            fecha_actual = fecha_actual.replace(day=min(fecha_actual.day, 28)) + timedelta(days=28)
-            fecha_actual = fecha_actual.replace(day=min(fecha_actual.day, 28))
-            
-    elif prestamo.frecuencia == 'Quincenal':
-        # Cálculo quincenal con tasa mensual directa
-        plazo_quincenas = prestamo.plazo_meses * 2
-        tasa_quincenal = tasa_mensual / 2  # Mitad de la tasa mensual
-        
-        monto_capital_quincenal = monto_prestamo / plazo_quincenas
-        interes_quincenal = monto_prestamo * tasa_quincenal
-        
-        for i in range(plazo_quincenas):
-            if i == plazo_quincenas - 1:
-                monto_capital = monto_prestamo - (monto_capital_quincenal * (plazo_quincenas - 1))
-            else:
-                monto_capital = monto_capital_quincenal
-            
-            monto_total = monto_capital + interes_quincenal
-            saldo_restante = monto_prestamo - (monto_capital_quincenal * (i + 1))
-            
-            cuota = Cuota(
-                prestamo_id=prestamo.id,
-                numero_cuota=i + 1,
-                fecha_vencimiento=fecha_actual,
-                monto_capital=monto_capital,
-                monto_interes=interes_quincenal,
-                monto_total=monto_total,
-                saldo_restante=max(0, saldo_restante)
-            )
-            db.session.add(cuota)
-            
-            saldo_restante -= monto_capital
-            fecha_actual += timedelta(days=15)
-            
-    elif prestamo.frecuencia == 'Semanal':
-        # Cálculo semanal con tasa mensual directa
-        plazo_semanas = prestamo.plazo_meses * 4
-        tasa_semanal = tasa_mensual / 4  # Cuarta parte de la tasa mensual
-        
-        monto_capital_semanal = monto_prestamo / plazo_semanas
-        interes_semanal = monto_prestamo * tasa_semanal
-        
-        for i in range(plazo_semanas):
-            if i == plazo_semanas - 1:
-                monto_capital = monto_prestamo - (monto_capital_semanal * (plazo_semanas - 1))
-            else:
-                monto_capital = monto_capital_semanal
-            
-            monto_total = monto_capital + interes_semanal
-            saldo_restante = monto_prestamo - (monto_capital_semanal * (i + 1))
-            
-            cuota = Cuota(
-                prestamo_id=prestamo.id,
-                numero_cuota=i + 1,
-                fecha_vencimiento=fecha_actual,
-                monto_capital=monto_capital,
-                monto_interes=interes_semanal,
-                monto_total=monto_total,
-                saldo_restante=max(0, saldo_restante)
-            )
-            db.session.add(cuota)
-            
-            saldo_restante -= monto_capital
-            fecha_actual += timedelta(days=7)
+    # Calcular la tabla (ver amortizacion.py) y guardarla con un solo INSERT por lotes
+    filas = calcular_cuotas(prestamo.monto, prestamo.tasa_interes, prestamo.plazo_meses,
+                            prestamo.frecuencia, prestamo.fecha_primera_cuota)
+    if filas:
+        db.session.execute(db.insert(Cuota), [dict(fila, prestamo_id=prestamo.id) for fila in filas])
     
+    actualizar_saldos_prestamo(prestamo)
+    db.session.commit()
+
+# Saldos mantenidos en el préstamo
+CAMPOS_SALDOS_PRESTAMO = ('total_cuotas', 'cuotas_pagadas', 'cuotas_pendientes', 'cuotas_atrasadas',
+                          'monto_cuotas', 'capital_pendiente', 'interes_pendiente', 'fecha_ultimo_pago')
+
+def _condicion_cuota_atrasada(fecha_actual):
+    """Misma regla que cuota_esta_atrasada, como expresión SQL"""
+    return db.and_(Cuota.estado == 'Pendiente', Cuota.fecha_vencimiento < fecha_actual)
+
+def calcular_saldos_prestamos(*filtros, fecha_actual=None):
+    """Saldos de los préstamos calculados desde sus cuotas y pagos, con dos consultas agrupadas.
+
+    Args:
+        *filtros: Condiciones sobre Cuota (por ejemplo Cuota.prestamo_id == 5)
+        fecha_actual (date, opcional): Día para contar las cuotas atrasadas
+
+    Returns:
+        dict: {prestamo_id: {campo: valor}} con los CAMPOS_SALDOS_PRESTAMO; los préstamos
+        sin cuotas no aparecen
+    """
+    fecha_actual = fecha_actual or datetime.now().date()
+    pagado, capital_pendiente, interes_pendiente = _saldo_cuotas_pendientes(*filtros)
+    es_pendiente = Cuota.estado.in_(['Pendiente', 'Parcial'])
+
+    def contar(condicion):
+        return db.func.coalesce(db.func.sum(db.case((condicion, 1), else_=0)), 0)
+
+    def sumar(condicion, columna):
+        return db.func.coalesce(db.func.sum(db.case((condicion, columna), else_=0)), 0)
+
+    filas = db.session.query(
+        Cuota.prestamo_id,
+        db.func.count(Cuota.id),
+        contar(Cuota.estado == 'Pagada'),
+        contar(es_pendiente),
+        contar(_condicion_cuota_atrasada(fecha_actual)),
+        db.func.coalesce(db.func.sum(Cuota.monto_total), 0),
+        sumar(es_pendiente, capital_pendiente),
+        sumar(es_pendiente, interes_pendiente)
+    ).outerjoin(pagado, pagado.c.cuota_id == Cuota.id).filter(*filtros).group_by(Cuota.prestamo_id).all()
+
+    ultimos_pagos = dict(db.session.query(
+        Cuota.prestamo_id, db.func.max(Pago.fecha_pago)
+    ).join(Pago, Pago.cuota_id == Cuota.id).filter(*filtros).group_by(Cuota.prestamo_id).all())
+
+    saldos = {}
+    for prestamo_id, total, pagadas, pendientes, atrasadas, monto_cuotas, capital, interes in filas:
+        saldos[prestamo_id] = {
+            'total_cuotas': int(total),
+            'cuotas_pagadas': int(pagadas),
+            'cuotas_pendientes': int(pendientes),
+            'cuotas_atrasadas': int(atrasadas),
+            'monto_cuotas': round(float(monto_cuotas), 2),
+            'capital_pendiente': round(float(capital), 2),
+            'interes_pendiente': round(float(interes), 2),
+            'fecha_ultimo_pago': ultimos_pagos.get(prestamo_id)
+        }
+    return saldos
+
+def saldos_prestamo_sin_cuotas():
+    """Saldos de un préstamo que no tiene cuotas"""
+    return dict({campo: 0 for campo in CAMPOS_SALDOS_PRESTAMO}, fecha_ultimo_pago=None)
+
+def actualizar_saldos_prestamo(prestamo):
+    """Recalcula los saldos guardados en el préstamo dentro de la transacción actual.
+
+    Se llama desde todo lo que cambia cuotas o pagos (alta y edición del préstamo,
+    pagos, edición y eliminación de pagos y cuotas). No confirma la transacción.
+    """
+    db.session.flush()
+    fecha_actual = datetime.now().date()
+    saldos = calcular_saldos_prestamos(Cuota.prestamo_id == prestamo.id, fecha_actual=fecha_actual)
+    for campo, valor in saldos.get(prestamo.id, saldos_prestamo_sin_cuotas()).items():
+        setattr(prestamo, campo, valor)
+    prestamo.fecha_corte_atrasos = fecha_actual
+
+def recalcular_saldos_prestamos(prestamo_ids):
+    """Recalcula y guarda los saldos de varios préstamos con un UPDATE por lotes (no confirma)"""
+    fecha_actual = datetime.now().date()
+    saldos = calcular_saldos_prestamos(Cuota.prestamo_id.in_(prestamo_ids), fecha_actual=fecha_actual)
+    filas = [dict(saldos.get(prestamo_id, saldos_prestamo_sin_cuotas()), id=prestamo_id,
+                  fecha_corte_atrasos=fecha_actual) for prestamo_id in prestamo_ids]
+    if filas:
+        db.session.execute(db.update(Prestamo), filas)
+    return saldos
+
+# Día en que este proceso ya actualizó las cuotas atrasadas de todos los préstamos
+_atrasos_prestamos_sincronizados = None
+
+def sincronizar_atrasos_prestamos():
+    """Recuenta las cuotas atrasadas de los préstamos contados otro día (un UPDATE, una vez al día).
+
+    Las cuotas pasan a estar atrasadas con el paso del tiempo, sin que nada las modifique.
+    """
+    global _atrasos_prestamos_sincronizados
+    fecha_actual = datetime.now().date()
+    if _atrasos_prestamos_sincronizados == fecha_actual:
+        return
+
+    atrasadas = db.select(db.func.count(Cuota.id)).where(
+        Cuota.prestamo_id == Prestamo.id,
+        _condicion_cuota_atrasada(fecha_actual)
+    ).scalar_subquery()
+    Prestamo.query.filter(db.or_(
+        Prestamo.fecha_corte_atrasos.is_(None),
+        Prestamo.fecha_corte_atrasos < fecha_actual
+    )).update({
+        Prestamo.cuotas_atrasadas: atrasadas,
+        Prestamo.fecha_corte_atrasos: fecha_actual
+    }, synchronize_session=False)
     db.session.commit()
+    _atrasos_prestamos_sincronizados = fecha_actual
 
 def recalcular_cuotas_prestamo(prestamo_id):
-    """Recalcula todas las cuotas de un préstamo"""
+    """Reamortiza las cuotas pendientes de un préstamo después de un abono al capital.
+    
+    Las cuotas pagadas, parciales o con pagos registrados no se tocan. El capital
+    pendiente (monto del préstamo, ya reducido por los abonos, menos el capital
+    cobrado en pagos normales de cuotas), sin lo que aún deben las cuotas parciales
+    o con pagos que se conservan, se reparte entre las cuotas pendientes que quedan,
+    conservando sus números y fechas, y solo se actualizan las que cambian. Si ya
+    no queda capital para ellas, esas cuotas se eliminan.
+    No confirma la transacción: lo hace quien la llama.
+    
+    Returns:
+        float: Capital pendiente después del recálculo
+    """
     prestamo = Prestamo.query.get_or_404(prestamo_id)
     
-    # Eliminar cuotas existentes
-    Cuota.query.filter_by(prestamo_id=prestamo_id).delete()
-    
-    # Generar nuevas cuotas
-    generar_cuotas(prestamo)
-    
-    flash('Cuotas recalculadas exitosamente', 'success')
-    return True
+    cuotas_con_pagos = db.select(Pago.cuota_id).where(Pago.cuota_id.isnot(None))
+    pendientes = Cuota.query.filter(
+        Cuota.prestamo_id == prestamo.id,
+        Cuota.estado == 'Pendiente',
+        Cuota.id.notin_(cuotas_con_pagos)
+    ).order_by(Cuota.numero_cuota).all()
+    
+    capital_cobrado = db.session.query(db.func.coalesce(db.func.sum(Pago.monto_capital), 0)).join(
+        Cuota, Pago.cuota_id == Cuota.id
+    ).filter(
+        Cuota.prestamo_id == prestamo.id,
+        Pago.tipo_pago.notin_(['Extraordinario', 'AbonoCapital'])
+    ).scalar()
+    capital_pendiente = round(float(prestamo.monto) - float(capital_cobrado), 2)
+    
+    # Capital que todavía deben las cuotas conservadas sin saldar (parciales o con
+    # pagos registrados): sigue cobrándose en ellas y no se reparte otra vez
+    cobrado_por_cuota = db.select(
+        Pago.cuota_id, db.func.sum(Pago.monto_capital).label('capital')
+    ).where(
+        Pago.tipo_pago.notin_(['Extraordinario', 'AbonoCapital'])
+    ).group_by(Pago.cuota_id).subquery()
+    restante_cuota = Cuota.monto_capital - db.func.coalesce(cobrado_por_cuota.c.capital, 0)
+    capital_conservado = db.session.query(db.func.coalesce(db.func.sum(
+        db.case((restante_cuota > 0, restante_cuota), else_=0)), 0)
+    ).select_from(Cuota).outerjoin(
+        cobrado_por_cuota, cobrado_por_cuota.c.cuota_id == Cuota.id
+    ).filter(
+        Cuota.prestamo_id == prestamo.id,
+        Cuota.estado != 'Pagada',
+        Cuota.id.notin_([c.id for c in pendientes])
+    ).scalar()
+    capital_a_repartir = round(capital_pendiente - float(capital_conservado), 2)
+    
+    if capital_a_repartir <= 0:
+        if pendientes:
+            Cuota.query.filter(Cuota.id.in_([c.id for c in pendientes])).delete(synchronize_session=False)
+        return max(capital_pendiente, 0.0)
+    
+    nuevos_montos = calcular_cuotas_restantes(capital_a_repartir, prestamo.monto, prestamo.tasa_interes,
+                                              prestamo.plazo_meses, prestamo.frecuencia, len(pendientes))
+    
+    # Solo las cuotas cuyo monto cambia (comparado a centavos, como se guardan)
+    cambios = []
+    for cuota, montos in zip(pendientes, nuevos_montos):
+        montos = {campo: round(valor, 2) for campo, valor in montos.items()}
+        if any(round(float(getattr(cuota, campo)), 2) != valor for campo, valor in montos.items()):
+            cambios.append(dict(montos, id=cuota.id))
+    if cambios:
+        db.session.execute(db.update(Cuota), cambios)
+    
+    return capital_pendiente
+
+# Registro de pagos sin duplicados
+LARGO_CLAVE_IDEMPOTENCIA = 64
+
+def nueva_clave_idempotencia():
+    """Clave para el campo oculto de los formularios de pago (una por formulario mostrado)"""
+    return uuid.uuid4().hex
+
+def clave_idempotencia_solicitud():
+    """Clave enviada en el campo clave_idempotencia o en el encabezado Idempotency-Key (None si no hay)"""
+    clave = (request.form.get('clave_idempotencia') or request.headers.get('Idempotency-Key') or '').strip()
+    if len(clave) > LARGO_CLAVE_IDEMPOTENCIA:
+        raise ValueError(f'La clave de idempotencia no puede tener más de {LARGO_CLAVE_IDEMPOTENCIA} caracteres')
+    return clave or None
+
+def pago_ya_registrado(clave):
+    """Pago registrado antes con la misma clave (búsqueda por el índice único), o None"""
+    if not clave:
+        return None
+    return Pago.query.filter_by(clave_idempotencia=clave).first()
 
 @app.route('/pagos')
 @login_required
 def pagos():
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    
     # Obtener parámetros de búsqueda
     query = request.args.get('q', '')
     tipo = request.args.get('tipo', '')
@@ -1546,13 +2724,7 @@ def pagos():
     
     # Aplicar filtros si existen
     if query:
-        pagos_query = pagos_query.join(Cuota).join(Prestamo).join(Cliente).filter(
-            db.or_(
-                Cliente.nombre.contains(query),
-                Cliente.apellidos.contains(query),
-                Cliente.documento.contains(query)
-            )
-        )
+        pagos_query = filtrar_busqueda_clientes(pagos_query.join(Cuota).join(Prestamo).join(Cliente), query)
     
     if tipo:
         pagos_query = pagos_query.filter_by(tipo_pago=tipo)
@@ -1567,8 +2739,7 @@ def pagos():
     pagos_query = pagos_query.order_by(Pago.fecha_pago.desc())
     
     # Paginar resultados
-    pagos = pagos_query.paginate(
-        page=page, per_page=per_page, error_out=False)
+    pagos = paginar_listado(pagos_query, Pago.fecha_pago, Pago.id)
     
     return render_template('pagos.html', 
                          pagos=pagos, 
@@ -1581,7 +2752,14 @@ def pagos():
 @login_required
 def nuevo_pago():
     if request.method == 'POST':
+        clave = None
         try:
+            # Un reenvío del mismo formulario devuelve el pago ya registrado
+            clave = clave_idempotencia_solicitud()
+            if pago_ya_registrado(clave):
+                flash('Este pago ya había sido registrado', 'info')
+                return redirect(url_for('pagos'))
+            
             cuota_id = request.form['cuota_id']
             cuota = Cuota.query.get_or_404(cuota_id)
             prestamo = cuota.prestamo
@@ -1604,10 +2782,13 @@ def nuevo_pago():
                 monto_capital=monto_capital,
                 monto_interes=monto_interes,
                 tipo_pago=tipo_pago,
-                usuario_id=current_user.id
+                usuario_id=current_user.id,
+                clave_idempotencia=clave
             )
             
             # Actualizar estado de la cuota
+            estaba_atrasada = cuota_esta_atrasada(cuota)
+            estado_prestamo_anterior = prestamo.estado
             if monto_capital >= float(cuota.monto_capital) and monto_interes >= float(cuota.monto_interes):
                 cuota.estado = 'Pagada'
             elif monto_capital > 0 or monto_interes > 0:
@@ -1616,16 +2797,6 @@ def nuevo_pago():
             # Actualizar saldo restante de la cuota
             cuota.saldo_restante = max(0, float(cuota.saldo_restante) - monto_capital)
             
-            # Actualizar contabilidad automáticamente
-            contabilidad = Contabilidad.query.first()
-            if not contabilidad:
-                contabilidad = Contabilidad(capital_disponible=0)
-                db.session.add(contabilidad)
-            
-            # Registrar como ingreso en contabilidad
-            contabilidad.capital_disponible = float(contabilidad.capital_disponible) + monto_pagado
-            contabilidad.fecha_actualizacion = datetime.utcnow()
-            
             # Registrar la transacción en contabilidad
             descripcion_pago = f"Pago de cuota - Cliente ID: {prestamo.cliente_id}"
             if tipo_pago == 'Extraordinario':
@@ -1650,25 +2821,46 @@ def nuevo_pago():
                 if prestamo.monto <= 0:
                     prestamo.estado = 'Pagado'
                     flash('¡Préstamo pagado completamente!', 'success')
+                elif recalcular_cuotas_prestamo(prestamo.id) <= 0:
+                    # Reamortizar las cuotas pendientes; sin capital pendiente queda saldado
+                    prestamo.estado = 'Pagado'
+                    flash('¡Préstamo pagado completamente!', 'success')
                 else:
-                    # Recalcular cuotas con el nuevo monto
-                    recalcular_cuotas_prestamo(prestamo.id)
+                    flash('Cuotas recalculadas exitosamente', 'success')
             
             db.session.add(pago)
+            actualizar_saldos_prestamo(prestamo)
+            
+            # Registrar como ingreso de capital
+            registrar_movimiento_capital(monto_pagado, 'Pago', descripcion_pago,
+                                         prestamo_id=prestamo.id, pago_id=pago.id)
+            
+            # Actualizar resumen de cartera del dashboard
+            if tipo_pago in ['Extraordinario', 'AbonoCapital']:
+                refrescar_atrasos_resumen()
+            else:
+                actualizar_atraso_cuota_resumen(cuota, estaba_atrasada)
+            prestamo_liquidado = estado_prestamo_anterior == 'Activo' and prestamo.estado == 'Pagado'
+            ajustar_resumen_cartera(pagos_mes=1, monto_pagos_mes=monto_pagado,
+                                    prestamos_activos=-1 if prestamo_liquidado else 0)
+            
             db.session.commit()
             
             flash('Pago registrado exitosamente', 'success')
             return redirect(url_for('pagos'))
             
+        except IntegrityError as e:
+            # Otra solicitud con la misma clave se confirmó primero
+            db.session.rollback()
+            if pago_ya_registrado(clave):
+                flash('Este pago ya había sido registrado', 'info')
+                return redirect(url_for('pagos'))
+            flash(f'Error al registrar pago: {str(e)}', 'error')
         except Exception as e:
             db.session.rollback()
             flash(f'Error al registrar pago: {str(e)}', 'error')
     
-    # Obtener clientes para el formulario
-    clientes = Cliente.query.filter_by(activo=True).all()
-    
-    return render_template('nuevo_pago.html', 
-                         clientes=clientes)
+    return render_template('nuevo_pago.html', clave_idempotencia=nueva_clave_idempotencia())
 
 @app.route('/pagos/<int:pago_id>')
 @login_required
@@ -1695,12 +2887,20 @@ def ver_pago(pago_id):
 def pago_extraordinario():
     """Permite realizar pagos extraordinarios o abonos al capital sin estar asociados a una cuota específica"""
     if request.method == 'POST':
+        clave = None
         try:
+            # Un reenvío del mismo formulario devuelve el pago ya registrado
+            clave = clave_idempotencia_solicitud()
+            if pago_ya_registrado(clave):
+                flash('Este pago ya había sido registrado', 'info')
+                return redirect(url_for('pagos'))
+            
             prestamo_id = request.form['prestamo_id']
             prestamo = Prestamo.query.get_or_404(prestamo_id)
             
             monto_pagado = float(request.form['monto_pagado'])
             tipo_pago = request.form['tipo_pago']
+            estado_prestamo_anterior = prestamo.estado
             
             # Crear un pago extraordinario
             pago = Pago(
@@ -1709,34 +2909,50 @@ def pago_extraordinario():
                 monto_capital=monto_pagado if tipo_pago == 'AbonoCapital' else 0,
                 monto_interes=monto_pagado if tipo_pago == 'SoloIntereses' else 0,
                 tipo_pago=tipo_pago,
-                usuario_id=current_user.id
+                usuario_id=current_user.id,
+                clave_idempotencia=clave
             )
             
-            # Actualizar contabilidad
-            contabilidad = Contabilidad.query.first()
-            if not contabilidad:
-                contabilidad = Contabilidad(capital_disponible=0)
-                db.session.add(contabilidad)
-            
-            contabilidad.capital_disponible = float(contabilidad.capital_disponible) + monto_pagado
-            contabilidad.fecha_actualizacion = datetime.utcnow()
-            
             # Si es abono al capital, actualizar el préstamo
             if tipo_pago == 'AbonoCapital':
                 prestamo.monto = float(prestamo.monto) - monto_pagado
                 if prestamo.monto <= 0:
                     prestamo.estado = 'Pagado'
                     flash('¡Préstamo pagado completamente!', 'success')
+                elif recalcular_cuotas_prestamo(prestamo.id) <= 0:
+                    # Reamortizar las cuotas pendientes; sin capital pendiente queda saldado
+                    prestamo.estado = 'Pagado'
+                    flash('¡Préstamo pagado completamente!', 'success')
                 else:
-                    # Recalcular cuotas con el nuevo monto
-                    recalcular_cuotas_prestamo(prestamo.id)
+                    flash('Cuotas recalculadas exitosamente', 'success')
             
             db.session.add(pago)
+            actualizar_saldos_prestamo(prestamo)
+            
+            # Actualizar contabilidad
+            registrar_movimiento_capital(monto_pagado, 'Pago',
+                                         f"Pago extraordinario - Cliente ID: {prestamo.cliente_id}",
+                                         prestamo_id=prestamo.id, pago_id=pago.id)
+            
+            # Actualizar resumen de cartera del dashboard
+            if tipo_pago == 'AbonoCapital':
+                refrescar_atrasos_resumen()
+            prestamo_liquidado = estado_prestamo_anterior == 'Activo' and prestamo.estado == 'Pagado'
+            ajustar_resumen_cartera(pagos_mes=1, monto_pagos_mes=monto_pagado,
+                                    prestamos_activos=-1 if prestamo_liquidado else 0)
+            
             db.session.commit()
             
             flash('Pago extraordinario registrado exitosamente', 'success')
             return redirect(url_for('pagos'))
             
+        except IntegrityError as e:
+            # Otra solicitud con la misma clave se confirmó primero
+            db.session.rollback()
+            if pago_ya_registrado(clave):
+                flash('Este pago ya había sido registrado', 'info')
+                return redirect(url_for('pagos'))
+            flash(f'Error al registrar pago extraordinario: {str(e)}', 'error')
         except Exception as e:
             db.session.rollback()
             flash(f'Error al registrar pago extraordinario: {str(e)}', 'error')
@@ -1744,7 +2960,8 @@ def pago_extraordinario():
     # Obtener préstamos activos
     prestamos = Prestamo.query.filter_by(estado='Activo').join(Cliente).all()
     
-    return render_template('pago_extraordinario.html', prestamos=prestamos)
+    return render_template('pago_extraordinario.html', prestamos=prestamos,
+                           clave_idempotencia=nueva_clave_idempotencia())
 
 @app.route('/pagos/<int:pago_id>/imprimir')
 @login_required
@@ -1801,11 +3018,26 @@ def editar_pago(pago_id):
     pago = Pago.query.get_or_404(pago_id)
     if request.method == 'POST':
         try:
+            monto_pagado_anterior = float(pago.monto_pagado)
+            monto_anterior = monto_pagado_anterior if es_del_mes_actual(pago.fecha_pago) else None
             pago.monto_pagado = request.form['monto_pagado']
             pago.monto_capital = request.form['monto_capital']
             pago.monto_interes = request.form['monto_interes']
             pago.tipo_pago = request.form['tipo_pago']
             pago.fecha_pago = datetime.strptime(request.form['fecha_pago'], '%Y-%m-%d')
+            monto_nuevo = float(pago.monto_pagado) if es_del_mes_actual(pago.fecha_pago) else None
+            
+            # Actualizar acumulados del mes en el resumen de cartera
+            ajustar_resumen_cartera(
+                pagos_mes=(monto_nuevo is not None) - (monto_anterior is not None),
+                monto_pagos_mes=(monto_nuevo or 0) - (monto_anterior or 0)
+            )
+            if pago.cuota:
+                actualizar_saldos_prestamo(pago.cuota.prestamo)
+            
+            # Actualizar contabilidad con la diferencia del monto
+            registrar_movimiento_capital(float(pago.monto_pagado) - monto_pagado_anterior, 'Pago',
+                                         f"Edición del pago #{pago.id}", pago_id=pago.id)
             
             db.session.commit()
             flash('Pago actualizado exitosamente', 'success')
@@ -1829,15 +3061,22 @@ def eliminar_pago(pago_id):
         # Restaurar estado de la cuota
         if pago.cuota:
             cuota = pago.cuota
+            estaba_atrasada = cuota_esta_atrasada(cuota)
             cuota.estado = 'Pendiente'
+            actualizar_atraso_cuota_resumen(cuota, estaba_atrasada)
+        
+        # Actualizar acumulados del mes en el resumen de cartera
+        if es_del_mes_actual(pago.fecha_pago):
+            ajustar_resumen_cartera(pagos_mes=-1, monto_pagos_mes=-float(pago.monto_pagado))
         
         # Actualizar contabilidad
-        contabilidad = Contabilidad.query.first()
-        if contabilidad:
-            contabilidad.capital_disponible = float(contabilidad.capital_disponible) - float(pago.monto_pagado)
-            contabilidad.fecha_actualizacion = datetime.utcnow()
+        registrar_movimiento_capital(-float(pago.monto_pagado), 'Pago',
+                                     f"Eliminación del pago #{pago.id}", pago_id=pago.id)
         
+        cuota = pago.cuota
         db.session.delete(pago)
+        if cuota:
+            actualizar_saldos_prestamo(cuota.prestamo)
         db.session.commit()
         
         flash('Pago eliminado exitosamente', 'success')
@@ -1858,13 +3097,7 @@ def buscar_pagos():
     pagos_query = Pago.query
     
     if query:
-        pagos_query = pagos_query.join(Cuota).join(Prestamo).join(Cliente).filter(
-            db.or_(
-                Cliente.nombre.contains(query),
-                Cliente.apellidos.contains(query),
-                Cliente.documento.contains(query)
-            )
-        )
+        pagos_query = filtrar_busqueda_clientes(pagos_query.join(Cuota).join(Prestamo).join(Cliente), query)
     
     if tipo:
         pagos_query = pagos_query.filter_by(tipo_pago=tipo)
@@ -1875,60 +3108,97 @@ def buscar_pagos():
     if fecha_fin:
         pagos_query = pagos_query.filter(Pago.fecha_pago <= datetime.strptime(fecha_fin, '%Y-%m-%d'))
     
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    pagos = pagos_query.paginate(page=page, per_page=per_page, error_out=False)
+    pagos = paginar_listado(pagos_query, Pago.fecha_pago, Pago.id)
     
     return render_template('pagos.html', pagos=pagos, query=query, tipo=tipo, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin)
 
 @app.route('/atrasados')
 @login_required
 def atrasados():
+    fecha_actual = datetime.now().date()
     try:
-        fecha_actual = datetime.now().date()
-        
-        # Obtener cuotas atrasadas con información del préstamo y cliente
-        cuotas_atrasadas = Cuota.query.filter(
-            Cuota.estado == 'Pendiente',
-            Cuota.fecha_vencimiento < fecha_actual
-        ).join(Prestamo).join(Cliente).all()
-        
-        # Calcular estadísticas
-        clientes_atrasados = set()
-        monto_total_atrasado = 0.0
-        total_dias_atraso = 0
-        
-        for cuota in cuotas_atrasadas:
-            try:
-                dias_atraso = (fecha_actual - cuota.fecha_vencimiento).days
-                # No asignar directamente al objeto, usar una variable temporal
-                clientes_atrasados.add(cuota.prestamo.cliente_id)
-                monto_total_atrasado += float(cuota.monto_total or 0)
-                total_dias_atraso += dias_atraso
-            except Exception as e:
-                print(f"Error procesando cuota {cuota.id}: {e}")
-                continue
-        
-        # Calcular promedios
-        dias_promedio_atraso = total_dias_atraso / len(cuotas_atrasadas) if cuotas_atrasadas else 0
+        # Se lee el corte de antigüedad del día (una fila por préstamo atrasado)
+        corte = obtener_corte_antiguedad()
+        prestamos_atrasados = db.session.query(AntiguedadPrestamo, Prestamo, Cliente).join(
+            Prestamo, AntiguedadPrestamo.prestamo_id == Prestamo.id
+        ).join(
+            Cliente, AntiguedadPrestamo.cliente_id == Cliente.id
+        ).filter(
+            AntiguedadPrestamo.fecha == corte.fecha
+        ).order_by(AntiguedadPrestamo.vencimiento_mas_antiguo).all()
+        
+        dias_promedio_atraso = (sum(antiguedad.dias_atraso for antiguedad, _, _ in prestamos_atrasados)
+                                / len(prestamos_atrasados)) if prestamos_atrasados else 0
         
         return render_template('atrasados.html', 
-                             cuotas_atrasadas=cuotas_atrasadas,
-                             clientes_atrasados=list(clientes_atrasados),
-                             monto_total_atrasado=monto_total_atrasado,
+                             prestamos_atrasados=prestamos_atrasados,
+                             corte=corte,
+                             tramos=corte.tramos(),
+                             cuotas_atrasadas=corte.cuotas_atrasadas,
+                             clientes_atrasados=corte.clientes_atrasados,
+                             monto_total_atrasado=corte.monto_atrasado,
                              dias_promedio_atraso=dias_promedio_atraso,
                              today=fecha_actual)
     
     except Exception as e:
+        db.session.rollback()
         print(f"Error en función atrasados: {e}")
         # En caso de error, pasar valores por defecto
         return render_template('atrasados.html', 
-                             cuotas_atrasadas=[],
-                             clientes_atrasados=[],
+                             prestamos_atrasados=[],
+                             corte=None,
+                             tramos=[],
+                             cuotas_atrasadas=0,
+                             clientes_atrasados=0,
                              monto_total_atrasado=0.0,
                              dias_promedio_atraso=0,
                              today=fecha_actual)
 
+@app.route('/atrasados/actualizar', methods=['POST'])
+@login_required
+def actualizar_corte_atrasados():
+    """Vuelve a generar el corte de antigüedad de hoy con los pagos registrados desde la noche"""
+    try:
+        corte = generar_corte_antiguedad()
+        return jsonify({
+            'success': True,
+            'fecha_corte': corte.fecha.isoformat(),
+            'prestamos_atrasados': corte.prestamos_atrasados,
+            'monto_atrasado': corte.monto_atrasado
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/atrasos/antiguedad')
+@login_required
+def api_antiguedad_atrasos():
+    """Historial diario de la mora por tramos y tasas de traslado entre tramos"""
+    try:
+        dias = min(max(request.args.get('dias', 90, type=int), 1), 730)
+        desde = datetime.now().date() - timedelta(days=dias)
+        # Se leen 30 días más para poder calcular los traslados del primer día pedido
+        cortes = {corte.fecha: corte for corte in CorteAntiguedad.query.filter(
+            CorteAntiguedad.fecha >= desde - timedelta(days=30)
+        ).order_by(CorteAntiguedad.fecha).all()}
+        traslados = calcular_traslados_atraso(cortes)
+        
+        return jsonify({
+            'success': True,
+            'tramos': [{'clave': clave, 'etiqueta': etiqueta} for clave, etiqueta, _, _ in TRAMOS_ATRASO],
+            'cortes': [{
+                'fecha': fecha.isoformat(),
+                'prestamos_atrasados': corte.prestamos_atrasados,
+                'clientes_atrasados': corte.clientes_atrasados,
+                'monto_atrasado': corte.monto_atrasado,
+                'tramos': {tramo['clave']: {'cuotas': tramo['cuotas'], 'monto': tramo['monto']}
+                           for tramo in corte.tramos()},
+                'traslados': traslados[fecha]
+            } for fecha, corte in cortes.items() if fecha >= desde]
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/cuotas/<int:cuota_id>')
 @login_required
 def ver_cuota(cuota_id):
@@ -1947,6 +3217,8 @@ def editar_cuota(cuota_id):
             cuota.monto_interes = request.form['monto_interes']
             cuota.monto_total = request.form['monto_total']
             cuota.estado = request.form['estado']
+            refrescar_atrasos_resumen()
+            actualizar_saldos_prestamo(cuota.prestamo)
             
             db.session.commit()
             flash('Cuota actualizada exitosamente', 'success')
@@ -1990,6 +3262,7 @@ def recalcular_cuota(cuota_id):
         
         cuota.monto_capital = capital
         cuota.monto_interes = interes
+        actualizar_saldos_prestamo(prestamo)
         
         db.session.commit()
         flash('Cuota recalculada exitosamente', 'success')
@@ -2017,13 +3290,11 @@ def cuotas_vencidas():
 @login_required
 def contabilidad():
     # Obtener datos de contabilidad
+    consolidar_capital_si_corresponde()
     contabilidad = Contabilidad.query.first()
     
     # Calcular estadísticas financieras
-    if contabilidad:
-        capital_disponible = float(contabilidad.capital_disponible)
-    else:
-        capital_disponible = 0
+    capital_disponible = float(obtener_capital_disponible())
     
     # Calcular total de ingresos (gastos con monto negativo)
     total_ingresos = db.session.query(db.func.sum(db.func.abs(Gasto.monto))).filter(Gasto.monto < 0).scalar() or 0
@@ -2054,15 +3325,6 @@ def registrar_ingreso():
         categoria = request.form.get('categoria', 'Otros')
         observaciones = request.form.get('observaciones', '')
         
-        # Actualizar capital disponible
-        contabilidad = Contabilidad.query.first()
-        if not contabilidad:
-            contabilidad = Contabilidad(capital_disponible=0)
-            db.session.add(contabilidad)
-        
-        contabilidad.capital_disponible = float(contabilidad.capital_disponible) + monto
-        contabilidad.fecha_actualizacion = datetime.utcnow()
-        
         # Registrar el ingreso como un gasto con monto negativo (para mantener consistencia)
         ingreso = Gasto(
             descripcion=descripcion,
@@ -2072,6 +3334,10 @@ def registrar_ingreso():
         )
         
         db.session.add(ingreso)
+        db.session.flush()
+        
+        # Actualizar capital disponible
+        registrar_movimiento_capital(monto, 'Ingreso', descripcion, gasto_id=ingreso.id)
         db.session.commit()
         
         flash('Ingreso registrado exitosamente', 'success')
@@ -2091,15 +3357,6 @@ def registrar_gasto():
         categoria = request.form.get('categoria', 'General')
         observaciones = request.form.get('observaciones', '')
         
-        # Actualizar capital disponible
-        contabilidad = Contabilidad.query.first()
-        if not contabilidad:
-            contabilidad = Contabilidad(capital_disponible=0)
-            db.session.add(contabilidad)
-        
-        contabilidad.capital_disponible = float(contabilidad.capital_disponible) - monto
-        contabilidad.fecha_actualizacion = datetime.utcnow()
-        
         # Registrar el gasto
         gasto = Gasto(
             descripcion=descripcion,
@@ -2109,6 +3366,11 @@ def registrar_gasto():
         )
         
         db.session.add(gasto)
+        db.session.flush()
+        
+        # Actualizar capital disponible
+        registrar_movimiento_capital(-monto, 'Gasto', descripcion, gasto_id=gasto.id)
+        ajustar_resumen_cartera(monto_prestamos_mes=desembolso_del_mes(gasto))
         db.session.commit()
         
         flash('Gasto registrado exitosamente', 'success')
@@ -2125,21 +3387,18 @@ def editar_gasto(gasto_id):
     gasto = Gasto.query.get_or_404(gasto_id)
     if request.method == 'POST':
         try:
-            monto_anterior = gasto.monto
+            monto_anterior = float(gasto.monto)
+            desembolso_anterior = desembolso_del_mes(gasto)
             gasto.descripcion = request.form['descripcion']
             gasto.monto = float(request.form['monto'])
             gasto.fecha = datetime.strptime(request.form['fecha'], '%Y-%m-%d').date()
             gasto.tipo = request.form['tipo']
             
-            # Actualizar capital disponible
-            contabilidad = Contabilidad.query.first()
-            if contabilidad:
-                if gasto.monto < 0:  # Es un ingreso
-                    contabilidad.capital_disponible = float(contabilidad.capital_disponible) + (gasto.monto - monto_anterior)
-                else:  # Es un gasto
-                    contabilidad.capital_disponible = float(contabilidad.capital_disponible) + (monto_anterior - gasto.monto)
-                contabilidad.fecha_actualizacion = datetime.utcnow()
+            # Actualizar capital disponible (los ingresos se guardan en negativo, así que vale para ambos)
+            registrar_movimiento_capital(monto_anterior - gasto.monto, 'Ajuste',
+                                         f"Edición de la transacción #{gasto.id}", gasto_id=gasto.id)
             
+            ajustar_resumen_cartera(monto_prestamos_mes=desembolso_del_mes(gasto) - desembolso_anterior)
             db.session.commit()
             flash('Gasto actualizado exitosamente', 'success')
             return redirect(url_for('contabilidad'))
@@ -2159,15 +3418,11 @@ def eliminar_gasto(gasto_id):
     
     gasto = Gasto.query.get_or_404(gasto_id)
     try:
-        # Actualizar capital disponible
-        contabilidad = Contabilidad.query.first()
-        if contabilidad:
-            if gasto.monto < 0:  # Es un ingreso
-                contabilidad.capital_disponible = float(contabilidad.capital_disponible) - abs(float(gasto.monto))
-            else:  # Es un gasto
-                contabilidad.capital_disponible = float(contabilidad.capital_disponible) + float(gasto.monto)
-            contabilidad.fecha_actualizacion = datetime.utcnow()
+        # Actualizar capital disponible (revertir el ingreso o el gasto)
+        registrar_movimiento_capital(float(gasto.monto), 'Ajuste',
+                                     f"Eliminación de la transacción #{gasto.id}", gasto_id=gasto.id)
         
+        ajustar_resumen_cartera(monto_prestamos_mes=-desembolso_del_mes(gasto))
         db.session.delete(gasto)
         db.session.commit()
         
@@ -2182,8 +3437,7 @@ def eliminar_gasto(gasto_id):
 @login_required
 def balance_contable():
     # Calcular balance general
-    contabilidad = Contabilidad.query.first()
-    capital_disponible = contabilidad.capital_disponible if contabilidad else 0
+    capital_disponible = obtener_capital_disponible()
     
     # Calcular total de ingresos (gastos con monto negativo)
     total_ingresos = db.session.query(db.func.sum(db.func.abs(Gasto.monto))).filter(Gasto.monto < 0).scalar() or 0
@@ -2204,6 +3458,189 @@ def balance_contable():
                          utilidad_neta=utilidad_neta,
                          transacciones=transacciones)
 
+# Pronóstico de cobros
+# Pronósticos calculados: {(fecha_inicio, fecha_fin, agrupacion, fecha_actual): data}.
+# Se vacían al confirmarse un pago o un cambio en un préstamo (desembolso, edición, eliminación)
+_pronosticos_cobros = {}
+_pronosticos_cobros_lock = threading.Lock()
+
+def _marcar_pronostico_vencido(mapper, conexion, objeto):
+    sesion = db.inspect(objeto).session
+    if sesion is not None:
+        sesion.info['pronostico_vencido'] = True
+
+for _modelo in (Pago, Prestamo):
+    for _evento in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_modelo, _evento, _marcar_pronostico_vencido)
+
+@event.listens_for(Session, 'after_commit')
+def _vaciar_pronosticos_cobros(sesion):
+    if sesion.info.pop('pronostico_vencido', False):
+        with _pronosticos_cobros_lock:
+            _pronosticos_cobros.clear()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _descartar_pronostico_vencido(sesion, transaccion_anterior):
+    sesion.info.pop('pronostico_vencido', None)
+
+def _saldo_cuotas_pendientes(*filtros):
+    """Columnas de capital e interés que faltan por cobrar de cada cuota (descontando pagos parciales).
+
+    Los filtros sobre Cuota limitan los pagos que se suman (por ejemplo, a un préstamo).
+    """
+    pagado = db.session.query(
+        Pago.cuota_id,
+        db.func.sum(Pago.monto_capital).label('capital'),
+        db.func.sum(Pago.monto_interes).label('interes')
+    ).join(Cuota, Pago.cuota_id == Cuota.id).filter(*filtros).group_by(Pago.cuota_id).subquery()
+
+    def saldo(total, cobrado):
+        diferencia = total - db.func.coalesce(cobrado, 0)
+        return db.case((diferencia > 0, diferencia), else_=0)
+
+    return pagado, saldo(Cuota.monto_capital, pagado.c.capital), saldo(Cuota.monto_interes, pagado.c.interes)
+
+def calcular_ratios_cobro(fecha_actual):
+    """Qué parte de lo vencido en los últimos PRONOSTICO_DIAS_HISTORIA días se cobró a tiempo
+    (hasta el día del vencimiento) y qué parte de lo que quedó atrasado se cobró después.
+
+    Solo cuentan los pagos regulares; sin historia los ratios valen 1 (no se ajusta nada).
+    """
+    inicio = fecha_actual - timedelta(days=PRONOSTICO_DIAS_HISTORIA)
+    en_ventana = (Cuota.fecha_vencimiento >= inicio, Cuota.fecha_vencimiento < fecha_actual)
+
+    vencido_capital, vencido_interes = db.session.query(
+        db.func.coalesce(db.func.sum(Cuota.monto_capital), 0),
+        db.func.coalesce(db.func.sum(Cuota.monto_interes), 0)
+    ).filter(*en_ventana).one()
+
+    a_tiempo = db.func.date(Pago.fecha_pago) <= Cuota.fecha_vencimiento
+    def sumar(condicion, columna):
+        return db.func.coalesce(db.func.sum(db.case((condicion, columna), else_=0)), 0)
+
+    capital_a_tiempo, interes_a_tiempo, capital_tarde, interes_tarde = db.session.query(
+        sumar(a_tiempo, Pago.monto_capital),
+        sumar(a_tiempo, Pago.monto_interes),
+        sumar(~a_tiempo, Pago.monto_capital),
+        sumar(~a_tiempo, Pago.monto_interes)
+    ).join(Cuota, Pago.cuota_id == Cuota.id).filter(
+        *en_ventana,
+        Pago.tipo_pago.notin_(['Extraordinario', 'AbonoCapital'])
+    ).one()
+
+    def ratio(cobrado, esperado):
+        esperado = float(esperado)
+        return min(1.0, float(cobrado) / esperado) if esperado > 0 else 1.0
+
+    return {
+        'capital_a_tiempo': ratio(capital_a_tiempo, vencido_capital),
+        'interes_a_tiempo': ratio(interes_a_tiempo, vencido_interes),
+        'capital_recuperado': ratio(capital_tarde, float(vencido_capital) - float(capital_a_tiempo)),
+        'interes_recuperado': ratio(interes_tarde, float(vencido_interes) - float(interes_a_tiempo))
+    }
+
+def calcular_pronostico_cobros(fecha_inicio, fecha_fin, agrupacion='dia'):
+    """Cobros esperados por día o semana entre dos fechas, separados en capital e interés.
+
+    Lo pendiente de cada vencimiento se suma con un GROUP BY por fecha_vencimiento y se
+    multiplica por el ratio histórico de cobro a tiempo. Las cuotas ya atrasadas van
+    aparte, multiplicadas por el ratio de recuperación. El resultado se reutiliza hasta
+    el próximo pago o cambio de préstamo (o hasta que cambie el día).
+    """
+    if agrupacion not in ('dia', 'semana'):
+        raise ValueError('Agrupación no válida: use dia o semana')
+
+    fecha_actual = datetime.now().date()
+    clave = (fecha_inicio, fecha_fin, agrupacion, fecha_actual)
+    with _pronosticos_cobros_lock:
+        guardado = _pronosticos_cobros.get(clave)
+    if guardado:
+        return guardado
+
+    ratios = calcular_ratios_cobro(fecha_actual)
+    pagado, capital_pendiente, interes_pendiente = _saldo_cuotas_pendientes()
+    pendientes = db.session.query(Cuota).outerjoin(pagado, pagado.c.cuota_id == Cuota.id).filter(
+        Cuota.estado.in_(['Pendiente', 'Parcial'])
+    )
+
+    filas = pendientes.with_entities(
+        Cuota.fecha_vencimiento,
+        db.func.count(Cuota.id),
+        db.func.sum(capital_pendiente),
+        db.func.sum(interes_pendiente)
+    ).filter(
+        Cuota.fecha_vencimiento >= max(fecha_inicio, fecha_actual),
+        Cuota.fecha_vencimiento <= fecha_fin
+    ).group_by(Cuota.fecha_vencimiento).order_by(Cuota.fecha_vencimiento).all()
+
+    periodos = {}
+    for fecha, cuotas, capital, interes in filas:
+        if agrupacion == 'semana':
+            fecha = fecha - timedelta(days=fecha.weekday())
+        periodo = periodos.setdefault(fecha, {'fecha': fecha.isoformat(), 'cuotas': 0,
+                                              'capital': 0.0, 'interes': 0.0})
+        periodo['cuotas'] += cuotas
+        periodo['capital'] += float(capital or 0)
+        periodo['interes'] += float(interes or 0)
+
+    for periodo in periodos.values():
+        periodo['esperado_capital'] = round(periodo['capital'] * ratios['capital_a_tiempo'], 2)
+        periodo['esperado_interes'] = round(periodo['interes'] * ratios['interes_a_tiempo'], 2)
+        periodo['esperado_total'] = round(periodo['esperado_capital'] + periodo['esperado_interes'], 2)
+        periodo['capital'] = round(periodo['capital'], 2)
+        periodo['interes'] = round(periodo['interes'], 2)
+
+    cuotas_atrasadas, capital_atrasado, interes_atrasado = pendientes.with_entities(
+        db.func.count(Cuota.id),
+        db.func.coalesce(db.func.sum(capital_pendiente), 0),
+        db.func.coalesce(db.func.sum(interes_pendiente), 0)
+    ).filter(Cuota.fecha_vencimiento < fecha_actual).one()
+    atrasado = {
+        'cuotas': cuotas_atrasadas,
+        'capital': round(float(capital_atrasado), 2),
+        'interes': round(float(interes_atrasado), 2),
+        'esperado_capital': round(float(capital_atrasado) * ratios['capital_recuperado'], 2),
+        'esperado_interes': round(float(interes_atrasado) * ratios['interes_recuperado'], 2)
+    }
+
+    periodos = [periodos[fecha] for fecha in sorted(periodos)]
+    data = {
+        'titulo': 'Pronóstico de Cobros',
+        'fecha_inicio': fecha_inicio,
+        'fecha_fin': fecha_fin,
+        'agrupacion': agrupacion,
+        'ratios': {nombre: round(valor, 4) for nombre, valor in ratios.items()},
+        'periodos': periodos,
+        'atrasado': atrasado,
+        'total_esperado_vencimientos': round(sum(p['esperado_total'] for p in periodos), 2),
+        'total_esperado_atrasos': round(atrasado['esperado_capital'] + atrasado['esperado_interes'], 2)
+    }
+
+    with _pronosticos_cobros_lock:
+        if len(_pronosticos_cobros) > 100:
+            _pronosticos_cobros.clear()
+        _pronosticos_cobros[clave] = data
+    return data
+
+@app.route('/api/pronostico/cobros')
+@login_required
+def api_pronostico_cobros():
+    """Cobros esperados para los próximos ?dias= días (por defecto PRONOSTICO_DIAS), ?agrupacion=dia|semana"""
+    try:
+        dias = min(max(request.args.get('dias', PRONOSTICO_DIAS, type=int), 1), 366)
+        fecha_inicio = datetime.now().date()
+        fecha_fin = fecha_inicio + timedelta(days=dias - 1)
+        data = calcular_pronostico_cobros(fecha_inicio, fecha_fin, request.args.get('agrupacion', 'dia'))
+
+        return jsonify({
+            'success': True,
+            'data': dict(data, fecha_inicio=fecha_inicio.isoformat(), fecha_fin=fecha_fin.isoformat())
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/reportes')
 @login_required
 def reportes():
@@ -2236,6 +3673,8 @@ def generar_reporte(tipo):
             data = generar_reporte_atrasos(fecha_inicio, fecha_fin)
         elif tipo == 'contabilidad':
             data = generar_reporte_contabilidad(fecha_inicio, fecha_fin)
+        elif tipo == 'pronostico':
+            data = calcular_pronostico_cobros(fecha_inicio, fecha_fin, request.args.get('agrupacion', 'semana'))
         else:
             flash('Tipo de reporte no válido', 'error')
             return redirect(url_for('reportes'))
@@ -2351,7 +3790,10 @@ def generar_reporte_atrasos(fecha_inicio, fecha_fin):
         Cuota.fecha_vencimiento < fecha_actual,
         Cuota.fecha_vencimiento >= fecha_inicio,
         Cuota.fecha_vencimiento <= fecha_fin
-    ).all()
+    ).options(db.joinedload(Cuota.prestamo).joinedload(Prestamo.cliente)).all()
+    
+    # La antigüedad por tramos es de toda la cartera, tomada del corte diario
+    corte = obtener_corte_antiguedad()
     
     data = {
         'titulo': 'Reporte de Atrasos',
@@ -2359,6 +3801,8 @@ def generar_reporte_atrasos(fecha_inicio, fecha_fin):
         'fecha_fin': fecha_fin,
         'total_cuotas_atrasadas': len(cuotas_atrasadas),
         'monto_total_atrasado': sum(float(c.monto_total) for c in cuotas_atrasadas),
+        'fecha_corte': corte.fecha,
+        'tramos': corte.tramos(),
         'atrasos': []
     }
     
@@ -2420,16 +3864,22 @@ def generar_pdf(data, tipo):
             pdf_buffer = generar_pdf_reporte_atrasos(data)
         elif tipo == 'contabilidad':
             pdf_buffer = generar_pdf_reporte_contabilidad(data)
+        elif tipo == 'pronostico':
+            pdf_buffer = generar_pdf_reporte_pronostico(data)
         else:
             flash('Tipo de reporte no válido', 'error')
             return redirect(url_for('reportes'))
         
         # Crear registro del reporte en la base de datos
-        parametros = json.dumps({
+        parametros = {
             'fecha_inicio': data.get('fecha_inicio', '').strftime('%Y-%m-%d') if hasattr(data.get('fecha_inicio', ''), 'strftime') else str(data.get('fecha_inicio', '')),
             'fecha_fin': data.get('fecha_fin', '').strftime('%Y-%m-%d') if hasattr(data.get('fecha_fin', ''), 'strftime') else str(data.get('fecha_fin', '')),
             'tipo': tipo
-        })
+        }
+        if 'agrupacion' in data:
+            # Para regenerar el pronóstico con la misma agrupación
+            parametros['agrupacion'] = data['agrupacion']
+        parametros = json.dumps(parametros)
         
         nuevo_reporte = Reporte(
             tipo=tipo,
@@ -2491,11 +3941,15 @@ def generar_excel(data, tipo):
     """Genera archivo Excel del reporte"""
     try:
         # Crear registro del reporte en la base de datos
-        parametros = json.dumps({
+        parametros = {
             'fecha_inicio': data.get('fecha_inicio', '').strftime('%Y-%m-%d') if hasattr(data.get('fecha_inicio', ''), 'strftime') else str(data.get('fecha_inicio', '')),
             'fecha_fin': data.get('fecha_fin', '').strftime('%Y-%m-%d') if hasattr(data.get('fecha_fin', ''), 'strftime') else str(data.get('fecha_fin', '')),
             'tipo': tipo
-        })
+        }
+        if 'agrupacion' in data:
+            # Para regenerar el pronóstico con la misma agrupación
+            parametros['agrupacion'] = data['agrupacion']
+        parametros = json.dumps(parametros)
         
         nuevo_reporte = Reporte(
             tipo=tipo,
@@ -2520,11 +3974,15 @@ def generar_csv(data, tipo):
     """Genera archivo CSV del reporte"""
     try:
         # Crear registro del reporte en la base de datos
-        parametros = json.dumps({
+        parametros = {
             'fecha_inicio': data.get('fecha_inicio', '').strftime('%Y-%m-%d') if hasattr(data.get('fecha_inicio', ''), 'strftime') else str(data.get('fecha_inicio', '')),
             'fecha_fin': data.get('fecha_fin', '').strftime('%Y-%m-%d') if hasattr(data.get('fecha_fin', ''), 'strftime') else str(data.get('fecha_fin', '')),
             'tipo': tipo
-        })
+        }
+        if 'agrupacion' in data:
+            # Para regenerar el pronóstico con la misma agrupación
+            parametros['agrupacion'] = data['agrupacion']
+        parametros = json.dumps(parametros)
         
         nuevo_reporte = Reporte(
             tipo=tipo,
@@ -2549,13 +4007,30 @@ def generar_csv(data, tipo):
 @app.route('/api/clientes')
 @login_required
 def api_clientes():
-    clientes = Cliente.query.filter_by(activo=True).all()
-    return jsonify([{
+    """Clientes activos para el selector de los formularios (búsqueda mientras se escribe).
+    
+    Con ?q= devuelve los mejores resultados por nombre o documento usando el índice
+    de búsqueda; sin q, los más recientes. Nunca más de ?limite= (máximo 50).
+    """
+    q = request.args.get('q', '').strip()
+    limite = min(max(request.args.get('limite', 20, type=int), 1), 50)
+    
+    clientes_query = Cliente.query.filter_by(activo=True)
+    if q:
+        clientes_query = filtrar_busqueda_clientes(clientes_query, q).order_by(Cliente.nombre, Cliente.apellidos)
+    else:
+        clientes_query = clientes_query.order_by(Cliente.fecha_creacion.desc())
+    clientes = clientes_query.limit(limite).all()
+    
+    response = jsonify([{
         'id': c.id,
         'nombre': f"{c.nombre} {c.apellidos}",
         'documento': c.documento,
         'telefono': c.telefono_principal
     } for c in clientes])
+    # Las mismas letras se repiten al escribir y borrar: el navegador las reutiliza un momento
+    response.headers['Cache-Control'] = 'private, max-age=30'
+    return response
 
 @app.route('/api/prestamos/<int:cliente_id>')
 @login_required
@@ -2707,15 +4182,10 @@ def api_detalle_prestamo(prestamo_id):
         pagos = Pago.query.join(Cuota).filter(Cuota.prestamo_id == prestamo_id).all()
         
         # Calcular valores financieros
-        total_a_pagar = sum(float(c.monto_total) for c in cuotas)
         intereses_totales = sum(float(c.monto_interes) for c in cuotas)
-        capital_pendiente = sum(float(c.monto_capital) for c in cuotas if c.estado == 'Pendiente')
         
-        # Calcular fecha de última actualización (último pago o fecha de creación)
-        fecha_ultima_actualizacion = prestamo.fecha_creacion
-        if pagos:
-            ultimo_pago = max(pagos, key=lambda p: p.fecha_pago)
-            fecha_ultima_actualizacion = ultimo_pago.fecha_pago
+        # Fecha de última actualización (último pago o fecha de creación)
+        fecha_ultima_actualizacion = prestamo.fecha_ultimo_pago or prestamo.fecha_creacion
         
         data = {
             'prestamo': {
@@ -2731,9 +4201,13 @@ def api_detalle_prestamo(prestamo_id):
                 'estado_garantia': prestamo.estado_garantia,
                 'estado': prestamo.estado,
                 'fecha_creacion': prestamo.fecha_creacion.strftime('%d/%m/%Y'),
-                'total_a_pagar': total_a_pagar,
+                'total_a_pagar': float(prestamo.monto_cuotas),
                 'intereses_totales': intereses_totales,
-                'capital_pendiente': capital_pendiente,
+                'capital_pendiente': float(prestamo.capital_pendiente),
+                'interes_pendiente': float(prestamo.interes_pendiente),
+                'cuotas_pagadas': prestamo.cuotas_pagadas,
+                'cuotas_pendientes': prestamo.cuotas_pendientes,
+                'cuotas_atrasadas': prestamo.cuotas_atrasadas,
                 'fecha_ultima_actualizacion': fecha_ultima_actualizacion.strftime('%d/%m/%Y')
             },
             'cliente': {
@@ -2818,52 +4292,355 @@ def api_detalle_pago(pago_id):
     except Exception as e:
                 return jsonify({'success': False, 'error': str(e)})
 
+# Tipos de pago de cuota que se aceptan por lote; los abonos al capital y pagos
+# extraordinarios reamortizan el préstamo y se registran de a uno
+TIPOS_PAGO_LOTE = ('Normal', 'Parcial', 'Adelantado', 'SoloIntereses')
+
+def validar_pago_lote(item):
+    """Valida un pago del lote y devuelve sus datos normalizados (ValueError si no es válido)"""
+    if not isinstance(item, dict):
+        raise ValueError('Cada pago debe ser un objeto')
+    try:
+        cuota_id = int(item['cuota_id'])
+        monto_pagado = float(item['monto_pagado'])
+        monto_capital = float(item.get('monto_capital', 0))
+        monto_interes = float(item.get('monto_interes', 0))
+    except KeyError as e:
+        raise ValueError(f'Falta el campo {e.args[0]}')
+    except (TypeError, ValueError):
+        raise ValueError('Los montos y el ID de cuota deben ser numéricos')
+
+    tipo_pago = item.get('tipo_pago', 'Normal')
+    if tipo_pago not in TIPOS_PAGO_LOTE:
+        raise ValueError(f'Tipo de pago no permitido en lote: {tipo_pago}')
+    if monto_pagado <= 0 or monto_capital < 0 or monto_interes < 0:
+        raise ValueError('Los montos no pueden ser negativos y el monto pagado debe ser mayor que cero')
+    if abs(monto_pagado - (monto_capital + monto_interes)) > 0.01:
+        raise ValueError('El monto pagado debe ser igual a la suma de capital e intereses')
+
+    clave = str(item.get('clave_idempotencia') or '').strip() or None
+    if clave and len(clave) > LARGO_CLAVE_IDEMPOTENCIA:
+        raise ValueError(f'La clave de idempotencia no puede tener más de {LARGO_CLAVE_IDEMPOTENCIA} caracteres')
+
+    return {'cuota_id': cuota_id, 'monto_pagado': monto_pagado, 'monto_capital': monto_capital,
+            'monto_interes': monto_interes, 'tipo_pago': tipo_pago, 'clave': clave}
+
+@app.route('/api/pagos/lote', methods=['POST'])
+@login_required
+def api_registrar_pagos_lote():
+    """API para registrar de una vez los cobros del día de un cobrador.
+
+    Recibe {"pagos": [{cuota_id, monto_pagado, monto_capital, monto_interes, tipo_pago,
+    clave_idempotencia}, ...]}. Los pagos válidos se registran en una sola transacción
+    con un movimiento de capital y una transacción contable por lote; los que no pasan
+    la validación se informan en 'resultados' (uno por pago, en el mismo orden).
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('pagos')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Debe enviar una lista de pagos'}), 400
+    if len(items) > MAX_PAGOS_POR_LOTE:
+        return jsonify({'success': False, 'error': f'El lote no puede tener más de {MAX_PAGOS_POR_LOTE} pagos'}), 400
+
+    resultados = [None] * len(items)
+    validos = []
+    for indice, item in enumerate(items):
+        try:
+            validos.append((indice, validar_pago_lote(item)))
+        except ValueError as e:
+            resultados[indice] = {'indice': indice, 'success': False, 'error': str(e)}
+
+    try:
+        # Cuotas con su préstamo y claves ya registradas: una consulta para todo el lote
+        cuotas = {}
+        cuota_ids = {datos['cuota_id'] for _, datos in validos}
+        if cuota_ids:
+            cuotas = {cuota.id: cuota for cuota in Cuota.query.options(db.joinedload(Cuota.prestamo))
+                      .filter(Cuota.id.in_(cuota_ids)).all()}
+        claves = {datos['clave'] for _, datos in validos if datos['clave']}
+        registrados = dict(db.session.query(Pago.clave_idempotencia, Pago.id).filter(
+            Pago.clave_idempotencia.in_(claves)).all()) if claves else {}
+
+        nuevos = []
+        prestamo_ids = set()
+        claves_lote = set()
+        total_pagado = 0
+        cambia_atraso = False
+        fecha_actual = datetime.now().date()
+        for indice, datos in validos:
+            clave = datos['clave']
+            if clave in registrados:
+                resultados[indice] = {'indice': indice, 'success': True, 'pago_id': registrados[clave], 'duplicado': True}
+                continue
+            cuota = cuotas.get(datos['cuota_id'])
+            error = None
+            if clave and clave in claves_lote:
+                error = 'Clave de idempotencia repetida en el lote'
+            elif cuota is None:
+                error = 'Cuota no encontrada'
+            elif cuota.estado == 'Pagada':
+                error = 'La cuota ya está pagada'
+            elif cuota.prestamo.estado in ('Pagado', 'Cancelado'):
+                error = f'El préstamo está {cuota.prestamo.estado}'
+            if error:
+                resultados[indice] = {'indice': indice, 'success': False, 'error': error}
+                continue
+
+            pago = Pago(
+                cuota_id=cuota.id,
+                monto_pagado=datos['monto_pagado'],
+                monto_capital=datos['monto_capital'],
+                monto_interes=datos['monto_interes'],
+                tipo_pago=datos['tipo_pago'],
+                usuario_id=current_user.id,
+                clave_idempotencia=clave
+            )
+
+            # Actualizar estado y saldo de la cuota (igual que en nuevo_pago)
+            estaba_atrasada = cuota_esta_atrasada(cuota, fecha_actual)
+            if datos['monto_capital'] >= float(cuota.monto_capital) and datos['monto_interes'] >= float(cuota.monto_interes):
+                cuota.estado = 'Pagada'
+            elif datos['monto_capital'] > 0 or datos['monto_interes'] > 0:
+                cuota.estado = 'Parcial'
+            cuota.saldo_restante = max(0, float(cuota.saldo_restante) - datos['monto_capital'])
+            cambia_atraso = cambia_atraso or estaba_atrasada != cuota_esta_atrasada(cuota, fecha_actual)
+
+            if clave:
+                claves_lote.add(clave)
+            nuevos.append((indice, pago))
+            prestamo_ids.add(cuota.prestamo_id)
+            total_pagado += datos['monto_pagado']
+
+        if nuevos:
+            db.session.add_all([pago for _, pago in nuevos])
+            db.session.flush()
+            for indice, pago in nuevos:
+                resultados[indice] = {'indice': indice, 'success': True, 'pago_id': pago.id}
+            recalcular_saldos_prestamos(sorted(prestamo_ids))
+
+            # Una transacción contable y un movimiento de capital por lote
+            descripcion = f"Lote de {len(nuevos)} pagos - {current_user.nombre} {current_user.apellidos}"
+            transaccion = Gasto(
+                descripcion=descripcion,
+                monto=-total_pagado,  # Negativo para ingreso
+                fecha=fecha_actual,
+                tipo="Pagos"
+            )
+            db.session.add(transaccion)
+            db.session.flush()
+            registrar_movimiento_capital(total_pagado, 'Pago', descripcion, gasto_id=transaccion.id)
+
+            # Actualizar resumen de cartera del dashboard
+            if cambia_atraso:
+                refrescar_atrasos_resumen()
+            ajustar_resumen_cartera(pagos_mes=len(nuevos), monto_pagos_mes=total_pagado)
+
+            db.session.commit()
+
+        return jsonify({
+            'success': True,
+            'registrados': len(nuevos),
+            'rechazados': sum(1 for resultado in resultados if not resultado['success']),
+            'total_pagado': round(total_pagado, 2),
+            'resultados': resultados
+        })
+
+    except IntegrityError:
+        # Otra solicitud registró alguna de las mismas claves al mismo tiempo
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': 'Algunos pagos del lote se registraron en otra solicitud; reenvíe el lote'
+        }), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def cuotas_por_cobrar(prestamo_id):
+    """Cuotas pendientes o parciales del préstamo con lo que falta de interés y capital,
+    de la más antigua a la más nueva (una consulta)"""
+    pagado, capital_pendiente, interes_pendiente = _saldo_cuotas_pendientes(Cuota.prestamo_id == prestamo_id)
+    filas = db.session.query(
+        Cuota.id, Cuota.numero_cuota, Cuota.fecha_vencimiento, Cuota.estado, Cuota.saldo_restante,
+        capital_pendiente.label('capital_pendiente'),
+        interes_pendiente.label('interes_pendiente')
+    ).outerjoin(pagado, pagado.c.cuota_id == Cuota.id).filter(
+        Cuota.prestamo_id == prestamo_id,
+        Cuota.estado.in_(['Pendiente', 'Parcial'])
+    ).order_by(Cuota.fecha_vencimiento, Cuota.numero_cuota).all()
+    return [dict(fila._mapping, cuota_id=fila.id) for fila in filas]
+
+def distribuir_pago_prestamo(prestamo, monto, clave=None, simular=False):
+    """Aplica un monto a las cuotas del préstamo: primero las más antiguas y en cada
+    una el interés antes que el capital.
+
+    Con simular=True solo calcula la distribución. Si no, agrega a la transacción
+    actual un Pago por cuota alcanzada, los cambios de estado de esas cuotas (un
+    UPDATE por lotes), una transacción contable y un movimiento de capital. La clave
+    de idempotencia se guarda en el primer pago. No confirma la transacción.
+
+    Returns:
+        dict: asignaciones (con número y vencimiento de cada cuota), total_asignado,
+        sobrante y pago_ids (vacío al simular)
+    """
+    monto = round(float(monto), 2)
+    if monto <= 0:
+        raise ValueError('El monto debe ser mayor que cero')
+
+    cuotas = {cuota['cuota_id']: cuota for cuota in cuotas_por_cobrar(prestamo.id)}
+    asignaciones, sobrante = distribuir_pago(monto, cuotas.values())
+    for asignacion in asignaciones:
+        cuota = cuotas[asignacion['cuota_id']]
+        asignacion['numero_cuota'] = cuota['numero_cuota']
+        asignacion['fecha_vencimiento'] = cuota['fecha_vencimiento'].isoformat()
+        asignacion['estado'] = 'Pagada' if asignacion['saldada'] else 'Parcial'
+
+    # Las cuotas sin nada que cobrar (las intermedias de un Bullet) no reciben pago:
+    # quedan pagadas si todas las anteriores quedan cubiertas con este monto
+    asignadas = {asignacion['cuota_id']: asignacion for asignacion in asignaciones}
+    sin_saldo = []
+    for cuota_id, cuota in cuotas.items():
+        asignacion = asignadas.get(cuota_id)
+        if asignacion is not None:
+            if not asignacion['saldada']:
+                break
+        elif round(float(cuota['capital_pendiente']) * 100) <= 0 and round(float(cuota['interes_pendiente']) * 100) <= 0:
+            sin_saldo.append(cuota_id)
+        else:
+            break
+
+    resultado = {
+        'asignaciones': asignaciones,
+        'total_asignado': round(monto - sobrante, 2),
+        'sobrante': sobrante,
+        'pago_ids': []
+    }
+    if simular or not asignaciones:
+        return resultado
+    if sobrante > 0:
+        raise ValueError(f'El monto excede lo pendiente del préstamo en RD$ {sobrante:,.2f}')
+
+    pagos = [Pago(
+        cuota_id=asignacion['cuota_id'],
+        monto_pagado=asignacion['monto_pagado'],
+        monto_capital=asignacion['monto_capital'],
+        monto_interes=asignacion['monto_interes'],
+        tipo_pago='Normal' if asignacion['saldada'] else 'Parcial',
+        usuario_id=current_user.id,
+        clave_idempotencia=clave if i == 0 else None
+    ) for i, asignacion in enumerate(asignaciones)]
+    db.session.add_all(pagos)
+
+    fecha_actual = datetime.now().date()
+    db.session.execute(db.update(Cuota), [{
+        'id': asignacion['cuota_id'],
+        'estado': asignacion['estado'],
+        'saldo_restante': max(0, float(cuotas[asignacion['cuota_id']]['saldo_restante']) - asignacion['monto_capital'])
+    } for asignacion in asignaciones] + [
+        {'id': cuota_id, 'estado': 'Pagada'} for cuota_id in sin_saldo
+    ])
+    cambia_atraso = any(cuotas[cuota_id]['estado'] == 'Pendiente' and
+                        cuotas[cuota_id]['fecha_vencimiento'] < fecha_actual
+                        for cuota_id in list(asignadas) + sin_saldo)
+
+    db.session.flush()
+    resultado['pago_ids'] = [pago.id for pago in pagos]
+    actualizar_saldos_prestamo(prestamo)
+
+    # Una transacción contable y un movimiento de capital por el monto completo
+    descripcion = f"Pago de {len(pagos)} cuota(s) - Cliente ID: {prestamo.cliente_id}"
+    transaccion = Gasto(
+        descripcion=descripcion,
+        monto=-monto,  # Negativo para ingreso
+        fecha=fecha_actual,
+        tipo="Pagos"
+    )
+    db.session.add(transaccion)
+    db.session.flush()
+    registrar_movimiento_capital(monto, 'Pago', descripcion, prestamo_id=prestamo.id, gasto_id=transaccion.id)
+
+    # Sin cuotas por cobrar el préstamo queda saldado
+    prestamo_liquidado = prestamo.estado == 'Activo' and prestamo.cuotas_pendientes == 0
+    if prestamo_liquidado:
+        prestamo.estado = 'Pagado'
+
+    # Actualizar resumen de cartera del dashboard
+    if cambia_atraso:
+        refrescar_atrasos_resumen()
+    ajustar_resumen_cartera(pagos_mes=len(pagos), monto_pagos_mes=monto,
+                            prestamos_activos=-1 if prestamo_liquidado else 0)
+    return resultado
+
+@app.route('/api/prestamos/<int:prestamo_id>/distribuir-pago', methods=['POST'])
+@login_required
+def api_distribuir_pago(prestamo_id):
+    """API para aplicar un monto a las cuotas de un préstamo de la más antigua a la más nueva.
+
+    Recibe monto, simular y clave_idempotencia (JSON o formulario). Con simular
+    devuelve la distribución sin registrar nada (vista previa del formulario de pago).
+    """
+    prestamo = Prestamo.query.get_or_404(prestamo_id)
+    data = request.get_json(silent=True) or request.form
+    simular = str(data.get('simular', '')).lower() in ('1', 'true', 'si', 'sí')
+    clave = None
+    try:
+        if prestamo.estado in ('Pagado', 'Cancelado'):
+            return jsonify({'success': False, 'error': f'El préstamo está {prestamo.estado}'}), 400
+
+        try:
+            monto = float(data.get('monto', ''))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'El monto debe ser numérico'}), 400
+
+        clave = str(data.get('clave_idempotencia') or request.headers.get('Idempotency-Key') or '').strip() or None
+        if clave and len(clave) > LARGO_CLAVE_IDEMPOTENCIA:
+            return jsonify({'success': False, 'error': f'La clave de idempotencia no puede tener más de {LARGO_CLAVE_IDEMPOTENCIA} caracteres'}), 400
+        registrado = None if simular else pago_ya_registrado(clave)
+        if registrado:
+            return jsonify({'success': True, 'duplicado': True, 'pago_ids': [registrado.id]})
+
+        resultado = distribuir_pago_prestamo(prestamo, monto, clave=clave, simular=simular)
+        if not simular:
+            db.session.commit()
+        return jsonify(dict(resultado, success=True, simulacion=simular))
+
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except IntegrityError:
+        # Otra solicitud con la misma clave se confirmó primero
+        db.session.rollback()
+        registrado = pago_ya_registrado(clave)
+        if registrado:
+            return jsonify({'success': True, 'duplicado': True, 'pago_ids': [registrado.id]})
+        return jsonify({'success': False, 'error': 'No se pudo registrar el pago'}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/dashboard/stats')
 @login_required
 def api_dashboard_stats():
     """API para obtener estadísticas del dashboard en tiempo real"""
     try:
-        # Estadísticas básicas
-        total_prestamos = Prestamo.query.filter_by(estado='Activo').count()
-        total_clientes = Cliente.query.filter_by(activo=True).count()
-        
-        # Calcular clientes atrasados
-        fecha_actual = datetime.now().date()
-        cuotas_atrasadas = Cuota.query.filter(
-            Cuota.estado == 'Pendiente',
-            Cuota.fecha_vencimiento < fecha_actual
-        ).all()
-        
-        clientes_atrasados = len(set([cuota.prestamo.cliente_id for cuota in cuotas_atrasadas]))
-        monto_total_atrasado = sum(float(cuota.monto_total) for cuota in cuotas_atrasadas)
-        
+        # Estadísticas básicas desde el resumen de cartera
+        resumen = obtener_resumen_cartera()
+        db.session.commit()
+
         # Capital disponible
-        contabilidad = Contabilidad.query.first()
-        capital_disponible = float(contabilidad.capital_disponible) if contabilidad else 0
-        
-        # Préstamos del mes
-        inicio_mes = fecha_actual.replace(day=1)
-        prestamos_mes = Prestamo.query.filter(
-            Prestamo.fecha_creacion >= inicio_mes
-        ).count()
-        
-        # Pagos del mes
-        pagos_mes = Pago.query.filter(
-            Pago.fecha_pago >= inicio_mes
-        ).count()
-        monto_pagos_mes = sum(float(p.monto_pagado) for p in Pago.query.filter(Pago.fecha_pago >= inicio_mes).all())
-        
+        capital_disponible = float(obtener_capital_disponible())
+
         return jsonify({
             'success': True,
             'stats': {
-                'total_prestamos': total_prestamos,
-                'total_clientes': total_clientes,
-                'clientes_atrasados': clientes_atrasados,
-                'monto_total_atrasado': monto_total_atrasado,
+                'total_prestamos': resumen.prestamos_activos,
+                'total_clientes': resumen.clientes_activos,
+                'clientes_atrasados': resumen.clientes_atrasados,
+                'monto_total_atrasado': float(resumen.monto_atrasado),
                 'capital_disponible': capital_disponible,
-                'prestamos_mes': prestamos_mes,
-                'pagos_mes': pagos_mes,
-                'monto_pagos_mes': monto_pagos_mes
+                'prestamos_mes': resumen.prestamos_mes,
+                'pagos_mes': resumen.pagos_mes,
+                'monto_pagos_mes': float(resumen.monto_pagos_mes)
             }
         })
     except Exception as e:
@@ -2912,8 +4689,7 @@ def api_notificaciones():
 def api_contabilidad_stats():
     """API para obtener estadísticas de contabilidad en tiempo real"""
     try:
-        contabilidad = Contabilidad.query.first()
-        capital_disponible = float(contabilidad.capital_disponible) if contabilidad else 0
+        capital_disponible = float(obtener_capital_disponible())
         
         # Calcular total de ingresos (gastos con monto negativo)
         total_ingresos = db.session.query(db.func.sum(db.func.abs(Gasto.monto))).filter(Gasto.monto < 0).scalar() or 0
@@ -3012,6 +4788,56 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def cargar_terminos_cartera():
+    """Términos de los préstamos activos como arreglos, sin crear objetos del ORM"""
+    filas = db.session.execute(
+        db.select(Prestamo.id, Prestamo.monto, Prestamo.tasa_interes, Prestamo.plazo_meses,
+                  Prestamo.frecuencia, Prestamo.fecha_primera_cuota)
+        .where(Prestamo.estado == 'Activo')
+    ).all()
+    return TerminosCartera.desde_filas(filas)
+
+def curva_a_json(curva):
+    """Convierte el resultado de simular_cartera en una lista de meses para JSON"""
+    return [{
+        'mes': str(mes),
+        'capital': round(float(capital), 2),
+        'interes': round(float(interes), 2),
+        'total': round(float(total), 2),
+        'cuotas': int(cuotas)
+    } for mes, capital, interes, total, cuotas in zip(
+        curva['meses'], curva['capital'], curva['interes'], curva['total'], curva['cuotas'])]
+
+@app.route('/api/simulacion/cartera')
+@login_required
+@admin_required
+def api_simulacion_cartera():
+    """Flujo de caja mensual de la cartera activa y el de un escenario hipotético
+    (?tasa_interes=, ?frecuencia=, ?plazo_meses= aplicados a todos los préstamos).
+    Solo lectura: no genera ni modifica cuotas."""
+    try:
+        desde = request.args.get('desde')
+        desde = datetime.strptime(desde, '%Y-%m-%d').date() if desde else datetime.now().date()
+
+        terminos = cargar_terminos_cartera()
+        escenario = terminos.escenario(
+            tasa_interes=request.args.get('tasa_interes', type=float),
+            frecuencia=request.args.get('frecuencia') or None,
+            plazo_meses=request.args.get('plazo_meses', type=int)
+        )
+
+        return jsonify({
+            'success': True,
+            'prestamos': len(terminos),
+            'desde': desde.isoformat(),
+            'actual': curva_a_json(simular_cartera(terminos, desde=desde)),
+            'escenario': curva_a_json(simular_cartera(escenario, desde=desde))
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 # Gestión de Usuarios (solo administradores)
 @app.route('/usuarios')
 @login_required
@@ -3166,7 +4992,7 @@ def cambiar_password():
     return redirect(url_for('perfil'))
 
 # Funciones para generar PDFs reales
-def generar_pdf_prestamo(prestamo, cuotas, total_cuotas, cuotas_pagadas, 
+def generar_pdf_prestamo(prestamo, cuotas, total_cuotas, cuotas_pagadas, cuotas_pendientes,
                          monto_total_prestamo, monto_pagado, monto_pendiente):
     """Genera un PDF real del préstamo"""
     buffer = io.BytesIO()
@@ -4096,8 +5922,7 @@ def generar_pdf_reporte_contabilidad(data):
 def descargar_balance_pdf():
     try:
         # Obtener datos de contabilidad
-        contabilidad = Contabilidad.query.first()
-        capital_disponible = float(contabilidad.capital_disponible) if contabilidad else 0
+        capital_disponible = float(obtener_capital_disponible())
         
         # Calcular estadísticas financieras
         total_ingresos = db.session.query(db.func.sum(db.func.abs(Gasto.monto))).filter(Gasto.monto < 0).scalar() or 0
@@ -4379,6 +6204,32 @@ def generar_pdf_reporte_atrasos(data):
     story.append(t)
     story.append(Spacer(1, 20))
     
+    # Antigüedad de la cartera atrasada por tramos
+    if data.get('tramos'):
+        story.append(Paragraph(f"ANTIGÜEDAD DE LA MORA (CORTE DEL {data['fecha_corte'].strftime('%d/%m/%Y')})",
+                               subtitle_style))
+        tramos_data = [['Tramo', 'Cuotas', 'Monto', '% del Atraso']]
+        for tramo in data['tramos']:
+            tramos_data.append([
+                tramo['etiqueta'],
+                str(tramo['cuotas']),
+                f"${tramo['monto']:,.2f}",
+                f"{tramo['porcentaje']:.1f}%"
+            ])
+        
+        t_tramos = Table(tramos_data, colWidths=[2*inch, 1.2*inch, 1.6*inch, 1.2*inch])
+        t_tramos.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.darkred),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
+        ]))
+        story.append(t_tramos)
+        story.append(Spacer(1, 20))
+    
     # Tabla de atrasos
     story.append(Paragraph("DETALLE DE ATRASOS", subtitle_style))
     
@@ -4425,6 +6276,105 @@ def generar_pdf_reporte_atrasos(data):
     doc.build(story)
     return buffer
 
+def generar_pdf_reporte_pronostico(data):
+    """Genera PDF del reporte de pronóstico de cobros"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    story = []
+    
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=18,
+        spaceAfter=30,
+        alignment=TA_CENTER,
+        textColor=colors.darkgreen
+    )
+    
+    subtitle_style = ParagraphStyle(
+        'CustomSubtitle',
+        parent=styles['Heading2'],
+        fontSize=14,
+        spaceAfter=20,
+        textColor=colors.darkgreen
+    )
+    
+    # Agregar logo centrado al inicio
+    try:
+        logo_path = os.path.join('assets', 'logo.png')
+        if os.path.exists(logo_path):
+            logo_img = Image(logo_path, width=2*inch, height=1.5*inch)
+            logo_img.hAlign = 'CENTER'
+            story.append(logo_img)
+            story.append(Spacer(1, 20))
+    except:
+        pass  # Si no se pueden cargar las imágenes, continuar sin ellas
+    
+    # Título
+    story.append(Paragraph(data['titulo'], title_style))
+    story.append(Spacer(1, 20))
+    
+    # Información del reporte
+    ratios = data['ratios']
+    atrasado = data['atrasado']
+    info_data = [
+        ['Período:', f"{data['fecha_inicio'].strftime('%d/%m/%Y')} - {data['fecha_fin'].strftime('%d/%m/%Y')}"],
+        ['Cobro a tiempo (capital / interés):', f"{ratios['capital_a_tiempo']:.1%} / {ratios['interes_a_tiempo']:.1%}"],
+        ['Esperado por vencimientos:', f"${data['total_esperado_vencimientos']:,.2f}"],
+        ['Atrasado pendiente:', f"${atrasado['capital'] + atrasado['interes']:,.2f} ({atrasado['cuotas']} cuotas)"],
+        ['Esperado de atrasos:', f"${data['total_esperado_atrasos']:,.2f}"]
+    ]
+    
+    t = Table(info_data, colWidths=[2.5*inch, 3.5*inch])
+    t.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
+        ('TEXTCOLOR', (0, 0), (0, -1), colors.black),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]))
+    story.append(t)
+    story.append(Spacer(1, 20))
+    
+    # Tabla de cobros esperados
+    story.append(Paragraph("COBROS ESPERADOS POR " + ("SEMANA" if data['agrupacion'] == 'semana' else "DÍA"), subtitle_style))
+    
+    periodos_data = [['Fecha', 'Cuotas', 'Capital', 'Interés', 'Esperado Capital', 'Esperado Interés', 'Esperado Total']]
+    for periodo in data['periodos']:
+        periodos_data.append([
+            datetime.strptime(periodo['fecha'], '%Y-%m-%d').strftime('%d/%m/%Y'),
+            str(periodo['cuotas']),
+            f"${periodo['capital']:,.2f}",
+            f"${periodo['interes']:,.2f}",
+            f"${periodo['esperado_capital']:,.2f}",
+            f"${periodo['esperado_interes']:,.2f}",
+            f"${periodo['esperado_total']:,.2f}"
+        ])
+    
+    t2 = Table(periodos_data, colWidths=[0.9*inch, 0.6*inch, 1*inch, 1*inch, 1.1*inch, 1.1*inch, 1.1*inch])
+    t2.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.darkgreen),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ('FONTSIZE', (0, 1), (-1, -1), 7)
+    ]))
+    story.append(t2)
+    
+    # Pie de página
+    story.append(Spacer(1, 30))
+    story.append(Paragraph(f"Reporte generado el: {datetime.now().strftime('%d/%m/%Y %H:%M')}", 
+                          ParagraphStyle('Footer', parent=styles['Normal'], alignment=TA_CENTER)))
+    
+    doc.build(story)
+    return buffer
+
 # Mejorar las funciones de reportes para incluir descarga de PDF
 @app.route('/reportes/descargar-atrasos')
 @login_required
@@ -4515,6 +6465,9 @@ def ver_reporte(reporte_id):
         elif tipo == 'contabilidad':
             data = generar_reporte_contabilidad(fecha_inicio, fecha_fin)
             pdf_buffer = generar_pdf_reporte_contabilidad(data)
+        elif tipo == 'pronostico':
+            data = calcular_pronostico_cobros(fecha_inicio, fecha_fin, parametros.get('agrupacion', 'semana'))
+            pdf_buffer = generar_pdf_reporte_pronostico(data)
         else:
             return f"Tipo de reporte no válido: {tipo}", 400
         
@@ -4569,6 +6522,9 @@ def descargar_reporte_existente(reporte_id):
         elif tipo == 'contabilidad':
             data = generar_reporte_contabilidad(fecha_inicio, fecha_fin)
             pdf_buffer = generar_pdf_reporte_contabilidad(data)
+        elif tipo == 'pronostico':
+            data = calcular_pronostico_cobros(fecha_inicio, fecha_fin, parametros.get('agrupacion', 'semana'))
+            pdf_buffer = generar_pdf_reporte_pronostico(data)
         else:
             flash('Tipo de reporte no válido', 'error')
             return redirect(url_for('reportes'))
@@ -4873,6 +6829,7 @@ def api_cuota(cuota_id):
             'monto_interes': float(cuota.monto_interes) if cuota.monto_interes else 0.0,
             'fecha_vencimiento': cuota.fecha_vencimiento.strftime('%d/%m/%Y') if cuota.fecha_vencimiento else 'N/A',
             'estado': cuota.estado,
+            'atrasada': cuota_esta_atrasada(cuota),
             'prestamo_monto': float(cuota.prestamo.monto) if cuota.prestamo.monto else 0.0,
             'cliente_nombre': f"{cuota.prestamo.cliente.nombre} {cuota.prestamo.cliente.apellidos}",
             'cliente_correo': cuota.prestamo.cliente.correo,
@@ -4909,15 +6866,19 @@ def api_enviar_notificacion():
                 'error': 'ID de cuota y email son requeridos'
             }), 400
         
-        # Aquí se implementaría la lógica de envío real
-        # Por ahora solo simulamos el envío
+        cuota = db.session.get(Cuota, cuota_id)
+        if cuota is None:
+            return jsonify({'success': False, 'error': 'Cuota no encontrada'}), 404
         
-        return jsonify({
-            'success': True,
-            'message': 'Notificación enviada exitosamente'
-        })
+        cliente = cuota.prestamo.cliente
+        resultado, codigo = enviar_notificacion_atraso_registrada(
+            cuota, email, f"{cliente.nombre} {cliente.apellidos}",
+            datos_notificacion_atraso(cuota, datetime.now().date()), current_user.id
+        )
+        return jsonify(resultado), codigo
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({
             'success': False,
             'error': str(e)
@@ -5227,17 +7188,380 @@ def api_enviar_notificacion_brevo():
         if not cliente_email or not cliente_nombre or not datos_cuota:
             return jsonify({'success': False, 'error': 'Datos incompletos'}), 400
         
-        # Enviar email usando Brevo
-        resultado = enviar_notificacion_atraso_brevo(cliente_email, cliente_nombre, datos_cuota)
+        # La cuota se identifica por su id o por préstamo y número de cuota
+        cuota = None
+        if data.get('cuota_id'):
+            cuota = db.session.get(Cuota, data['cuota_id'])
+        elif str(datos_cuota.get('prestamo_id', '')).isdigit() and str(datos_cuota.get('cuota_numero', '')).isdigit():
+            cuota = Cuota.query.filter_by(prestamo_id=int(datos_cuota['prestamo_id']),
+                                          numero_cuota=int(datos_cuota['cuota_numero'])).first()
+        if cuota is None:
+            return jsonify({'success': False, 'error': 'Cuota no encontrada'}), 404
         
-        if resultado['success']:
-            return jsonify(resultado), 200
-        else:
-            return jsonify(resultado), 500
+        # Enviar email usando Brevo
+        resultado, codigo = enviar_notificacion_atraso_registrada(cuota, cliente_email, cliente_nombre,
+                                                                  datos_cuota, current_user.id)
+        return jsonify(resultado), codigo
             
     except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Registro de notificaciones: una por cuota, canal y día, y un máximo por cliente
+MOTIVOS_NOTIFICACION_OMITIDA = {
+    'duplicada': 'Esta cuota ya fue notificada hoy',
+    'limite_cliente': 'El cliente ya recibió el máximo de notificaciones permitido',
+    'no_atrasada': 'La cuota ya no está atrasada (se pagó después del corte de atrasos)'
+}
+
+def inicio_ventana_notificaciones(fecha_actual):
+    """Primer día que cuenta para el límite de notificaciones por cliente"""
+    return fecha_actual - timedelta(days=max(1, NOTIFICACIONES_VENTANA_DIAS) - 1)
+
+def reservar_notificacion(cuota, canal='email', usuario_id=None):
+    """Anota la notificación de hoy de una cuota antes de enviarla (confirma la transacción).
+
+    Returns:
+        tuple: (RegistroNotificacion, None) si se puede enviar, o (None, motivo) con
+        motivo 'duplicada' si la cuota ya se notificó hoy por el canal o 'limite_cliente'
+        si el cliente ya recibió NOTIFICACIONES_MAX_POR_CLIENTE en la ventana
+    """
+    fecha_actual = datetime.now().date()
+    cliente_id = cuota.prestamo.cliente_id
+    if RegistroNotificacion.query.filter_by(cuota_id=cuota.id, canal=canal, fecha=fecha_actual).first():
+        return None, 'duplicada'
+    if NOTIFICACIONES_MAX_POR_CLIENTE > 0 and RegistroNotificacion.query.filter(
+        RegistroNotificacion.cliente_id == cliente_id,
+        RegistroNotificacion.canal == canal,
+        RegistroNotificacion.fecha >= inicio_ventana_notificaciones(fecha_actual)
+    ).count() >= NOTIFICACIONES_MAX_POR_CLIENTE:
+        return None, 'limite_cliente'
+    
+    registro = RegistroNotificacion(cuota_id=cuota.id, cliente_id=cliente_id, canal=canal,
+                                    fecha=fecha_actual, usuario_id=usuario_id)
+    try:
+        db.session.add(registro)
+        db.session.commit()
+    except IntegrityError:
+        # Otra solicitud anotó la misma cuota al mismo tiempo
+        db.session.rollback()
+        return None, 'duplicada'
+    return registro, None
+
+def liberar_notificacion(registro):
+    """Borra la anotación de un envío que falló para poder reintentarlo hoy"""
+    db.session.delete(registro)
+    db.session.commit()
+
+def enviar_notificacion_atraso_registrada(cuota, cliente_email, cliente_nombre, datos_cuota, usuario_id):
+    """Envía una notificación de atraso por email si la cuota sigue atrasada, no se
+    notificó hoy y el cliente no llegó al límite.
+
+    Returns:
+        tuple: (dict con el resultado, código HTTP); las omitidas llevan 'omitida' y 'motivo'
+    """
+    # La página de atrasados muestra el corte de la mañana: la cuota pudo pagarse después
+    if not cuota_esta_atrasada(cuota):
+        return {'success': False, 'omitida': True, 'motivo': 'no_atrasada',
+                'error': MOTIVOS_NOTIFICACION_OMITIDA['no_atrasada']}, 409
+    registro, motivo = reservar_notificacion(cuota, 'email', usuario_id)
+    if motivo:
+        return {'success': False, 'omitida': True, 'motivo': motivo,
+                'error': MOTIVOS_NOTIFICACION_OMITIDA[motivo]}, 409
+    
+    resultado = enviar_notificacion_atraso_brevo(cliente_email, cliente_nombre, datos_cuota)
+    if not resultado['success']:
+        # Si el resultado es incierto el email pudo haberse enviado: la anotación se conserva
+        if not resultado.get('incierto'):
+            liberar_notificacion(registro)
+        return resultado, 500
+    return resultado, 200
+
+# Notificaciones de atraso en segundo plano
+def datos_notificacion_atraso(cuota, fecha_actual):
+    """Datos de la cuota que muestra la plantilla de la notificación de atraso"""
+    monto_total = float(cuota.monto_total or 0)
+    return {
+        'prestamo_id': cuota.prestamo_id,
+        'monto_prestamo': f"{float(cuota.prestamo.monto or 0):.2f}",
+        'cuota_numero': cuota.numero_cuota,
+        'fecha_vencimiento': cuota.fecha_vencimiento.strftime('%d/%m/%Y'),
+        'dias_atraso': (fecha_actual - cuota.fecha_vencimiento).days,
+        'monto_original': f"{monto_total:.2f}",
+        'interes_atraso': f"{monto_total * RECARGO_ATRASO_NOTIFICACION:.2f}",
+        'monto_total': f"{monto_total * (1 + RECARGO_ATRASO_NOTIFICACION):.2f}"
+    }
+
+def encolar_notificaciones_atraso(usuario_id, cuota_ids=None, prestamo_ids=None):
+    """Crea un trabajo con un correo pendiente por cada cuota atrasada seleccionada
+    (confirma la transacción). Sin selección se toman todas las cuotas atrasadas.
+    
+    Las cuotas ya notificadas hoy por email y las de clientes que llegaron al límite de
+    notificaciones no se encolan (se cuentan en duplicadas y limitadas); las demás quedan
+    anotadas en RegistroNotificacion junto con su correo.
+
+    Args:
+        usuario_id (int): Usuario que solicita el envío
+        cuota_ids (list): Cuotas a notificar
+        prestamo_ids (list): Préstamos cuyas cuotas atrasadas se notifican
+
+    Returns:
+        TrabajoNotificacion: El trabajo creado
+    """
+    fecha_actual = datetime.now().date()
+    condiciones = [_condicion_cuota_atrasada(fecha_actual)]
+    if cuota_ids is not None:
+        condiciones.append(Cuota.id.in_(cuota_ids))
+    if prestamo_ids is not None:
+        condiciones.append(Cuota.prestamo_id.in_(prestamo_ids))
+    
+    try:
+        return _encolar_notificaciones_atraso(usuario_id, condiciones, fecha_actual)
+    except IntegrityError:
+        # Otro envío anotó algunas de estas cuotas al mismo tiempo: con sus registros
+        # ya confirmados, el segundo intento las cuenta como duplicadas
+        db.session.rollback()
+        return _encolar_notificaciones_atraso(usuario_id, condiciones, fecha_actual)
+
+def _encolar_notificaciones_atraso(usuario_id, condiciones, fecha_actual):
+    trabajo = TrabajoNotificacion(usuario_id=usuario_id, total=0, omitidas=0, duplicadas=0, limitadas=0)
+    db.session.add(trabajo)
+    db.session.flush()
+    
+    # Cuotas ya notificadas hoy y notificaciones recientes de cada cliente, con una
+    # consulta para toda la selección
+    notificadas_hoy = {cuota_id for cuota_id, in db.session.query(RegistroNotificacion.cuota_id).filter(
+        RegistroNotificacion.canal == 'email',
+        RegistroNotificacion.fecha == fecha_actual,
+        RegistroNotificacion.cuota_id.in_(db.select(Cuota.id).where(*condiciones))
+    )}
+    por_cliente = {}
+    if NOTIFICACIONES_MAX_POR_CLIENTE > 0:
+        clientes = db.select(Prestamo.cliente_id).join(Cuota, Cuota.prestamo_id == Prestamo.id).where(*condiciones)
+        por_cliente = dict(db.session.query(RegistroNotificacion.cliente_id, db.func.count(RegistroNotificacion.id)).filter(
+            RegistroNotificacion.canal == 'email',
+            RegistroNotificacion.fecha >= inicio_ventana_notificaciones(fecha_actual),
+            RegistroNotificacion.cliente_id.in_(clientes)
+        ).group_by(RegistroNotificacion.cliente_id).all())
+    
+    correos = []
+    registros = []
+    consulta = Cuota.query.filter(*condiciones).options(
+        db.joinedload(Cuota.prestamo).joinedload(Prestamo.cliente)
+    )
+    # De más antigua a más reciente: con el límite por cliente se notifica su cuota más atrasada
+    for cuota in consulta.order_by(Cuota.fecha_vencimiento, Cuota.id).all():
+        cliente = cuota.prestamo.cliente
+        destinatario = (cliente.correo or '').strip()
+        if not destinatario:
+            trabajo.omitidas += 1
+            continue
+        if cuota.id in notificadas_hoy:
+            trabajo.duplicadas += 1
+            continue
+        if NOTIFICACIONES_MAX_POR_CLIENTE > 0 and por_cliente.get(cliente.id, 0) >= NOTIFICACIONES_MAX_POR_CLIENTE:
+            trabajo.limitadas += 1
+            continue
+        por_cliente[cliente.id] = por_cliente.get(cliente.id, 0) + 1
+        correos.append({
+            'trabajo_id': trabajo.id,
+            'cuota_id': cuota.id,
+            'destinatario': destinatario,
+            'nombre': f"{cliente.nombre} {cliente.apellidos}",
+            'datos': json.dumps(datos_notificacion_atraso(cuota, fecha_actual))
+        })
+        registros.append({
+            'cuota_id': cuota.id,
+            'cliente_id': cliente.id,
+            'canal': 'email',
+            'fecha': fecha_actual,
+            'trabajo_id': trabajo.id,
+            'usuario_id': usuario_id
+        })
+    
+    if correos:
+        db.session.execute(db.insert(RegistroNotificacion), registros)
+        db.session.execute(db.insert(CorreoSaliente), correos)
+    trabajo.total = len(correos)
+    db.session.commit()
+    return trabajo
+
+def reclamar_correos(limite):
+    """Marca como Enviando hasta `limite` correos listos para enviar y los devuelve.
+
+    El UPDATE vuelve a comprobar el estado, así que dos hilos o procesos que eligen
+    los mismos correos no los envían dos veces: cada uno se queda solo con los que
+    llevan su marca de reclamo.
+    """
+    ahora = datetime.utcnow()
+    disponible = db.or_(
+        db.and_(CorreoSaliente.estado == 'Pendiente', CorreoSaliente.proximo_intento <= ahora),
+        db.and_(CorreoSaliente.estado == 'Enviando',
+                CorreoSaliente.fecha_reclamo < ahora - timedelta(seconds=CORREOS_RECLAMO_VENCE_SEGUNDOS))
+    )
+    ids = [correo_id for correo_id, in db.session.query(CorreoSaliente.id).filter(disponible).order_by(
+        CorreoSaliente.proximo_intento, CorreoSaliente.id
+    ).limit(limite)]
+    if not ids:
+        db.session.rollback()
+        return []
+    
+    reclamo = uuid.uuid4().hex
+    db.session.execute(db.update(CorreoSaliente).where(CorreoSaliente.id.in_(ids), disponible).values(
+        estado='Enviando', reclamo=reclamo, fecha_reclamo=ahora
+    ))
+    db.session.commit()
+    return CorreoSaliente.query.filter(CorreoSaliente.id.in_(ids), CorreoSaliente.reclamo == reclamo).all()
+
+def enviar_correo_saliente(correo, servicio):
+    """Envía un correo reclamado y guarda el resultado (confirma la transacción)"""
+    resultado = servicio.enviar_notificacion_atraso(correo.destinatario, correo.nombre, json.loads(correo.datos))
+    guardar_resultado_correo(correo, resultado)
+    db.session.commit()
+    return resultado
+
+def enviar_correos_salientes_lote(correos, servicio):
+    """Envía varios correos reclamados con la misma plantilla en llamadas por lote
+    y guarda el resultado de cada destinatario (confirma la transacción)"""
+    resultados = servicio.enviar_notificaciones_atraso_lote([{
+        'email': correo.destinatario,
+        'nombre': correo.nombre,
+        'datos_cuota': json.loads(correo.datos)
+    } for correo in correos])
+    rechazado = not resultados[0].get('success') and not resultados[0].get('reintentable')
+    if len(correos) > 1 and rechazado and not resultados[0].get('incierto'):
+        # Un destinatario inválido hace rechazar todo el lote: se envían uno por uno
+        # para que el error quede solo en el que corresponde. Si el resultado es incierto
+        # el lote pudo haberse enviado y todos quedan como Incierto sin reenviarse
+        resultados = []
+        for correo in correos:
+            limitador_correos.esperar()
+            resultados.append(enviar_correo_saliente(correo, servicio))
+        return resultados
+    for correo, resultado in zip(correos, resultados):
+        guardar_resultado_correo(correo, resultado)
+    db.session.commit()
+    return resultados
+
+def guardar_resultado_correo(correo, resultado):
+    """Marca el correo como enviado, pendiente de reintento, fallido o incierto según el resultado"""
+    correo.intentos = (correo.intentos or 0) + 1
+    correo.reclamo = None
+    if resultado.get('success'):
+        correo.estado = 'Enviado'
+        correo.message_id = resultado.get('message_id')
+        correo.fecha_envio = datetime.utcnow()
+        correo.ultimo_error = None
+    else:
+        correo.ultimo_error = resultado.get('error')
+        if resultado.get('incierto'):
+            # Brevo pudo haberlo enviado: no se reintenta y la cuota sigue anotada como notificada
+            correo.estado = 'Incierto'
+        elif resultado.get('reintentable') and correo.intentos < CORREOS_MAX_INTENTOS:
+            # Si Brevo pidió esperar más (Retry-After o circuito abierto), se respeta
+            espera = max(espera_reintento(correo.intentos, CORREOS_ESPERA_REINTENTO_SEGUNDOS),
+                         resultado.get('reintentar_en') or 0)
+            correo.estado = 'Pendiente'
+            correo.proximo_intento = datetime.utcnow() + timedelta(seconds=espera)
+        else:
+            correo.estado = 'Fallido'
+            # La cuota se puede volver a notificar hoy
+            if correo.trabajo_id:
+                RegistroNotificacion.query.filter_by(
+                    trabajo_id=correo.trabajo_id, cuota_id=correo.cuota_id
+                ).delete(synchronize_session=False)
+
+limitador_correos = LimitadorTasa(CORREOS_POR_SEGUNDO)
+
+def despachar_correos_pendientes():
+    """Reclama un grupo de correos y los envía respetando el límite por segundo.
+    Devuelve True si había correos para enviar (False también sin servicio de Brevo)."""
+    with app.app_context():
+        try:
+            # Sin servicio no se reclama nada: los correos siguen Pendiente y el hilo
+            # espera la pausa del pool antes de volver a intentar
+            servicio = obtener_servicio_brevo()
+            if servicio is None:
+                return False
+            correos = reclamar_correos(CORREOS_POR_RECLAMO)
+            if not correos:
+                return False
+            if CORREOS_ENVIO_POR_LOTE:
+                for inicio in range(0, len(correos), servicio.versiones_por_lote):
+                    limitador_correos.esperar()
+                    enviar_correos_salientes_lote(correos[inicio:inicio + servicio.versiones_por_lote], servicio)
+            else:
+                for correo in correos:
+                    limitador_correos.esperar()
+                    enviar_correo_saliente(correo, servicio)
+            return True
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+pool_correos = PoolDespacho(despachar_correos_pendientes, hilos=CORREOS_HILOS, nombre='correos')
+
+def iniciar_despacho_correos():
+    """Arranca (si hace falta) los hilos de despacho de este proceso y los despierta"""
+    if CORREOS_DESPACHO_EN_PROCESO:
+        pool_correos.iniciar()
+        pool_correos.avisar()
+
+def _leer_ids(valor):
+    """Lista de ids enteros de un campo JSON, o None si no se envió"""
+    if valor is None:
+        return None
+    if not isinstance(valor, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in valor):
+        raise ValueError('Los ids deben ser una lista de números enteros')
+    return valor
+
+@app.route('/api/notificaciones-atraso/trabajos', methods=['POST'])
+@login_required
+def crear_trabajo_notificaciones():
+    """Encola una notificación por cada cuota atrasada seleccionada y devuelve el trabajo"""
+    data = request.get_json(silent=True) or {}
+    try:
+        cuota_ids = _leer_ids(data.get('cuota_ids'))
+        prestamo_ids = _leer_ids(data.get('prestamo_ids'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        trabajo = encolar_notificaciones_atraso(current_user.id, cuota_ids, prestamo_ids)
+        if trabajo.total:
+            iniciar_despacho_correos()
+        return jsonify({'success': True, 'trabajo': trabajo.progreso()})
+    except Exception as e:
+        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/notificaciones-atraso/trabajos/<int:trabajo_id>')
+@login_required
+def progreso_trabajo_notificaciones(trabajo_id):
+    """Avance del envío de un trabajo de notificaciones"""
+    trabajo = TrabajoNotificacion.query.get_or_404(trabajo_id)
+    progreso = trabajo.progreso()
+    if not progreso['terminado']:
+        # Si el proceso que lo encoló se reinició, este retoma los pendientes
+        iniciar_despacho_correos()
+    return jsonify({'success': True, 'trabajo': progreso})
+
+@app.route('/api/brevo/metricas')
+@login_required
+@admin_required
+def api_metricas_brevo():
+    """Latencia y resultados de las llamadas a Brevo y estado del circuito (de este proceso)"""
+    servicio = obtener_servicio_brevo()
+    if servicio is None:
+        return jsonify({'success': False, 'error': 'Servicio no disponible'}), 503
+    return jsonify({
+        'success': True,
+        'circuito': servicio.circuito.estado,
+        'metricas': servicio.metricas.resumen()
+    })
+
 @app.route('/pagos/<int:pago_id>/enviar-recibo')
 @login_required
 def enviar_recibo_pago(pago_id):
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para comparar la generación de cuotas
+Mide, para cada frecuencia, el método anterior (un objeto Cuota por cuota
+agregado a la sesión en un ciclo) contra generar_cuotas() (cálculo puro +
+un solo INSERT por lotes). Usa una base SQLite temporal salvo que se defina
+BENCHMARK_DATABASE_URL, así que no toca los datos reales.
+
+Uso: python benchmark_amortizacion.py [repeticiones]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+# Base de datos del benchmark (antes de importar la app)
+archivo_db = os.path.join(tempfile.mkdtemp(), 'benchmark_amortizacion.db')
+os.environ['DATABASE_URL'] = os.getenv('BENCHMARK_DATABASE_URL', f'sqlite:///{archivo_db}')
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, Cliente, TerminoCliente, Prestamo, Cuota, generar_cuotas
+from amortizacion import FRECUENCIAS, calcular_cuotas
+
+def generar_cuotas_ciclo(prestamo):
+    """Método anterior: un objeto Cuota por cuota, agregado uno a uno a la sesión"""
+    Cuota.query.filter_by(prestamo_id=prestamo.id).delete()
+    for fila in calcular_cuotas(prestamo.monto, prestamo.tasa_interes, prestamo.plazo_meses,
+                                prestamo.frecuencia, prestamo.fecha_primera_cuota):
+        db.session.add(Cuota(prestamo_id=prestamo.id, **fila))
+    db.session.commit()
+
+def medir(funcion, prestamo, repeticiones):
+    """Milisegundos promedio por llamada"""
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion(prestamo)
+    return (time.perf_counter() - inicio) * 1000 / repeticiones
+
+def benchmark(repeticiones):
+    """Corre la comparación para las cinco frecuencias con un préstamo de 12 meses"""
+    with app.app_context():
+        db.create_all()
+        print(f"   Base de datos: {db.engine.url.render_as_string(hide_password=True)}\n")
+
+        cliente = Cliente(nombre='Benchmark', apellidos='Amortización', documento=f'BENCH-{time.time_ns()}',
+                          nacionalidad='Dominicana', sexo='M', estado_civil='Soltero', telefono_principal='0',
+                          correo='benchmark@example.com', direccion='-', provincia='-', municipio='-', sector='-',
+                          ocupacion='-', ingresos=0, situacion_laboral='-', lugar_trabajo='-', direccion_trabajo='-')
+        db.session.add(cliente)
+        db.session.commit()
+
+        print(f"{'Frecuencia':<24}{'Cuotas':>8}{'Ciclo (ms)':>14}{'Lote (ms)':>14}{'Mejora':>10}")
+        prestamos = []
+        for frecuencia in FRECUENCIAS:
+            prestamo = Prestamo(cliente_id=cliente.id, monto=120000, tasa_interes=5, plazo_meses=12,
+                                frecuencia=frecuencia, fecha_primera_cuota=date.today())
+            db.session.add(prestamo)
+            db.session.commit()
+            prestamos.append(prestamo)
+
+            # Una pasada de calentamiento de cada método
+            generar_cuotas_ciclo(prestamo)
+            generar_cuotas(prestamo)
+
+            ciclo = medir(generar_cuotas_ciclo, prestamo, repeticiones)
+            lote = medir(generar_cuotas, prestamo, repeticiones)
+            cuotas = Cuota.query.filter_by(prestamo_id=prestamo.id).count()
+            print(f"{frecuencia:<24}{cuotas:>8}{ciclo:>14.2f}{lote:>14.2f}{ciclo / lote:>9.1f}x")
+
+        # Dejar la base como estaba si no es la temporal
+        for prestamo in prestamos:
+            Cuota.query.filter_by(prestamo_id=prestamo.id).delete()
+            db.session.delete(prestamo)
+        TerminoCliente.query.filter_by(cliente_id=cliente.id).delete()
+        db.session.delete(cliente)
+        db.session.commit()
+
+if __name__ == "__main__":
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f"🚀 Generación de cuotas: {repeticiones} repeticiones por frecuencia")
+    benchmark(repeticiones)
+    print("\n✅ Benchmark terminado")
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para comparar la generación del HTML de los emails
+Mide el costo de generar 1,000 emails con el método anterior (el documento completo,
+estilos incluidos, armado con un f-string en cada llamada) contra las plantillas de
+plantillas_correo.py (carcasa renderizada una vez por proceso y solo el fragmento de
+cada cliente por email), y el costo por cliente del envío por lote, donde la
+plantilla se genera una sola vez y por cliente solo se arman sus parámetros.
+También comprueba que ambos métodos generan el mismo texto. No envía emails ni
+usa la base de datos.
+
+Uso: python benchmark_plantillas_correo.py [emails]
+"""
+
+import os
+import re
+import sys
+import time
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from config_brevo import BrevoEmailService
+
+# Métodos anteriores, copiados de config_brevo.py para comparar
+
+def html_recibo_pago_fstring(cliente_nombre, datos_pago):
+    """Método anterior: recibo de pago armado con un f-string en cada llamada"""
+    return f"""
+    <!DOCTYPE html>
+    <html lang="es">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Recibo de Pago - {datos_pago['pago_id']}</title>
+        <style>
+            body {{
+                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                line-height: 1.6;
+                color: #333;
+                max-width: 600px;
+                margin: 0 auto;
+                padding: 20px;
+                background-color: #f8f9fa;
+            }}
+            .email-container {{
+                background: white;
+                border-radius: 15px;
+                box-shadow: 0 4px 20px rgba(0,0,0,0.1);
+                overflow: hidden;
+            }}
+            .header {{
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                color: white;
+                padding: 30px 20px;
+                text-align: center;
+            }}
+            .company-name {{
+                font-size: 24px;
+                font-weight: bold;
+                margin-bottom: 5px;
+            }}
+            .company-slogan {{
+                font-size: 14px;
+                opacity: 0.9;
+            }}
+            .content {{
+                padding: 30px 25px;
+            }}
+            .section-title {{
+                color: #667eea;
+                font-size: 18px;
+                font-weight: bold;
+                margin-bottom: 20px;
+                border-bottom: 2px solid #e9ecef;
+                padding-bottom: 10px;
+            }}
+            .info-row {{
+                display: flex;
+                justify-content: space-between;
+                margin-bottom: 15px;
+                align-items: center;
+            }}
+            .info-label {{
+                font-weight: 600;
+                color: #495057;
+            }}
+            .info-value {{
+                font-weight: 500;
+                color: #212529;
+            }}
+            .amount-highlight {{
+                font-size: 20px;
+                font-weight: bold;
+                color: #28a745;
+            }}
+            .separator {{
+                border-top: 2px dotted #dee2e6;
+                margin: 25px 0;
+            }}
+            .footer {{
+                background: #f8f9fa;
+                padding: 20px 25px;
+                text-align: center;
+                border-top: 1px solid #e9ecef;
+            }}
+            .contact-info {{
+                font-size: 14px;
+                color: #6c757d;
+                margin-bottom: 10px;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="email-container">
+            <div class="header">
+                <div class="company-name">WANDY SOLUCIONES Y PRÉSTAMOS</div>
+                <div class="company-slogan">Soluciones financieras a tu alcance</div>
+            </div>
+            
+            <div class="content">
+                <div style="text-align: center; margin-bottom: 25px;">
+                    <h2 style="color: #667eea;">Recibo de Pago #{datos_pago['pago_id']}</h2>
+                    <p style="color: #6c757d;">Fecha de Emisión: {datos_pago['fecha_pago']}</p>
+                </div>
+                
+                <div class="section-title">Información del Cliente</div>
+                <div class="info-row">
+                    <span class="info-label">Cliente:</span>
+                    <span class="info-value">{cliente_nombre}</span>
+                </div>
+                <div class="info-row">
+                    <span class="info-label">Préstamo:</span>
+                    <span class="info-value">#{datos_pago['prestamo_id']}</span>
+                </div>
+                <div class="info-row">
+                    <span class="info-label">Cuota:</span>
+                    <span class="info-value">#{datos_pago['cuota_numero']}</span>
+                </div>
+                
+                <div class="separator"></div>
+                
+                <div class="section-title">Detalles del Pago</div>
+                <div class="info-row">
+                    <span class="info-label">Monto Total:</span>
+                    <span class="info-value amount-highlight">RD${datos_pago['monto_total']}</span>
+                </div>
+                <div class="info-row">
+                    <span class="info-label">Capital:</span>
+                    <span class="info-value">RD${datos_pago['monto_capital']}</span>
+                </div>
+                <div class="info-row">
+                    <span class="info-label">Intereses:</span>
+                    <span class="info-value">RD${datos_pago['monto_interes']}</span>
+                </div>
+                <div class="info-row">
+                    <span class="info-label">Fecha de Pago:</span>
+                    <span class="info-value">{datos_pago['fecha_pago']}</span>
+                </div>
+                
+                <div class="separator"></div>
+                
+                <p style="text-align: center; color: #28a745; font-weight: bold; font-size: 18px;">
+                    ✅ Pago Confirmado
+                </p>
+                
+                <p style="text-align: center; color: #6c757d; font-size: 14px;">
+                    Este es un recibo oficial de Wandy Soluciones y Préstamos.<br>
+                    Por favor, guárdelo para sus registros.
+                </p>
+            </div>
+            
+            <div class="footer">
+                <div class="contact-info">
+                    <strong>Wandy Soluciones y Préstamos</strong><br>
+                    Soluciones financieras a tu alcance
+                </div>
+                
+                <div class="contact-info">
+                    📞 Tel: +809 326-3633<br>
+                    📧 Email: info@wandysoluciones.com<br>
+                    🌐 Web: www.wandysoluciones.com
+                </div>
+                
+                <div style="margin-top: 20px; font-size: 12px; color: #adb5bd;">
+                    Este email fue enviado automáticamente desde el sistema de Wandy Soluciones y Préstamos.
+                </div>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+def html_notificacion_atraso_fstring(cliente_nombre, datos_cuota):
+    """Método anterior: notificación de atraso armado con un f-string en cada llamada"""
+    return f"""
+    <!DOCTYPE html>
+    <html lang="es">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Recordatorio de Pago Atrasado</title>
+        <style>
+            body {{
+                font-family: 'arial, helvetica, sans-serif';
+                line-height: 1.5;
+                color: #3b3f44;
+                font-size: 16px;
+                max-width: 600px;
+                margin: 0 auto;
+                padding: 20px;
+                background-color: #f8f9fa;
+            }}
+            
+            .email-container {{
+                background: white;
+                border-radius: 15px;
+                box-shadow: 0 4px 20px rgba(0,0,0,0.1);
+                overflow: hidden;
+            }}
+            
+            .header {{
+                background: linear-gradient(135deg, #dc3545 0%, #c82333 100%);
+                color: white;
+                padding: 30px 20px;
+                text-align: center;
+            }}
+            
+            .company-name {{
+                font-size: 24px;
+                font-weight: bold;
+                margin-bottom: 5px;
+            }}
+            
+            .company-slogan {{
+                font-size: 14px;
+                opacity: 0.9;
+            }}
+            
+            .content {{
+                padding: 30px 25px;
+            }}
+            
+            .section-title {{
+                color: #1F2D3D;
+                font-family: 'arial, helvetica, sans-serif';
+                font-size: 18px;
+                font-weight: 400;
+                margin-bottom: 20px;
+                border-bottom: 2px solid #e9ecef;
+                padding-bottom: 10px;
+            }}
+            
+            .info-row {{
+                display: flex;
+                justify-content: space-between;
+                margin-bottom: 15px;
+                align-items: center;
+            }}
+            
+            .info-label {{
+                font-weight: 600;
+                color: #495057;
+            }}
+            
+            .info-value {{
+                font-weight: 500;
+                color: #212529;
+            }}
+            
+            .amount-highlight {{
+                font-size: 20px;
+                font-weight: bold;
+                color: #dc3545;
+            }}
+            
+            .separator {{
+                border-top: 2px dotted #dee2e6;
+                margin: 25px 0;
+            }}
+            
+            .alert {{
+                background: #fff3cd;
+                border: 1px solid #ffeaa7;
+                border-radius: 10px;
+                padding: 20px;
+                margin: 20px 0;
+                border-left: 4px solid #f39c12;
+            }}
+            
+            .help-box {{
+                background: #d4edda;
+                border: 1px solid #c3e6cb;
+                border-radius: 10px;
+                padding: 20px;
+                margin: 20px 0;
+            }}
+            
+            .footer {{
+                background: #f8f9fa;
+                padding: 20px 25px;
+                text-align: center;
+                border-top: 1px solid #e9ecef;
+            }}
+            
+            .contact-info {{
+                font-size: 14px;
+                color: #6c757d;
+                margin-bottom: 10px;
+            }}
+            
+            .social-links {{
+                margin-top: 15px;
+            }}
+            
+            .social-links a {{
+                color: #0092ff;
+                text-decoration: underline;
+                font-family: 'arial, helvetica, sans-serif';
+                font-size: 16px;
+                margin: 0 10px;
+            }}
+            
+            .social-links a:hover {{
+                text-decoration: underline;
+            }}
+            
+            .view-in-browser {{
+                text-align: center;
+                padding: 5px 30px;
+                margin-bottom: 10px;
+            }}
+            
+            .view-in-browser a {{
+                color: #858588;
+                font-family: 'arial, helvetica, sans-serif';
+                font-size: 12px;
+                text-decoration: underline;
+            }}
+            
+            .notification-title {{
+                text-align: center;
+                font-size: 20px;
+                color: #dc3545;
+                margin-bottom: 25px;
+                font-weight: bold;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="email-container">
+            <div class="view-in-browser">
+                <p><a href="#">Ver en navegador</a></p>
+            </div>
+            <div class="header">
+                <img style="width: 150px; height: auto; display: block; margin: 0 auto 10px;" src="https://i.imgur.com/Ui2SzsR.jpg" alt="Logo de Wandy Soluciones y Préstamos">
+                <div class="company-name">WANDY SOLUCIONES Y PRÉSTAMOS</div>
+                <div class="company-slogan">Soluciones financieras a tu alcance</div>
+            </div>
+            
+            <div class="content">
+                <div class="notification-title">
+                    ⚠️ Recordatorio de Pago Atrasado
+                </div>
+                
+                <div class="alert">
+                    <p style="margin: 0; font-size: 16px;">
+                        <strong>Estimado/a {cliente_nombre},</strong><br><br>
+                        Le recordamos que tiene una cuota atrasada que requiere su atención inmediata.
+                    </p>
+                </div>
+                
+                <div class="section-title">Detalles de la Cuota Atrasada</div>
+                
+                <div class="info-row">
+                    <span class="info-label">Monto del Préstamo:</span>
+                    <span class="info-value">RD${datos_cuota.get('monto_prestamo', '0.00')}</span>
+                </div>
+                
+                <div class="info-row">
+                    <span class="info-label">Cuota:</span>
+                    <span class="info-value">{datos_cuota.get('cuota_numero', 'N/A')}</span>
+                </div>
+                
+                <div class="info-row">
+                    <span class="info-label">Fecha de Vencimiento:</span>
+                    <span class="info-value">{datos_cuota.get('fecha_vencimiento', 'N/A')}</span>
+                </div>
+                
+                <div class="separator"></div>
+                
+                <div class="section-title">Información Financiera</div>
+                
+                <div class="info-row">
+                    <span class="info-label">Monto Original:</span>
+                    <span class="info-value">RD${datos_cuota.get('monto_original', '0.00')}</span>
+                </div>
+                
+                <div class="info-row">
+                    <span class="info-label">Interés por Atraso:</span>
+                    <span class="info-value amount-highlight">RD${datos_cuota.get('interes_atraso', '0.00')}</span>
+                </div>
+                
+                <div class="info-row">
+                    <span class="info-label">Monto Total a Pagar:</span>
+                    <span class="info-value amount-highlight">RD${datos_cuota.get('monto_total', '0.00')}</span>
+                </div>
+                
+                <div class="separator"></div>
+                
+                <div class="help-box">
+                    <h4 style="color: #155724; margin-top: 0;">📞 ¿Necesita Ayuda?</h4>
+                    <p style="color: #155724; margin-bottom: 0;">
+                        Si tiene alguna pregunta o necesita hacer un arreglo de pago, 
+                        no dude en contactarnos. Estamos aquí para ayudarle.
+                    </p>
+                </div>
+                
+                <p style="text-align: center; color: #6c757d; font-size: 14px;">
+                    Por favor, regularice su pago lo antes posible para evitar cargos adicionales.
+                </p>
+            </div>
+            
+            <div class="footer">
+                <div class="contact-info">
+                    <strong>Wandy Soluciones y Préstamos</strong><br>
+                    Soluciones financieras a tu alcance
+                </div>
+                
+                <div class="contact-info">
+                    📞 Tel: +809 326-3633<br>
+                    📧 Email: info@wandysoluciones.com<br>
+                    🌐 Web: www.wandysoluciones.com
+                </div>
+                
+                <div class="social-links">
+                    <a href="https://www.facebook.com/share/1B3zAZmT11/?mibextid=wwXIfr">Facebook</a> |
+                    <a href="https://www.instagram.com/wandy_soluciones?igsh=MWM5Ynl2cG41eTc3aw%3D%3D&utm_source=">Instagram</a> |
+                    <a href="https://wa.me/18093263633">WhatsApp</a>
+                </div>
+                
+                <div style="margin-top: 20px; font-size: 12px; color: #adb5bd;">
+                    Este email fue enviado automáticamente desde el sistema de Wandy Soluciones y Préstamos.<br>
+                    Si tiene alguna pregunta, por favor contáctenos directamente.
+                </div>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+def datos_recibo(numero):
+    return (f'Cliente {numero} Pérez', {
+        'pago_id': 1000 + numero, 'fecha_pago': '15/10/2026', 'prestamo_id': 500 + numero,
+        'cuota_numero': numero % 12 + 1, 'monto_total': f'{2500 + numero:,.2f}',
+        'monto_capital': f'{2000 + numero:,.2f}', 'monto_interes': '500.00'
+    })
+
+def datos_atraso(numero):
+    return (f'Cliente {numero} Pérez', {
+        'monto_prestamo': f'{50000 + numero:,.2f}', 'cuota_numero': numero % 12 + 1,
+        'fecha_vencimiento': '01/10/2026', 'monto_original': '4,500.00',
+        'interes_atraso': '225.00', 'monto_total': '4,725.00'
+    })
+
+def texto_visible(html):
+    """Texto del cuerpo del email sin etiquetas ni espacios repetidos"""
+    cuerpo = html[html.index('<body>'):]
+    return ' '.join(re.sub(r'<[^>]+>', ' ', cuerpo).split())
+
+def medir(funcion, datos, emails):
+    """Milisegundos para generar `emails` emails"""
+    inicio = time.perf_counter()
+    for numero in range(emails):
+        funcion(*datos(numero))
+    return (time.perf_counter() - inicio) * 1000
+
+def benchmark(emails):
+    servicio = BrevoEmailService()
+    casos = [
+        ('Recibo de pago', html_recibo_pago_fstring, servicio._generar_html_recibo_pago, datos_recibo),
+        ('Notificación de atraso', html_notificacion_atraso_fstring,
+         servicio._generar_html_notificacion_atraso, datos_atraso),
+    ]
+
+    errores = []
+    print(f"{'Email':<26}{'Primero (ms)':>14}{'f-string (ms)':>15}{'Plantilla (ms)':>16}{'Relación':>10}")
+    for nombre, anterior, plantilla, datos in casos:
+        # El primer email de cada tipo compila sus plantillas y renderiza la carcasa
+        inicio = time.perf_counter()
+        nuevo = plantilla(*datos(0))
+        primero = (time.perf_counter() - inicio) * 1000
+        if texto_visible(nuevo) != texto_visible(anterior(*datos(0))):
+            errores.append(f'{nombre}: el texto no coincide con el método anterior')
+
+        tiempo_anterior = medir(anterior, datos, emails)
+        tiempo_plantilla = medir(plantilla, datos, emails)
+        print(f"{nombre:<26}{primero:>14.2f}{tiempo_anterior:>15.2f}{tiempo_plantilla:>16.2f}"
+              f"{tiempo_plantilla / tiempo_anterior:>9.1f}x")
+
+    # En el envío por lote la plantilla se genera una vez y por cliente solo se arman sus parámetros
+    servicio._plantilla_notificacion_atraso()
+    tiempo_lote = medir(servicio._parametros_notificacion_atraso, datos_atraso, emails)
+    print(f"{'Atraso por lote (params)':<26}{'':>14}{'':>15}{tiempo_lote:>16.2f}")
+
+    for error in errores:
+        print(f"❌ {error}")
+    return not errores
+
+if __name__ == "__main__":
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print(f"🚀 Generando {emails:,} emails de cada tipo...\n")
+    if benchmark(emails):
+        print("\n🎉 ¡Benchmark terminado!")
+    else:
+        print("\n💥 Las plantillas no generan el mismo contenido")
+        sys.exit(1)
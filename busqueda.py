@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Normalización de textos para el buscador de clientes
+Convierte nombres y documentos en términos en minúsculas y sin acentos,
+que son los que se guardan en el índice de búsqueda y los que se comparan
+contra lo que escribe el usuario
+"""
+
+import re
+import unicodedata
+
+# Largo máximo de un término (coincide con la columna del índice)
+LARGO_MAXIMO_TERMINO = 100
+
+# Cantidad máxima de palabras que se toman de una búsqueda
+MAXIMO_TERMINOS_BUSQUEDA = 5
+
+def normalizar_texto(texto):
+    """Pasa el texto a minúsculas, quita acentos y deja solo letras, números y espacios
+
+    Ejemplo: 'José  Pérez-Núñez' -> 'jose perez nunez'
+    """
+    if not texto:
+        return ''
+    descompuesto = unicodedata.normalize('NFKD', str(texto))
+    sin_acentos = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', sin_acentos.lower()).split())
+
+def compactar_documento(documento):
+    """Documento sin guiones ni espacios: '001-1234567-8' -> '00112345678'"""
+    return normalizar_texto(documento).replace(' ', '')[:LARGO_MAXIMO_TERMINO]
+
+def terminos_texto(*textos):
+    """Palabras distintas y normalizadas de uno o varios textos, en orden de aparición"""
+    terminos = []
+    for texto in textos:
+        for termino in normalizar_texto(texto).split():
+            termino = termino[:LARGO_MAXIMO_TERMINO]
+            if termino not in terminos:
+                terminos.append(termino)
+    return terminos
+
+def terminos_busqueda(consulta):
+    """Términos de lo que escribió el usuario
+
+    Returns:
+        tuple: (palabras, documento) donde documento es la consulta compactada
+        si contiene números (posible cédula o pasaporte) o None
+    """
+    palabras = terminos_texto(consulta)[:MAXIMO_TERMINOS_BUSQUEDA]
+    documento = compactar_documento(consulta)
+    if not re.search(r'\d', documento):
+        documento = None
+    return palabras, documento
@@ -6,6 +6,14 @@ Sistema de envío de emails para Wandy Soluciones y Préstamos
 import requests
 import json
 import os
+import threading
+import time
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from plantillas_correo import plantillas_correo
 from dotenv import load_dotenv
 import logging
 
@@ -16,6 +24,132 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def segundos_retry_after(valor):
+    """Segundos que pide esperar un encabezado Retry-After (número o fecha HTTP), o None"""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def solicitud_no_enviada(error):
+    """True si la llamada falló antes de enviar la solicitud (no se resolvió el nombre o no
+    se pudo abrir la conexión): repetirla no puede duplicar el email. Un tiempo de lectura
+    agotado o una conexión cortada después de enviar no cuentan: Brevo pudo haberlo recibido."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        causa = error.args[0] if error.args else None
+        # urllib3 envuelve la causa en MaxRetryError; NewConnectionError y NameResolutionError
+        # son subclases de ConnectTimeoutError
+        return isinstance(getattr(causa, 'reason', causa), ConnectTimeoutError)
+    return False
+
+class InterruptorCircuito:
+    """Deja de llamar a Brevo después de `fallos` errores seguidos (sin conexión, 429 o 5xx).
+
+    Abierto: las llamadas se rechazan sin salir a la red durante `espera` segundos.
+    Luego pasa a semiabierto y deja pasar una sola llamada de prueba: si responde
+    bien se cierra, si falla se abre otra vez.
+    """
+    
+    def __init__(self, fallos=5, espera=30):
+        self.fallos = fallos
+        self.espera = espera
+        self.estado = 'cerrado'
+        self._fallos_seguidos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+    
+    def permitir(self):
+        """0 si la llamada puede hacerse; si no, segundos sugeridos antes de volver a intentar"""
+        with self._lock:
+            if self.estado == 'cerrado':
+                return 0
+            restante = self._abierto_desde + self.espera - time.monotonic()
+            if self.estado == 'abierto' and restante > 0:
+                return restante
+            if self._prueba_en_curso:
+                return 1.0
+            self.estado = 'semiabierto'
+            self._prueba_en_curso = True
+            return 0
+    
+    def registrar_exito(self):
+        with self._lock:
+            if self.estado != 'cerrado':
+                logger.info("✅ Circuito de Brevo cerrado")
+            self.estado = 'cerrado'
+            self._fallos_seguidos = 0
+            self._prueba_en_curso = False
+    
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos_seguidos += 1
+            self._prueba_en_curso = False
+            if self.estado == 'semiabierto' or self._fallos_seguidos >= self.fallos:
+                if self.estado != 'abierto':
+                    logger.error(f"❌ Circuito de Brevo abierto por {self.espera:g} s "
+                                 f"después de {self._fallos_seguidos} fallos seguidos")
+                self.estado = 'abierto'
+                self._abierto_desde = time.monotonic()
+
+class MetricasEnvio:
+    """Latencia y resultado de las llamadas a la API de Brevo de este proceso"""
+    
+    def __init__(self, muestras=1000):
+        self._lock = threading.Lock()
+        self.llamadas = 0
+        self.rechazadas = 0  # No salieron a la red por el circuito abierto
+        self.por_resultado = Counter()  # Código HTTP o 'conexion'
+        self.latencia_total = 0.0
+        self.latencia_maxima = 0.0
+        self._recientes = deque(maxlen=muestras)
+    
+    def registrar(self, resultado, segundos):
+        with self._lock:
+            self.llamadas += 1
+            self.por_resultado[str(resultado)] += 1
+            self.latencia_total += segundos
+            self.latencia_maxima = max(self.latencia_maxima, segundos)
+            self._recientes.append(segundos)
+    
+    def registrar_rechazo(self):
+        with self._lock:
+            self.rechazadas += 1
+    
+    def resumen(self):
+        """Totales y latencias en milisegundos (percentiles de las últimas llamadas)"""
+        with self._lock:
+            recientes = sorted(self._recientes)
+            percentil = lambda p: round(recientes[min(len(recientes) - 1, int(len(recientes) * p))] * 1000, 1) \
+                if recientes else None
+            return {
+                'llamadas': self.llamadas,
+                'rechazadas_por_circuito': self.rechazadas,
+                'por_resultado': dict(self.por_resultado),
+                'latencia_promedio_ms': round(self.latencia_total / self.llamadas * 1000, 1) if self.llamadas else None,
+                'latencia_p50_ms': percentil(0.5),
+                'latencia_p95_ms': percentil(0.95),
+                'latencia_maxima_ms': round(self.latencia_maxima * 1000, 1) if self.llamadas else None
+            }
+
+# Datos de la cuota que muestra la notificación de atraso y su valor si falta
+CAMPOS_NOTIFICACION_ATRASO = {
+    'monto_prestamo': '0.00',
+    'cuota_numero': 'N/A',
+    'fecha_vencimiento': 'N/A',
+    'monto_original': '0.00',
+    'interes_atraso': '0.00',
+    'monto_total': '0.00'
+}
+
 class BrevoEmailService:
     """Servicio de envío de emails usando Brevo API REST"""
     
@@ -25,7 +159,32 @@ class BrevoEmailService:
         self.sender_email = os.getenv('BREVO_SENDER_EMAIL', 'wandysoluciones@gmail.com')
         self.sender_name = os.getenv('BREVO_SENDER_NAME', 'Wandy Soluciones y Préstamos')
         self.reply_to = os.getenv('BREVO_REPLY_TO', 'wandysoluciones@gmail.com')
-        self.api_url = "https://api.brevo.com/v3/smtp/email"
+        # Se puede apuntar a un servidor local de prueba en lugar de la API de Brevo
+        self.api_url = os.getenv('BREVO_API_URL', "https://api.brevo.com/v3/smtp/email")
+        # (conexión, lectura): una llamada colgada no retiene el hilo indefinidamente
+        self.timeout = (float(os.getenv('BREVO_TIMEOUT_CONEXION', 3.05)),
+                        float(os.getenv('BREVO_TIMEOUT_LECTURA', 10)))
+        # Reintentos dentro de la misma llamada ante 429, 5xx o falla de conexión
+        self.reintentos = int(os.getenv('BREVO_REINTENTOS', 2))
+        self.espera_maxima = float(os.getenv('BREVO_ESPERA_MAXIMA_SEGUNDOS', 10))
+        # Destinatarios por llamada en los envíos por lote (Brevo acepta hasta 1000 versiones)
+        self.versiones_por_lote = int(os.getenv('BREVO_VERSIONES_POR_LOTE', 100))
+        self._plantilla_atraso = None
+        
+        # Sesión con conexiones persistentes (keep-alive) compartida por los hilos
+        self.session = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('BREVO_CONEXIONES', 10)))
+        self.session.mount('https://', adaptador)
+        self.session.mount('http://', adaptador)
+        self.session.headers.update({
+            "accept": "application/json",
+            "content-type": "application/json",
+            "api-key": self.api_key or ''
+        })
+        
+        self.circuito = InterruptorCircuito(int(os.getenv('BREVO_CIRCUITO_FALLOS', 5)),
+                                            float(os.getenv('BREVO_CIRCUITO_ESPERA_SEGUNDOS', 30)))
+        self.metricas = MetricasEnvio()
         
         if not self.api_key:
             logger.warning("BREVO_API_KEY no está configurada - emails no se enviarán")
@@ -57,46 +216,10 @@ class BrevoEmailService:
             subject = f"Recibo de Pago #{datos_pago['pago_id']} - {cliente_nombre}"
             html_content = self._generar_html_recibo_pago(cliente_nombre, datos_pago)
             
-            # Configurar payload para API REST
-            payload = {
-                "sender": {
-                    "name": self.sender_name,
-                    "email": self.sender_email
-                },
-                "to": [
-                    {
-                        "email": cliente_email,
-                        "name": cliente_nombre
-                    }
-                ],
-                "subject": subject,
-                "htmlContent": html_content
-            }
-            
-            headers = {
-                "accept": "application/json",
-                "content-type": "application/json",
-                "api-key": self.api_key
-            }
-            
-            # Enviar email
-            response = requests.post(self.api_url, json=payload, headers=headers)
-            
-            if response.status_code == 201:
-                result = response.json()
+            resultado = self._enviar_email(cliente_email, cliente_nombre, subject, html_content)
+            if resultado['success']:
                 logger.info(f"✅ Recibo de pago enviado exitosamente a {cliente_email}")
-                return {
-                    'success': True,
-                    'message_id': result.get('messageId', 'unknown'),
-                    'message': 'Email enviado exitosamente'
-                }
-            else:
-                logger.error(f"❌ Error al enviar email: {response.status_code} - {response.text}")
-                return {
-                    'success': False,
-                    'error': f"HTTP {response.status_code}: {response.text}",
-                    'message': 'Error al enviar email'
-                }
+            return resultado
             
         except Exception as e:
             logger.error(f"❌ Error al enviar recibo de pago: {str(e)}")
@@ -118,6 +241,14 @@ class BrevoEmailService:
         Returns:
             dict: Resultado del envío
         """
+        if not self.api_key:
+            logger.warning("API Key no configurada - simulando envío de email")
+            return {
+                'success': True,
+                'message_id': 'simulated',
+                'message': 'Email simulado (API Key no configurada)'
+            }
+        
         try:
             # Preparar datos del email
             subject = f"Recordatorio de Pago Atrasado - {cliente_nombre}"
@@ -125,24 +256,10 @@ class BrevoEmailService:
             # Crear contenido HTML de la notificación
             html_content = self._generar_html_notificacion_atraso(cliente_nombre, datos_cuota)
             
-            # Configurar email
-            send_email = SendSmtpEmail(
-                to=[SendSmtpEmailTo(email=cliente_email, name=cliente_nombre)],
-                sender=SendSmtpEmailSender(email=self.sender_email, name=self.sender_name),
-                reply_to=SendSmtpEmailReplyTo(email=self.reply_to),
-                subject=subject,
-                html_content=html_content
-            )
-            
-            # Enviar email
-            result = self.email_api.send_transac_email(send_email)
-            
-            logger.info(f"✅ Notificación de atraso enviada exitosamente a {cliente_email}")
-            return {
-                'success': True,
-                'message_id': result.message_id,
-                'message': 'Notificación enviada exitosamente'
-            }
+            resultado = self._enviar_email(cliente_email, cliente_nombre, subject, html_content)
+            if resultado['success']:
+                logger.info(f"✅ Notificación de atraso enviada exitosamente a {cliente_email}")
+            return resultado
             
         except Exception as e:
             logger.error(f"❌ Error al enviar notificación de atraso: {str(e)}")
@@ -152,430 +269,213 @@ class BrevoEmailService:
                 'message': 'Error al enviar notificación'
             }
     
+    def enviar_notificaciones_atraso_lote(self, destinatarios):
+        """
+        Enviar notificaciones de atraso a varios clientes con la misma plantilla
+        
+        La plantilla se genera una sola vez con marcadores {{ params.campo }} y cada
+        cliente se envía como una versión del mensaje (messageVersions) con sus propios
+        parámetros; se hace una llamada a la API por cada grupo de `versiones_por_lote`.
+        
+        Args:
+            destinatarios (list): dicts con 'email', 'nombre' y 'datos_cuota'
+            
+        Returns:
+            list: Resultado del envío de cada destinatario, en el mismo orden
+        """
+        if not self.api_key:
+            logger.warning("API Key no configurada - simulando envío de email")
+            return [{
+                'success': True,
+                'message_id': 'simulated',
+                'message': 'Email simulado (API Key no configurada)'
+            } for _ in destinatarios]
+        
+        resultados = []
+        for inicio in range(0, len(destinatarios), self.versiones_por_lote):
+            grupo = destinatarios[inicio:inicio + self.versiones_por_lote]
+            try:
+                payload = self._payload_base(
+                    "Recordatorio de Pago Atrasado - {{ params.cliente_nombre }}",
+                    self._plantilla_notificacion_atraso()
+                )
+                payload["messageVersions"] = [{
+                    "to": [{"email": destinatario['email'], "name": destinatario['nombre']}],
+                    "params": self._parametros_notificacion_atraso(destinatario['nombre'], destinatario['datos_cuota'])
+                } for destinatario in grupo]
+                resultado = self._llamar_api(payload)
+            except Exception as e:
+                logger.error(f"❌ Error al enviar notificaciones de atraso: {str(e)}")
+                resultado = {'success': False, 'error': str(e), 'message': 'Error al enviar notificación'}
+            
+            if resultado['success']:
+                # Brevo devuelve un messageId por versión, en el mismo orden
+                message_ids = resultado.pop('respuesta').get('messageIds') or []
+                resultados.extend({
+                    **resultado,
+                    'message_id': message_ids[posicion] if posicion < len(message_ids) else None
+                } for posicion in range(len(grupo)))
+                logger.info(f"✅ {len(grupo)} notificaciones de atraso enviadas en una llamada")
+            else:
+                # Brevo acepta o rechaza el grupo completo: todos comparten el resultado
+                # (también si es incierto: el grupo entero pudo haberse enviado)
+                resultados.extend(dict(resultado) for _ in grupo)
+        return resultados
+    
+    def _enviar_email(self, cliente_email, cliente_nombre, subject, html_content):
+        """
+        Enviar un email por la API REST de Brevo
+        
+        Returns:
+            dict: Resultado del envío (ver _llamar_api)
+        """
+        payload = self._payload_base(subject, html_content)
+        payload["to"] = [
+            {
+                "email": cliente_email,
+                "name": cliente_nombre
+            }
+        ]
+        
+        resultado = self._llamar_api(payload)
+        if resultado['success']:
+            resultado['message_id'] = resultado.pop('respuesta').get('messageId', 'unknown')
+        return resultado
+    
+    def _payload_base(self, subject, html_content):
+        """Remitente, asunto y contenido comunes a los envíos individuales y por lote"""
+        return {
+            "sender": {
+                "name": self.sender_name,
+                "email": self.sender_email
+            },
+            "replyTo": {
+                "email": self.reply_to
+            },
+            "subject": subject,
+            "htmlContent": html_content
+        }
+    
+    def _llamar_api(self, payload):
+        """
+        Hacer POST del payload a la API de Brevo
+        
+        Los 429 y 5xx se reintentan hasta `reintentos` veces esperando lo que indique
+        Retry-After (o una espera creciente); las fallas al conectar también, porque la
+        solicitud no llegó a Brevo. Un tiempo de lectura agotado o una conexión cortada
+        después de enviar no se repiten nunca: el email pudo haberse enviado, así que el
+        resultado se marca como 'incierto' y no como reintentable.
+        
+        Returns:
+            dict: Resultado de la llamada, con el JSON de Brevo en 'respuesta' si tuvo
+                  éxito; 'reintentable' indica si el error es pasajero y se puede volver a
+                  enviar, 'reintentar_en' los segundos sugeridos antes de hacerlo e
+                  'incierto' que no se sabe si Brevo aceptó el envío
+        """
+        intento = 0
+        while True:
+            espera_circuito = self.circuito.permitir()
+            if espera_circuito:
+                self.metricas.registrar_rechazo()
+                return {
+                    'success': False,
+                    'error': 'Envíos a Brevo suspendidos por fallos seguidos (circuito abierto)',
+                    'reintentable': True,
+                    'reintentar_en': espera_circuito,
+                    'message': 'Error al enviar email'
+                }
+            
+            inicio = time.monotonic()
+            try:
+                response = self.session.post(self.api_url, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                latencia = time.monotonic() - inicio
+                self.metricas.registrar('conexion', latencia)
+                self.circuito.registrar_fallo()
+                no_enviada = solicitud_no_enviada(e)
+                if no_enviada and intento < self.reintentos:
+                    intento += 1
+                    time.sleep(self._espera_reintento(intento))
+                    continue
+                if no_enviada:
+                    logger.error(f"❌ Error de conexión con Brevo: {str(e)}")
+                else:
+                    logger.error(f"❌ Sin respuesta de Brevo después de enviar (resultado incierto): {str(e)}")
+                return {
+                    'success': False,
+                    'error': str(e),
+                    'reintentable': no_enviada,
+                    'incierto': not no_enviada,
+                    'latencia_ms': round(latencia * 1000, 1),
+                    'message': 'Error al enviar email'
+                }
+            
+            latencia = time.monotonic() - inicio
+            self.metricas.registrar(response.status_code, latencia)
+            logger.debug(f"Brevo respondió {response.status_code} en {latencia * 1000:.0f} ms")
+            
+            if response.status_code == 201:
+                self.circuito.registrar_exito()
+                return {
+                    'success': True,
+                    'respuesta': response.json(),
+                    'latencia_ms': round(latencia * 1000, 1),
+                    'message': 'Email enviado exitosamente'
+                }
+            
+            reintentable = response.status_code == 429 or response.status_code >= 500
+            retry_after = segundos_retry_after(response.headers.get('Retry-After'))
+            if reintentable:
+                self.circuito.registrar_fallo()
+                if intento < self.reintentos and (retry_after or 0) <= self.espera_maxima:
+                    intento += 1
+                    time.sleep(self._espera_reintento(intento, retry_after))
+                    continue
+            else:
+                # Brevo respondió: el error es de la solicitud, no del servicio
+                self.circuito.registrar_exito()
+            
+            logger.error(f"❌ Error al enviar email: {response.status_code} - {response.text}")
+            return {
+                'success': False,
+                'error': f"HTTP {response.status_code}: {response.text}",
+                'status_code': response.status_code,
+                'reintentable': reintentable,
+                'reintentar_en': retry_after,
+                'latencia_ms': round(latencia * 1000, 1),
+                'message': 'Error al enviar email'
+            }
+    
+    def _espera_reintento(self, intento, retry_after=None):
+        """Segundos antes de repetir la llamada: lo que pide Brevo o 0.5, 1, 2... s"""
+        if retry_after is not None:
+            return min(retry_after, self.espera_maxima)
+        return min(0.5 * 2 ** (intento - 1), self.espera_maxima)
+    
     def _generar_html_recibo_pago(self, cliente_nombre, datos_pago):
         """Generar HTML para recibo de pago"""
-        return f"""
-        <!DOCTYPE html>
-        <html lang="es">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Recibo de Pago - {datos_pago['pago_id']}</title>
-            <style>
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    line-height: 1.6;
-                    color: #333;
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                    background-color: #f8f9fa;
-                }}
-                .email-container {{
-                    background: white;
-                    border-radius: 15px;
-                    box-shadow: 0 4px 20px rgba(0,0,0,0.1);
-                    overflow: hidden;
-                }}
-                .header {{
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    color: white;
-                    padding: 30px 20px;
-                    text-align: center;
-                }}
-                .company-name {{
-                    font-size: 24px;
-                    font-weight: bold;
-                    margin-bottom: 5px;
-                }}
-                .company-slogan {{
-                    font-size: 14px;
-                    opacity: 0.9;
-                }}
-                .content {{
-                    padding: 30px 25px;
-                }}
-                .section-title {{
-                    color: #667eea;
-                    font-size: 18px;
-                    font-weight: bold;
-                    margin-bottom: 20px;
-                    border-bottom: 2px solid #e9ecef;
-                    padding-bottom: 10px;
-                }}
-                .info-row {{
-                    display: flex;
-                    justify-content: space-between;
-                    margin-bottom: 15px;
-                    align-items: center;
-                }}
-                .info-label {{
-                    font-weight: 600;
-                    color: #495057;
-                }}
-                .info-value {{
-                    font-weight: 500;
-                    color: #212529;
-                }}
-                .amount-highlight {{
-                    font-size: 20px;
-                    font-weight: bold;
-                    color: #28a745;
-                }}
-                .separator {{
-                    border-top: 2px dotted #dee2e6;
-                    margin: 25px 0;
-                }}
-                .footer {{
-                    background: #f8f9fa;
-                    padding: 20px 25px;
-                    text-align: center;
-                    border-top: 1px solid #e9ecef;
-                }}
-                .contact-info {{
-                    font-size: 14px;
-                    color: #6c757d;
-                    margin-bottom: 10px;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="header">
-                    <div class="company-name">WANDY SOLUCIONES Y PRÉSTAMOS</div>
-                    <div class="company-slogan">Soluciones financieras a tu alcance</div>
-                </div>
-                
-                <div class="content">
-                    <div style="text-align: center; margin-bottom: 25px;">
-                        <h2 style="color: #667eea;">Recibo de Pago #{datos_pago['pago_id']}</h2>
-                        <p style="color: #6c757d;">Fecha de Emisión: {datos_pago['fecha_pago']}</p>
-                    </div>
-                    
-                    <div class="section-title">Información del Cliente</div>
-                    <div class="info-row">
-                        <span class="info-label">Cliente:</span>
-                        <span class="info-value">{cliente_nombre}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">Préstamo:</span>
-                        <span class="info-value">#{datos_pago['prestamo_id']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">Cuota:</span>
-                        <span class="info-value">#{datos_pago['cuota_numero']}</span>
-                    </div>
-                    
-                    <div class="separator"></div>
-                    
-                    <div class="section-title">Detalles del Pago</div>
-                    <div class="info-row">
-                        <span class="info-label">Monto Total:</span>
-                        <span class="info-value amount-highlight">RD${datos_pago['monto_total']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">Capital:</span>
-                        <span class="info-value">RD${datos_pago['monto_capital']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">Intereses:</span>
-                        <span class="info-value">RD${datos_pago['monto_interes']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">Fecha de Pago:</span>
-                        <span class="info-value">{datos_pago['fecha_pago']}</span>
-                    </div>
-                    
-                    <div class="separator"></div>
-                    
-                    <p style="text-align: center; color: #28a745; font-weight: bold; font-size: 18px;">
-                        ✅ Pago Confirmado
-                    </p>
-                    
-                    <p style="text-align: center; color: #6c757d; font-size: 14px;">
-                        Este es un recibo oficial de Wandy Soluciones y Préstamos.<br>
-                        Por favor, guárdelo para sus registros.
-                    </p>
-                </div>
-                
-                <div class="footer">
-                    <div class="contact-info">
-                        <strong>Wandy Soluciones y Préstamos</strong><br>
-                        Soluciones financieras a tu alcance
-                    </div>
-                    
-                    <div class="contact-info">
-                        📞 Tel: +809 326-3633<br>
-                        📧 Email: info@wandysoluciones.com<br>
-                        🌐 Web: www.wandysoluciones.com
-                    </div>
-                    
-                    <div style="margin-top: 20px; font-size: 12px; color: #adb5bd;">
-                        Este email fue enviado automáticamente desde el sistema de Wandy Soluciones y Préstamos.
-                    </div>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        return plantillas_correo.renderizar('recibo_pago', f"Recibo de Pago - {datos_pago['pago_id']}",
+                                            cliente_nombre=cliente_nombre, pago=datos_pago)
+    
+    def _plantilla_notificacion_atraso(self):
+        """HTML de la notificación de atraso con marcadores de Brevo, generado una sola vez"""
+        if self._plantilla_atraso is None:
+            marcadores = {campo: f"{{{{ params.{campo} }}}}" for campo in CAMPOS_NOTIFICACION_ATRASO}
+            self._plantilla_atraso = self._generar_html_notificacion_atraso("{{ params.cliente_nombre }}", marcadores)
+        return self._plantilla_atraso
+    
+    def _parametros_notificacion_atraso(self, cliente_nombre, datos_cuota):
+        """Valores de los marcadores de la plantilla para un cliente"""
+        parametros = {campo: str(datos_cuota.get(campo, valor_defecto))
+                      for campo, valor_defecto in CAMPOS_NOTIFICACION_ATRASO.items()}
+        parametros['cliente_nombre'] = cliente_nombre
+        return parametros
     
     def _generar_html_notificacion_atraso(self, cliente_nombre, datos_cuota):
         """Generar HTML para notificación de atraso"""
-        return f"""
-        <!DOCTYPE html>
-        <html lang="es">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Recordatorio de Pago Atrasado</title>
-            <style>
-                body {{
-                    font-family: 'arial, helvetica, sans-serif';
-                    line-height: 1.5;
-                    color: #3b3f44;
-                    font-size: 16px;
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                    background-color: #f8f9fa;
-                }}
-                
-                .email-container {{
-                    background: white;
-                    border-radius: 15px;
-                    box-shadow: 0 4px 20px rgba(0,0,0,0.1);
-                    overflow: hidden;
-                }}
-                
-                .header {{
-                    background: linear-gradient(135deg, #dc3545 0%, #c82333 100%);
-                    color: white;
-                    padding: 30px 20px;
-                    text-align: center;
-                }}
-                
-                .company-name {{
-                    font-size: 24px;
-                    font-weight: bold;
-                    margin-bottom: 5px;
-                }}
-                
-                .company-slogan {{
-                    font-size: 14px;
-                    opacity: 0.9;
-                }}
-                
-                .content {{
-                    padding: 30px 25px;
-                }}
-                
-                .section-title {{
-                    color: #1F2D3D;
-                    font-family: 'arial, helvetica, sans-serif';
-                    font-size: 18px;
-                    font-weight: 400;
-                    margin-bottom: 20px;
-                    border-bottom: 2px solid #e9ecef;
-                    padding-bottom: 10px;
-                }}
-                
-                .info-row {{
-                    display: flex;
-                    justify-content: space-between;
-                    margin-bottom: 15px;
-                    align-items: center;
-                }}
-                
-                .info-label {{
-                    font-weight: 600;
-                    color: #495057;
-                }}
-                
-                .info-value {{
-                    font-weight: 500;
-                    color: #212529;
-                }}
-                
-                .amount-highlight {{
-                    font-size: 20px;
-                    font-weight: bold;
-                    color: #dc3545;
-                }}
-                
-                .separator {{
-                    border-top: 2px dotted #dee2e6;
-                    margin: 25px 0;
-                }}
-                
-                .alert {{
-                    background: #fff3cd;
-                    border: 1px solid #ffeaa7;
-                    border-radius: 10px;
-                    padding: 20px;
-                    margin: 20px 0;
-                    border-left: 4px solid #f39c12;
-                }}
-                
-                .help-box {{
-                    background: #d4edda;
-                    border: 1px solid #c3e6cb;
-                    border-radius: 10px;
-                    padding: 20px;
-                    margin: 20px 0;
-                }}
-                
-                .footer {{
-                    background: #f8f9fa;
-                    padding: 20px 25px;
-                    text-align: center;
-                    border-top: 1px solid #e9ecef;
-                }}
-                
-                .contact-info {{
-                    font-size: 14px;
-                    color: #6c757d;
-                    margin-bottom: 10px;
-                }}
-                
-                .social-links {{
-                    margin-top: 15px;
-                }}
-                
-                .social-links a {{
-                    color: #0092ff;
-                    text-decoration: underline;
-                    font-family: 'arial, helvetica, sans-serif';
-                    font-size: 16px;
-                    margin: 0 10px;
-                }}
-                
-                .social-links a:hover {{
-                    text-decoration: underline;
-                }}
-                
-                .view-in-browser {{
-                    text-align: center;
-                    padding: 5px 30px;
-                    margin-bottom: 10px;
-                }}
-                
-                .view-in-browser a {{
-                    color: #858588;
-                    font-family: 'arial, helvetica, sans-serif';
-                    font-size: 12px;
-                    text-decoration: underline;
-                }}
-                
-                .notification-title {{
-                    text-align: center;
-                    font-size: 20px;
-                    color: #dc3545;
-                    margin-bottom: 25px;
-                    font-weight: bold;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="view-in-browser">
-                    <p><a href="#">Ver en navegador</a></p>
-                </div>
-                <div class="header">
-                    <img style="width: 150px; height: auto; display: block; margin: 0 auto 10px;" src="https://i.imgur.com/Ui2SzsR.jpg" alt="Logo de Wandy Soluciones y Préstamos">
-                    <div class="company-name">WANDY SOLUCIONES Y PRÉSTAMOS</div>
-                    <div class="company-slogan">Soluciones financieras a tu alcance</div>
-                </div>
-                
-                <div class="content">
-                    <div class="notification-title">
-                        ⚠️ Recordatorio de Pago Atrasado
-                    </div>
-                    
-                    <div class="alert">
-                        <p style="margin: 0; font-size: 16px;">
-                            <strong>Estimado/a {cliente_nombre},</strong><br><br>
-                            Le recordamos que tiene una cuota atrasada que requiere su atención inmediata.
-                        </p>
-                    </div>
-                    
-                    <div class="section-title">Detalles de la Cuota Atrasada</div>
-                    
-                    <div class="info-row">
-                        <span class="info-label">Monto del Préstamo:</span>
-                        <span class="info-value">RD${datos_cuota.get('monto_prestamo', '0.00')}</span>
-                    </div>
-                    
-                    <div class="info-row">
-                        <span class="info-label">Cuota:</span>
-                        <span class="info-value">{datos_cuota.get('cuota_numero', 'N/A')}</span>
-                    </div>
-                    
-                    <div class="info-row">
-                        <span class="info-label">Fecha de Vencimiento:</span>
-                        <span class="info-value">{datos_cuota.get('fecha_vencimiento', 'N/A')}</span>
-                    </div>
-                    
-                    <div class="separator"></div>
-                    
-                    <div class="section-title">Información Financiera</div>
-                    
-                    <div class="info-row">
-                        <span class="info-label">Monto Original:</span>
-                        <span class="info-value">RD${datos_cuota.get('monto_original', '0.00')}</span>
-                    </div>
-                    
-                    <div class="info-row">
-                        <span class="info-label">Interés por Atraso:</span>
-                        <span class="info-value amount-highlight">RD${datos_cuota.get('interes_atraso', '0.00')}</span>
-                    </div>
-                    
-                    <div class="info-row">
-                        <span class="info-label">Monto Total a Pagar:</span>
-                        <span class="info-value amount-highlight">RD${datos_cuota.get('monto_total', '0.00')}</span>
-                    </div>
-                    
-                    <div class="separator"></div>
-                    
-                    <div class="help-box">
-                        <h4 style="color: #155724; margin-top: 0;">📞 ¿Necesita Ayuda?</h4>
-                        <p style="color: #155724; margin-bottom: 0;">
-                            Si tiene alguna pregunta o necesita hacer un arreglo de pago, 
-                            no dude en contactarnos. Estamos aquí para ayudarle.
-                        </p>
-                    </div>
-                    
-                    <p style="text-align: center; color: #6c757d; font-size: 14px;">
-                        Por favor, regularice su pago lo antes posible para evitar cargos adicionales.
-                    </p>
-                </div>
-                
-                <div class="footer">
-                    <div class="contact-info">
-                        <strong>Wandy Soluciones y Préstamos</strong><br>
-                        Soluciones financieras a tu alcance
-                    </div>
-                    
-                    <div class="contact-info">
-                        📞 Tel: +809 326-3633<br>
-                        📧 Email: info@wandysoluciones.com<br>
-                        🌐 Web: www.wandysoluciones.com
-                    </div>
-                    
-                    <div class="social-links">
-                        <a href="https://www.facebook.com/share/1B3zAZmT11/?mibextid=wwXIfr">Facebook</a> |
-                        <a href="https://www.instagram.com/wandy_soluciones?igsh=MWM5Ynl2cG41eTc3aw%3D%3D&utm_source=">Instagram</a> |
-                        <a href="https://wa.me/18093263633">WhatsApp</a>
-                    </div>
-                    
-                    <div style="margin-top: 20px; font-size: 12px; color: #adb5bd;">
-                        Este email fue enviado automáticamente desde el sistema de Wandy Soluciones y Préstamos.<br>
-                        Si tiene alguna pregunta, por favor contáctenos directamente.
-                    </div>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        return plantillas_correo.renderizar('notificacion_atraso', 'Recordatorio de Pago Atrasado',
+                                            cliente_nombre=cliente_nombre,
+                                            cuota={**CAMPOS_NOTIFICACION_ATRASO, **datos_cuota})
     
     def verificar_conexion(self):
         """Verificar conexión con Brevo"""
@@ -597,17 +497,37 @@ def crear_servicio_brevo():
         logger.error(f"❌ Error al crear servicio de Brevo: {str(e)}")
         return None
 
+_servicio_compartido = None
+_servicio_lock = threading.Lock()
+
+def obtener_servicio_brevo():
+    """Instancia del servicio compartida por todo el proceso, para reutilizar las
+    conexiones de su sesión, su circuito y sus métricas"""
+    global _servicio_compartido
+    if _servicio_compartido is None:
+        with _servicio_lock:
+            if _servicio_compartido is None:
+                _servicio_compartido = crear_servicio_brevo()
+    return _servicio_compartido
+
 # Funciones de conveniencia para uso directo
 def enviar_recibo_pago_brevo(cliente_email, cliente_nombre, datos_pago):
     """Función de conveniencia para enviar recibo de pago"""
-    servicio = crear_servicio_brevo()
+    servicio = obtener_servicio_brevo()
     if servicio:
         return servicio.enviar_recibo_pago(cliente_email, cliente_nombre, datos_pago)
     return {'success': False, 'error': 'Servicio no disponible'}
 
 def enviar_notificacion_atraso_brevo(cliente_email, cliente_nombre, datos_cuota):
     """Función de conveniencia para enviar notificación de atraso"""
-    servicio = crear_servicio_brevo()
+    servicio = obtener_servicio_brevo()
     if servicio:
         return servicio.enviar_notificacion_atraso(cliente_email, cliente_nombre, datos_cuota)
     return {'success': False, 'error': 'Servicio no disponible'}
+
+def enviar_notificaciones_atraso_lote_brevo(destinatarios):
+    """Función de conveniencia para enviar notificaciones de atraso por lote"""
+    servicio = obtener_servicio_brevo()
+    if servicio:
+        return servicio.enviar_notificaciones_atraso_lote(destinatarios)
+    return [{'success': False, 'error': 'Servicio no disponible'} for _ in destinatarios]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para consolidar el capital disponible
+Suma al saldo de Contabilidad los movimientos de capital registrados desde la
+última consolidación y los marca como consolidados. El capital disponible que
+muestra la aplicación no cambia; solo se acorta la lista de movimientos que hay
+que sumar al leerlo. Se puede programar (por ejemplo con cron) cada noche.
+
+Uso: python consolidar_capital.py
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, consolidar_capital, obtener_capital_disponible
+
+def consolidar():
+    """Consolida los movimientos pendientes y muestra el saldo resultante"""
+    with app.app_context():
+        try:
+            db.create_all()
+            capital_antes = obtener_capital_disponible()
+            consolidados = consolidar_capital()
+            capital_despues = obtener_capital_disponible()
+
+            print(f"📋 {consolidados} movimientos consolidados")
+            print(f"💰 Capital disponible: RD$ {capital_despues:,.2f}")
+            if capital_antes != capital_despues:
+                # Otros movimientos confirmados mientras se consolidaba
+                print(f"ℹ️  El capital cambió desde RD$ {capital_antes:,.2f} durante la consolidación")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error al consolidar el capital: {e}")
+            return False
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Consolidando el capital disponible...")
+    load_dotenv()
+
+    if consolidar():
+        print("\n🎉 ¡Consolidación terminada!")
+    else:
+        print("\n💥 No se pudo consolidar el capital")
+        sys.exit(1)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para enviar los correos de la bandeja de salida
+Los procesos web ya envían las notificaciones de atraso en segundo plano; este
+script permite hacerlo en un proceso aparte (con CORREOS_DESPACHO_EN_PROCESO=false
+en la aplicación) o vaciar la bandeja desde cron. Usa la misma cantidad de hilos,
+límite por segundo y reintentos que la aplicación (variables CORREOS_*).
+
+Uso: python despachar_correos.py            (queda corriendo hasta Ctrl+C)
+     python despachar_correos.py --una-vez  (envía lo que esté listo y termina)
+"""
+
+import os
+import sys
+import time
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, CorreoSaliente, CORREOS_HILOS, CORREOS_POR_SEGUNDO, despachar_correos_pendientes, pool_correos
+
+def contar_por_estado():
+    """Correos de la bandeja por estado"""
+    with app.app_context():
+        conteos = dict(db.session.query(CorreoSaliente.estado, db.func.count(CorreoSaliente.id))
+                       .group_by(CorreoSaliente.estado).all())
+        db.session.remove()
+    return conteos
+
+def mostrar_estado():
+    conteos = contar_por_estado()
+    print(f"📋 Pendientes: {conteos.get('Pendiente', 0) + conteos.get('Enviando', 0)}  "
+          f"Enviados: {conteos.get('Enviado', 0)}  Fallidos: {conteos.get('Fallido', 0)}  "
+          f"Inciertos: {conteos.get('Incierto', 0)}")
+
+def despachar(una_vez=False):
+    """Envía los correos pendientes con los hilos de despacho"""
+    try:
+        with app.app_context():
+            db.create_all()
+        print(f"⚙️  {CORREOS_HILOS} hilos, hasta {CORREOS_POR_SEGUNDO:g} correos por segundo")
+        mostrar_estado()
+
+        if una_vez:
+            while despachar_correos_pendientes():
+                pass
+        else:
+            pool_correos.iniciar()
+            try:
+                while True:
+                    time.sleep(60)
+                    mostrar_estado()
+            except KeyboardInterrupt:
+                print("\n⏹️  Deteniendo después de los envíos en curso...")
+                pool_correos.detener()
+
+        mostrar_estado()
+
+    except Exception as e:
+        print(f"❌ Error al despachar los correos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Despachando la bandeja de salida de correos...")
+    load_dotenv()
+
+    if despachar(una_vez='--una-vez' in sys.argv):
+        print("\n🎉 ¡Despacho terminado!")
+    else:
+        print("\n💥 No se pudieron despachar los correos")
+        sys.exit(1)
@@ -0,0 +1,113 @@
+"""
+Piezas del despacho de correos en segundo plano: límite de envíos por segundo,
+espera entre reintentos y el grupo de hilos que vacía la bandeja de salida.
+No dependen de Flask ni de la base de datos.
+"""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LimitadorTasa:
+    """Cubeta de fichas compartida por varios hilos: como máximo `por_segundo` envíos
+    por segundo, con ráfagas de hasta `rafaga` envíos seguidos (por defecto ninguna:
+    los envíos quedan espaciados de forma pareja)."""
+
+    def __init__(self, por_segundo, rafaga=1):
+        self.por_segundo = float(por_segundo)
+        self.rafaga = float(rafaga)
+        self._fichas = self.rafaga
+        self._ultima = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        """Bloquea hasta que haya una ficha disponible y la consume"""
+        if self.por_segundo <= 0:
+            return
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.rafaga, self._fichas + (ahora - self._ultima) * self.por_segundo)
+                self._ultima = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                espera = (1 - self._fichas) / self.por_segundo
+            time.sleep(espera)
+
+
+def espera_reintento(intentos, base=30, maximo=3600):
+    """Segundos antes del siguiente intento: crece al doble con cada intento fallido
+    (base, 2*base, 4*base...) hasta `maximo`, con una parte aleatoria para que los
+    correos que fallaron juntos no se reintenten todos al mismo tiempo.
+
+    Args:
+        intentos (int): Intentos ya realizados (1 después del primer fallo)
+        base (float): Espera después del primer fallo
+        maximo (float): Espera máxima
+
+    Returns:
+        float: Segundos a esperar, entre la mitad y el total de la espera exponencial
+    """
+    espera = min(maximo, base * 2 ** max(0, intentos - 1))
+    return espera / 2 + random.uniform(0, espera / 2)
+
+
+class PoolDespacho:
+    """Hilos que llaman a `trabajar()` mientras haya trabajo.
+
+    `trabajar` procesa un grupo y devuelve True si encontró algo que hacer; cuando
+    devuelve False el hilo duerme `pausa` segundos o hasta que se llame a `avisar()`.
+    La cantidad de hilos limita los envíos simultáneos.
+    """
+
+    def __init__(self, trabajar, hilos=4, pausa=5, nombre='despacho'):
+        self._trabajar = trabajar
+        self.hilos = hilos
+        self.pausa = pausa
+        self.nombre = nombre
+        self._hilos = []
+        self._aviso = threading.Event()
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def activo(self):
+        return any(hilo.is_alive() for hilo in self._hilos)
+
+    def iniciar(self):
+        """Arranca los hilos que falten (se puede llamar varias veces)"""
+        with self._lock:
+            self._detener.clear()
+            self._hilos = [hilo for hilo in self._hilos if hilo.is_alive()]
+            for numero in range(len(self._hilos), self.hilos):
+                hilo = threading.Thread(target=self._ciclo, name=f'{self.nombre}-{numero + 1}', daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+
+    def avisar(self):
+        """Despierta a los hilos dormidos porque hay trabajo nuevo"""
+        self._aviso.set()
+
+    def detener(self, esperar=True):
+        """Pide a los hilos que terminen después del grupo en curso"""
+        self._detener.set()
+        self._aviso.set()
+        if esperar:
+            for hilo in self._hilos:
+                hilo.join()
+
+    def _ciclo(self):
+        while not self._detener.is_set():
+            try:
+                hubo_trabajo = self._trabajar()
+            except Exception:
+                logger.exception(f"❌ Error en el hilo {threading.current_thread().name}")
+                hubo_trabajo = False
+            if not hubo_trabajo and not self._detener.is_set():
+                if self._aviso.wait(self.pausa):
+                    self._aviso.clear()
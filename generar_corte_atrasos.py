@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para generar el corte diario de antigüedad de los atrasos
+Guarda, para cada préstamo con cuotas vencidas, las cuotas y montos atrasados
+en los tramos de 1-30, 31-60, 61-90 y más de 90 días, y los totales de la
+cartera del día. La página de atrasados, el dashboard y los reportes leen este
+corte; los cortes anteriores se conservan para ver la evolución de la mora.
+Se debe programar (por ejemplo con cron) cada noche después de medianoche.
+El corte se calcula con el estado actual de las cuotas, así que no se pueden
+generar cortes de fechas pasadas.
+
+Uso: python generar_corte_atrasos.py [AAAA-MM-DD]
+"""
+
+import os
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, generar_corte_antiguedad
+
+def generar(fecha=None):
+    """Genera (o reemplaza) el corte de la fecha indicada y muestra sus totales"""
+    with app.app_context():
+        try:
+            db.create_all()
+            corte = generar_corte_antiguedad(fecha)
+
+            print(f"📅 Corte del {corte.fecha.strftime('%d/%m/%Y')}")
+            print(f"👥 {corte.clientes_atrasados} clientes y {corte.prestamos_atrasados} préstamos con atrasos")
+            for tramo in corte.tramos():
+                print(f"   {tramo['etiqueta']:>15}: {tramo['cuotas']:>5} cuotas  RD$ {tramo['monto']:>14,.2f}")
+            print(f"💰 Total atrasado: RD$ {corte.monto_atrasado:,.2f}")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error al generar el corte de atrasos: {e}")
+            return False
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Generando el corte de antigüedad de los atrasos...")
+    load_dotenv()
+
+    fecha = None
+    if len(sys.argv) > 1:
+        try:
+            fecha = datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+        except ValueError:
+            print("❌ La fecha debe tener el formato AAAA-MM-DD")
+            sys.exit(1)
+        if fecha < datetime.now().date():
+            print("❌ No se puede generar un corte de una fecha pasada: se calcula con el estado actual de las cuotas")
+            sys.exit(1)
+
+    if generar(fecha):
+        print("\n🎉 ¡Corte generado!")
+    else:
+        print("\n💥 No se pudo generar el corte")
+        sys.exit(1)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para actualizar el esquema de la base de datos
+Crea las tablas nuevas y aplica en orden las migraciones pendientes
+(columnas e índices sobre tablas que ya existían), registrando cada
+versión aplicada en la tabla version_esquema
+"""
+
+import os
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text
+from app import (app, db, Conversacion, Mensaje, ChatNoLeidosConversacion, ChatNoLeidosUsuario,
+                 Cliente, Prestamo, Cuota, Pago, TrabajoNotificacion, indexar_terminos_cliente,
+                 recalcular_saldos_prestamos)
+
+version_esquema = db.Table(
+    'version_esquema',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('descripcion', db.String(200), nullable=False),
+    db.Column('fecha_aplicacion', db.DateTime, default=datetime.utcnow)
+)
+
+def columnas_tabla(tabla):
+    """Nombres de las columnas que tiene la tabla en la base de datos"""
+    return {columna['name'] for columna in inspect(db.engine).get_columns(tabla)}
+
+def crear_indice_si_falta(modelo, nombre):
+    """Crea en la base de datos un índice declarado en el modelo si todavía no existe"""
+    tabla = modelo.__table__
+    existentes = {indice['name'] for indice in inspect(db.engine).get_indexes(tabla.name)}
+    if nombre in existentes:
+        return False
+
+    indice = next(indice for indice in tabla.indexes if indice.name == nombre)
+    indice.create(db.engine)
+    return True
+
+def agregar_columna_si_falta(tabla, columna, tipo):
+    """Agrega una columna (siempre admite NULL) a una tabla existente.
+
+    El tipo puede ser el SQL literal o el tipo de SQLAlchemy de la columna del modelo.
+    """
+    if columna in columnas_tabla(tabla):
+        return False
+
+    if not isinstance(tipo, str):
+        tipo = tipo.compile(dialect=db.engine.dialect)
+
+    db.session.execute(text(f'ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}'))
+    db.session.commit()
+    return True
+
+def migracion_indice_mensajes():
+    """Índice (conversacion_id, fecha_envio, id) para paginar el historial del chat"""
+    crear_indice_si_falta(Mensaje, 'ix_mensaje_conversacion_fecha_id')
+
+def migracion_par_canonico_conversacion():
+    """Par canónico de participantes con índice único para la conversación abierta"""
+    agregar_columna_si_falta('conversacion', 'usuario_menor_id', 'INTEGER')
+    agregar_columna_si_falta('conversacion', 'usuario_mayor_id', 'INTEGER')
+    agregar_columna_si_falta('conversacion', 'par_abierto', 'BOOLEAN')
+
+    # Completar el par en las conversaciones existentes
+    Conversacion.query.update({
+        Conversacion.usuario_menor_id: db.case(
+            (Conversacion.usuario1_id < Conversacion.usuario2_id, Conversacion.usuario1_id),
+            else_=Conversacion.usuario2_id
+        ),
+        Conversacion.usuario_mayor_id: db.case(
+            (Conversacion.usuario1_id < Conversacion.usuario2_id, Conversacion.usuario2_id),
+            else_=Conversacion.usuario1_id
+        ),
+        Conversacion.par_abierto: db.case((Conversacion.activa == True, True), else_=None)
+    }, synchronize_session=False)
+
+    # Unificar las conversaciones abiertas duplicadas en la más antigua
+    duplicados = db.session.query(
+        Conversacion.usuario_menor_id, Conversacion.usuario_mayor_id
+    ).filter(
+        Conversacion.par_abierto == True
+    ).group_by(
+        Conversacion.usuario_menor_id, Conversacion.usuario_mayor_id
+    ).having(db.func.count(Conversacion.id) > 1).all()
+
+    for usuario_menor_id, usuario_mayor_id in duplicados:
+        ids = [c.id for c in Conversacion.query.filter_by(
+            usuario_menor_id=usuario_menor_id,
+            usuario_mayor_id=usuario_mayor_id,
+            par_abierto=True
+        ).order_by(Conversacion.id).all()]
+        conservar, sobrantes = ids[0], ids[1:]
+
+        Mensaje.query.filter(Mensaje.conversacion_id.in_(sobrantes)).update(
+            {Mensaje.conversacion_id: conservar}, synchronize_session=False)
+        Conversacion.query.filter(Conversacion.id.in_(sobrantes)).update(
+            {Conversacion.activa: False, Conversacion.par_abierto: None}, synchronize_session=False)
+
+        # Los contadores de no leídos de ambos se recalculan al volver a entrar al chat
+        participantes = (usuario_menor_id, usuario_mayor_id)
+        ChatNoLeidosConversacion.query.filter(
+            ChatNoLeidosConversacion.usuario_id.in_(participantes)).delete(synchronize_session=False)
+        ChatNoLeidosUsuario.query.filter(
+            ChatNoLeidosUsuario.usuario_id.in_(participantes)).delete(synchronize_session=False)
+
+        print(f"   - Conversaciones {sobrantes} unidas en la {conservar}")
+
+    db.session.commit()
+    crear_indice_si_falta(Conversacion, 'uq_conversacion_par_abierto')
+
+def migracion_indice_busqueda_clientes():
+    """Llena el índice de búsqueda (tabla termino_cliente) con los clientes existentes"""
+    conexion = db.session.connection()
+    total = 0
+    ultimo_id = 0
+    while True:
+        lote = Cliente.query.filter(Cliente.id > ultimo_id).order_by(Cliente.id).limit(500).all()
+        if not lote:
+            break
+        for cliente in lote:
+            indexar_terminos_cliente(conexion, cliente)
+        total += len(lote)
+        ultimo_id = lote[-1].id
+    db.session.commit()
+    print(f"   - {total} clientes indexados")
+
+def migracion_indices_listados():
+    """Índices (fecha, id) para la paginación por cursor de los listados"""
+    crear_indice_si_falta(Cliente, 'ix_cliente_fecha_creacion_id')
+    crear_indice_si_falta(Prestamo, 'ix_prestamo_fecha_creacion_id')
+    crear_indice_si_falta(Pago, 'ix_pago_fecha_pago_id')
+
+def migracion_saldos_prestamos():
+    """Columnas de saldos en los préstamos, calculadas desde sus cuotas y pagos"""
+    columnas = Prestamo.__table__.c
+    for columna in ('total_cuotas', 'cuotas_pagadas', 'cuotas_pendientes', 'cuotas_atrasadas',
+                    'fecha_corte_atrasos', 'monto_cuotas', 'capital_pendiente', 'interes_pendiente',
+                    'fecha_ultimo_pago'):
+        agregar_columna_si_falta('prestamo', columna, columnas[columna].type)
+
+    total = 0
+    ultimo_id = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Prestamo.id).where(Prestamo.id > ultimo_id).order_by(Prestamo.id).limit(500)
+        ).scalars().all()
+        if not ids:
+            break
+        recalcular_saldos_prestamos(ids)
+        db.session.commit()
+        total += len(ids)
+        ultimo_id = ids[-1]
+    print(f"   - {total} préstamos actualizados")
+
+def migracion_clave_idempotencia_pagos():
+    """Clave de idempotencia de los pagos con índice único"""
+    agregar_columna_si_falta('pago', 'clave_idempotencia', Pago.__table__.c.clave_idempotencia.type)
+    crear_indice_si_falta(Pago, 'uq_pago_clave_idempotencia')
+
+def migracion_indices_atrasos():
+    """Índices de las consultas de cuotas atrasadas y de las llaves foráneas de cuotas, pagos y préstamos.
+
+    El índice parcial de cuotas pendientes solo se crea en PostgreSQL y el compuesto
+    (estado, fecha_vencimiento) solo en las demás bases (ver Cuota.__table_args__).
+    """
+    crear_indice_si_falta(Cuota, 'ix_cuota_prestamo_numero')
+    crear_indice_si_falta(Cuota, 'ix_cuota_pendiente_vencimiento')
+    crear_indice_si_falta(Cuota, 'ix_cuota_estado_vencimiento')
+    crear_indice_si_falta(Pago, 'ix_pago_cuota_id')
+    crear_indice_si_falta(Prestamo, 'ix_prestamo_cliente_estado')
+
+def migracion_registro_notificaciones():
+    """Cuotas duplicadas y limitadas de los trabajos de notificaciones (la tabla
+    registro_notificacion, con su índice único, la crea create_all)"""
+    for columna in ('duplicadas', 'limitadas'):
+        agregar_columna_si_falta('trabajo_notificacion', columna,
+                                 TrabajoNotificacion.__table__.c[columna].type)
+
+# (version, descripción, función). Agregar siempre al final con la versión siguiente
+MIGRACIONES = [
+    (1, 'Índice de mensajes por conversación y fecha', migracion_indice_mensajes),
+    (2, 'Par canónico e índice único en conversaciones', migracion_par_canonico_conversacion),
+    (3, 'Índice de búsqueda de clientes', migracion_indice_busqueda_clientes),
+    (4, 'Índices de fecha para paginar clientes, préstamos y pagos', migracion_indices_listados),
+    (5, 'Saldos de los préstamos', migracion_saldos_prestamos),
+    (6, 'Clave de idempotencia de los pagos', migracion_clave_idempotencia_pagos),
+    (7, 'Índices de cuotas atrasadas y llaves foráneas', migracion_indices_atrasos),
+    (8, 'Registro de notificaciones por cuota y día', migracion_registro_notificaciones),
+]
+
+def migrar_db():
+    """Crea las tablas faltantes y aplica las migraciones pendientes"""
+    with app.app_context():
+        try:
+            db.create_all()
+
+            aplicadas = {fila.version for fila in db.session.execute(db.select(version_esquema.c.version))}
+            pendientes = [m for m in MIGRACIONES if m[0] not in aplicadas]
+
+            if not pendientes:
+                print("✅ El esquema ya está al día")
+                return True
+
+            for version, descripcion, migracion in pendientes:
+                print(f"🔨 Migración {version}: {descripcion}...")
+                migracion()
+                db.session.execute(version_esquema.insert().values(
+                    version=version, descripcion=descripcion, fecha_aplicacion=datetime.utcnow()))
+                db.session.commit()
+                print(f"✅ Migración {version} aplicada")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error al migrar la base de datos: {e}")
+            return False
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Actualizando esquema de la base de datos...")
+    load_dotenv()
+
+    if migrar_db():
+        print("\n🎉 ¡Base de datos actualizada!")
+    else:
+        print("\n💥 Error al actualizar la base de datos")
+        sys.exit(1)
@@ -0,0 +1,71 @@
+"""
+Plantillas de los emails (templates/emails). Cada email tiene una carcasa con los
+estilos, el encabezado con el logo y el pie, que es igual para todos los clientes,
+y un fragmento `<nombre>_contenido.html` con los datos de cada uno.
+Las plantillas se compilan una sola vez por proceso y la carcasa se renderiza una
+sola vez y se guarda como texto: por cada email solo se renderiza el fragmento.
+No depende de Flask.
+"""
+
+import os
+import re
+import threading
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup, escape
+
+DIRECTORIO_PLANTILLAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Huecos de la carcasa que cambian en cada email
+HUECOS_CARCASA = ('titulo', 'contenido')
+_MARCA_HUECO = re.compile('\x00(%s)\x00' % '|'.join(HUECOS_CARCASA))
+
+
+class PlantillasCorreo:
+    """Plantillas compiladas y carcasas ya renderizadas, compartidas por los hilos"""
+
+    def __init__(self, directorio=DIRECTORIO_PLANTILLAS):
+        # auto_reload=False: una vez compilada, la plantilla no vuelve a leer el archivo
+        self.entorno = Environment(loader=FileSystemLoader(directorio),
+                                   autoescape=select_autoescape(['html']),
+                                   auto_reload=False, trim_blocks=True, lstrip_blocks=True)
+        self._cargadas = {}
+        self._lock = threading.Lock()
+
+    def _cargar(self, nombre):
+        """(trozos de la carcasa, plantilla del fragmento) del email `nombre`
+
+        La carcasa se renderiza con una marca en cada hueco y se parte en esas marcas:
+        los trozos en posición par son texto fijo y los impares el nombre del hueco.
+        """
+        cargada = self._cargadas.get(nombre)
+        if cargada is None:
+            with self._lock:
+                cargada = self._cargadas.get(nombre)
+                if cargada is None:
+                    carcasa = self.entorno.get_template(f'emails/{nombre}.html').render(
+                        {hueco: Markup(f'\x00{hueco}\x00') for hueco in HUECOS_CARCASA})
+                    cargada = (_MARCA_HUECO.split(carcasa),
+                               self.entorno.get_template(f'emails/{nombre}_contenido.html'))
+                    self._cargadas[nombre] = cargada
+        return cargada
+
+    def renderizar(self, nombre, titulo, **contexto):
+        """
+        HTML completo de un email
+
+        Args:
+            nombre (str): Email a generar ('recibo_pago', 'notificacion_atraso'...)
+            titulo (str): Título del documento
+            **contexto: Variables del fragmento
+
+        Returns:
+            str: La carcasa con el título y el fragmento renderizado en sus huecos
+        """
+        trozos, fragmento = self._cargar(nombre)
+        valores = {'titulo': escape(titulo), 'contenido': fragmento.render(contexto)}
+        return ''.join(valores[trozo] if posicion % 2 else trozo for posicion, trozo in enumerate(trozos))
+
+
+# Instancia del proceso (las plantillas se leen la primera vez que se usan)
+plantillas_correo = PlantillasCorreo()
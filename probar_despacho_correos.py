@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para probar el despacho de notificaciones de atraso sin enviar emails reales
+Levanta un servidor HTTP local que imita la API de Brevo (responde con error a una
+de cada N solicitudes para forzar reintentos, rechaza una dirección inválida y responde
+tarde, después del tiempo de lectura, al envío de otra dirección), crea
+una base SQLite temporal con préstamos atrasados, encola las notificaciones y las
+envía con los hilos de despacho, por lote (messageVersions) o de una en una.
+Al final comprueba que cada cuota recibió exactamente un correo, que la dirección
+inválida quedó como fallida sin afectar a las demás, que los correos sin respuesta
+quedaron como inciertos y no se reenviaron, que la plantilla por lote llevó
+todos sus parámetros, que nunca hubo más envíos simultáneos que hilos, que se
+respetó el límite por segundo y que un segundo envío el mismo día solo vuelve a
+encolar la cuota cuyo correo falló.
+
+Uso: python probar_despacho_correos.py [--correos 60] [--error-cada 7] [--por-segundo 20] [--hilos 4] [--sin-lote]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StubBrevo(ThreadingHTTPServer):
+    """Imitación de POST /v3/smtp/email que registra los envíos"""
+
+    def __init__(self, error_cada, demora):
+        super().__init__(('127.0.0.1', 0), ManejadorStub)
+        self.error_cada = error_cada
+        self.demora = demora
+        self.lock = threading.Lock()
+        self.solicitudes = 0
+        self.conexiones = 0
+        self.en_curso = 0
+        self.max_en_curso = 0
+        self.entregados = []  # (destinatario, asunto, instante)
+        self.errores = 0  # Solicitudes respondidas con error
+        self.sin_parametros = 0  # Versiones con marcadores de la plantilla sin valor
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v3/smtp/email"
+
+
+DIRECCION_INVALIDA = 'invalida@prueba.local'
+DIRECCION_LENTA = 'lenta@prueba.local'  # Su envío se acepta pero la respuesta llega tarde
+DEMORA_LENTA = 1.0
+MARCADOR = re.compile(r'\{\{\s*params\.(\w+)\s*\}\}')
+
+
+class ManejadorStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Mantiene la conexión abierta entre solicitudes
+    disable_nagle_algorithm = True  # Sin demora de TCP entre encabezados y cuerpo
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.conexiones += 1
+
+    def do_POST(self):
+        servidor = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with servidor.lock:
+            servidor.solicitudes += 1
+            numero = servidor.solicitudes
+            servidor.en_curso += 1
+            servidor.max_en_curso = max(servidor.max_en_curso, servidor.en_curso)
+        try:
+            time.sleep(servidor.demora)
+            versiones = payload.get('messageVersions')
+            if versiones:
+                destinatarios = [version['to'][0]['email'] for version in versiones]
+                marcadores = set(MARCADOR.findall(payload['subject'] + payload['htmlContent']))
+                faltantes = sum(1 for version in versiones if marcadores - set(version.get('params', {})))
+            else:
+                destinatarios = [payload['to'][0]['email']]
+                faltantes = 0
+
+            if DIRECCION_INVALIDA in destinatarios or (servidor.error_cada and numero % servidor.error_cada == 0):
+                with servidor.lock:
+                    servidor.errores += 1
+            if DIRECCION_INVALIDA in destinatarios:
+                self._responder(400, {'code': 'invalid_parameter', 'message': 'email is not valid in to'})
+                return
+            if servidor.error_cada and numero % servidor.error_cada == 0:
+                # Alterna entre límite de solicitudes (con Retry-After) y error del servidor
+                if numero % 2:
+                    self._responder(429, {'message': 'error de prueba'}, {'Retry-After': '0.2'})
+                else:
+                    self._responder(503, {'message': 'error de prueba'})
+                return
+            if DIRECCION_LENTA in destinatarios:
+                time.sleep(DEMORA_LENTA)
+            instante = time.monotonic()
+            with servidor.lock:
+                servidor.sin_parametros += faltantes
+                servidor.entregados.extend((destinatario, payload['subject'], instante)
+                                           for destinatario in destinatarios)
+            if versiones:
+                self._responder(201, {'messageIds': [f'<stub-{numero}-{i}@local>' for i in range(len(versiones))]})
+            else:
+                self._responder(201, {'messageId': f'<stub-{numero}@local>'})
+        finally:
+            with servidor.lock:
+                servidor.en_curso -= 1
+
+    def _responder(self, estado, cuerpo, encabezados=None):
+        contenido = json.dumps(cuerpo).encode('utf-8')
+        try:
+            self.send_response(estado)
+            for nombre, valor in (encabezados or {}).items():
+                self.send_header(nombre, valor)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(contenido)))
+            self.end_headers()
+            self.wfile.write(contenido)
+        except OSError:
+            # El cliente ya cerró la conexión (tiempo de lectura agotado)
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def crear_datos(m, correos):
+    """Usuario, clientes y préstamos con una cuota atrasada cada uno (más un cliente sin correo
+    y uno con una dirección que el stub rechaza)"""
+    from werkzeug.security import generate_password_hash
+    usuario = m.Usuario(username='prueba', password_hash=generate_password_hash('prueba'),
+                        nombre='Prueba', apellidos='Despacho', cargo='Prueba', rol='admin')
+    m.db.session.add(usuario)
+    hoy = datetime.now().date()
+    for numero in range(correos + 2):
+        cliente = m.Cliente(nombre=f'Cliente{numero}', apellidos='Prueba', documento=f'PRB{numero:05d}',
+                            nacionalidad='Dominicana', sexo='M', estado_civil='Soltero', telefono_principal='809',
+                            correo=(DIRECCION_INVALIDA if numero == correos // 2
+                                    else DIRECCION_LENTA if numero == correos // 3
+                                    else f'cliente{numero}@prueba.local' if numero <= correos else ''),
+                            direccion='N/A', provincia='Santo Domingo', municipio='N/A', sector='N/A',
+                            ocupacion='N/A', ingresos=0, situacion_laboral='N/A', lugar_trabajo='N/A',
+                            direccion_trabajo='N/A')
+        prestamo = m.Prestamo(cliente=cliente, monto=1000, tasa_interes=5, plazo_meses=1, frecuencia='Mensual',
+                              fecha_primera_cuota=hoy - timedelta(days=15))
+        m.db.session.add(m.Cuota(prestamo=prestamo, numero_cuota=1, fecha_vencimiento=hoy - timedelta(days=15),
+                                 monto_capital=1000, monto_interes=50, monto_total=1050, saldo_restante=0))
+    m.db.session.commit()
+    return usuario
+
+
+def probar(args):
+    stub = StubBrevo(args.error_cada, args.demora)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    base = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    base.close()
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{base.name}',
+        'BREVO_API_URL': stub.url,
+        'BREVO_API_KEY': 'clave-de-prueba',
+        'CORREOS_HILOS': str(args.hilos),
+        'CORREOS_POR_SEGUNDO': str(args.por_segundo),
+        'CORREOS_ESPERA_REINTENTO_SEGUNDOS': '0.2',
+        'BREVO_TIMEOUT_LECTURA': str(DEMORA_LENTA / 2),
+        'CORREOS_DESPACHO_EN_PROCESO': 'false',
+        'CORREOS_ENVIO_POR_LOTE': 'false' if args.sin_lote else 'true',
+        'CORREOS_POR_RECLAMO': str(args.por_reclamo),
+    })
+    import app as m
+
+    try:
+        with m.app.app_context():
+            m.db.create_all()
+            usuario = crear_datos(m, args.correos)
+            trabajo = m.encolar_notificaciones_atraso(usuario.id)
+            print(f"📬 {trabajo.total} correos encolados, {trabajo.omitidas} cuotas sin correo")
+            trabajo_id = trabajo.id
+            usuario_id = usuario.id
+
+        inicio = time.monotonic()
+        m.pool_correos.iniciar()
+        m.pool_correos.avisar()
+        limite = inicio + args.correos / args.por_segundo * 3 + 30
+        while time.monotonic() < limite:
+            with m.app.app_context():
+                progreso = m.db.session.get(m.TrabajoNotificacion, trabajo_id).progreso()
+                m.db.session.remove()
+            if progreso['terminado']:
+                break
+            time.sleep(0.2)
+        duracion = time.monotonic() - inicio
+        m.pool_correos.detener()
+
+        destinatarios = [destinatario for destinatario, _, _ in stub.entregados]
+        duplicados = len(destinatarios) - len(set(destinatarios))
+        # Instante de cada llamada aceptada (una por lote)
+        instantes = sorted(set(instante for _, _, instante in stub.entregados))
+        print(f"⏱️  {duracion:.2f} s, {stub.solicitudes} solicitudes al stub "
+              f"({stub.errores} con error) en {stub.conexiones} conexiones")
+        print(f"📋 Enviados: {progreso['enviados']}  Fallidos: {progreso['fallidos']}  "
+              f"Inciertos: {progreso['inciertos']}  Pendientes: {progreso['pendientes']}")
+        print(f"🔀 Máximo de envíos simultáneos: {stub.max_en_curso} (hilos: {args.hilos})")
+        metricas = m.obtener_servicio_brevo().metricas.resumen()
+        print(f"📡 Llamadas: {metricas['llamadas']} {metricas['por_resultado']}  "
+              f"latencia p50 {metricas['latencia_p50_ms']} ms, p95 {metricas['latencia_p95_ms']} ms")
+
+        errores = []
+        if not progreso['terminado'] or progreso['enviados'] + progreso['inciertos'] != args.correos:
+            errores.append('no se enviaron todos los correos')
+        if not progreso['inciertos']:
+            errores.append('el envío sin respuesta no quedó como incierto')
+        if len(set(destinatarios)) != args.correos:
+            errores.append('no todos los clientes recibieron su correo')
+        if progreso['fallidos'] != 1:
+            errores.append('la dirección inválida no quedó como único correo fallido')
+        if stub.sin_parametros:
+            errores.append(f'{stub.sin_parametros} versiones del lote sin todos sus parámetros')
+        if duplicados:
+            errores.append(f'{duplicados} correos duplicados')
+        if stub.max_en_curso > args.hilos:
+            errores.append('más envíos simultáneos que hilos')
+        # En cualquier ventana de un segundo caben la tasa más un envío (y algo de variación del reloj)
+        maximo_por_segundo = max((sum(1 for t in instantes if i <= t < i + 1) for i in instantes), default=0)
+        print(f"📈 Máximo de llamadas aceptadas en un segundo: {maximo_por_segundo} (límite: {args.por_segundo:g})")
+        if maximo_por_segundo > args.por_segundo + 2:
+            errores.append('se superó el límite por segundo')
+
+        # El registro de notificaciones evita repetir las cuotas ya notificadas hoy
+        with m.app.app_context():
+            repeticion = m.encolar_notificaciones_atraso(usuario_id).progreso()
+            m.db.session.remove()
+        print(f"🔁 Segundo envío: {repeticion['total']} encolados, {repeticion['duplicadas']} ya notificados hoy")
+        if repeticion['total'] != 1 or repeticion['duplicadas'] != progreso['enviados'] + progreso['inciertos']:
+            errores.append('el segundo envío no se limitó a la cuota que falló')
+
+        for error in errores:
+            print(f"❌ {error}")
+        return not errores
+
+    finally:
+        stub.shutdown()
+        os.remove(base.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prueba del despacho de correos contra un stub local de Brevo')
+    parser.add_argument('--correos', type=int, default=60)
+    parser.add_argument('--error-cada', type=int, default=7, help='Una de cada N solicitudes responde con error')
+    parser.add_argument('--por-segundo', type=float, default=20)
+    parser.add_argument('--hilos', type=int, default=4)
+    parser.add_argument('--demora', type=float, default=0.05, help='Segundos que tarda el stub en responder')
+    parser.add_argument('--por-reclamo', type=int, default=10, help='Correos que toma cada hilo a la vez')
+    parser.add_argument('--sin-lote', action='store_true', help='Enviar un correo por llamada')
+    args = parser.parse_args()
+
+    print("🚀 Probando el despacho de correos contra un stub local de Brevo...")
+    if probar(args):
+        print("\n🎉 ¡El despacho funciona correctamente!")
+    else:
+        print("\n💥 La prueba del despacho falló")
+        sys.exit(1)
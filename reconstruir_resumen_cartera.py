@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para reconciliar el resumen de cartera del dashboard
+Recalcula todas las cifras desde las tablas de préstamos, cuotas y pagos
+y muestra las diferencias con lo que estaba guardado
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, ResumenCartera, reconstruir_resumen_cartera
+
+CAMPOS = [
+    'prestamos_activos',
+    'clientes_activos',
+    'monto_atrasado',
+    'clientes_atrasados',
+    'prestamos_mes',
+    'monto_prestamos_mes',
+    'pagos_mes',
+    'monto_pagos_mes',
+]
+
+def reconciliar_resumen():
+    """Reconstruye el resumen de cartera y reporta las diferencias encontradas"""
+    with app.app_context():
+        try:
+            db.create_all()
+
+            resumen = ResumenCartera.query.first()
+            anterior = {campo: getattr(resumen, campo) for campo in CAMPOS} if resumen else {}
+
+            resumen = reconstruir_resumen_cartera()
+            db.session.commit()
+
+            print("📋 Resumen de cartera:")
+            diferencias = 0
+            for campo in CAMPOS:
+                nuevo = getattr(resumen, campo)
+                viejo = anterior.get(campo)
+                if anterior and viejo is not None and float(viejo) != float(nuevo):
+                    diferencias += 1
+                    print(f"   ⚠️  {campo}: {viejo} -> {nuevo}")
+                else:
+                    print(f"   - {campo}: {nuevo}")
+
+            if not anterior:
+                print("\nℹ️  No existía resumen previo, se creó desde cero")
+            elif diferencias:
+                print(f"\n⚠️  Se corrigieron {diferencias} cifras")
+            else:
+                print("\n✅ El resumen ya estaba conciliado")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error al reconstruir el resumen: {e}")
+            return False
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Reconciliando resumen de cartera...")
+    load_dotenv()
+
+    if reconciliar_resumen():
+        print("\n🎉 ¡Resumen de cartera actualizado!")
+    else:
+        print("\n💥 Error al reconciliar el resumen")
+        sys.exit(1)
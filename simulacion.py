@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Simulación de los flujos de caja de toda la cartera
+Calcula con arreglos de NumPy las tablas de amortización de todos los
+préstamos a la vez (mismas reglas que amortizacion.calcular_cuotas) y las
+acumula por mes. Es solo lectura: recibe los términos de los préstamos como
+filas simples y nunca crea objetos del ORM ni escribe en la base de datos.
+"""
+
+import numpy as np
+
+from amortizacion import FRECUENCIAS
+
+# Cuotas por mes de las frecuencias con capital fijo
+PERIODOS_POR_MES = {'Mensual': 1, 'Quincenal': 2, 'Semanal': 4}
+# Días entre cuotas; las frecuencias mensuales usan _siguientes_fechas_mensuales
+DIAS_ENTRE_CUOTAS = {'Quincenal': 15, 'Semanal': 7}
+
+class TerminosCartera:
+    """Términos de los préstamos como arreglos paralelos (uno por columna)"""
+
+    def __init__(self, ids, montos, tasas, plazos, frecuencias, fechas_primera_cuota):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.montos = np.asarray(montos, dtype=np.float64)
+        self.tasas = np.asarray(tasas, dtype=np.float64)
+        self.plazos = np.asarray(plazos, dtype=np.int64)
+        self.frecuencias = np.asarray(frecuencias, dtype='U21')
+        self.fechas_primera_cuota = np.asarray(fechas_primera_cuota, dtype='datetime64[D]')
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def desde_filas(cls, filas):
+        """Construye los arreglos a partir de filas (id, monto, tasa_interes,
+        plazo_meses, frecuencia, fecha_primera_cuota)"""
+        columnas = list(zip(*filas)) or [()] * 6
+        ids, montos, tasas, plazos, frecuencias, fechas = columnas
+        return cls(ids, [float(m) for m in montos], [float(t) for t in tasas],
+                   plazos, frecuencias, fechas)
+
+    def escenario(self, tasa_interes=None, frecuencia=None, plazo_meses=None):
+        """Copia de los términos con la tasa, frecuencia y/o plazo reemplazados en todos los préstamos"""
+        if frecuencia is not None and frecuencia not in FRECUENCIAS:
+            raise ValueError(f'Frecuencia no válida: {frecuencia}')
+
+        def reemplazar(arreglo, valor):
+            return arreglo if valor is None else np.full_like(arreglo, valor)
+
+        return TerminosCartera(self.ids, self.montos,
+                               reemplazar(self.tasas, tasa_interes),
+                               reemplazar(self.plazos, plazo_meses),
+                               reemplazar(self.frecuencias, frecuencia),
+                               self.fechas_primera_cuota)
+
+def _siguientes_fechas_mensuales(fechas):
+    """Versión vectorizada de amortizacion._siguiente_fecha_mensual"""
+    def limitar_dia_28(fechas):
+        dia = (fechas - fechas.astype('datetime64[M]')).astype(np.int64) + 1
+        return fechas - np.maximum(dia - 28, 0)
+
+    return limitar_dia_28(limitar_dia_28(fechas) + 28)
+
+def simular_cartera(terminos, desde=None):
+    """Flujo de caja mensual esperado de la cartera.
+
+    Cada préstamo genera las mismas cuotas que calcular_cuotas: capital fijo
+    con la última cuota absorbiendo los decimales (Mensual, Quincenal,
+    Semanal), todo al final (Bullet) o solo intereses (SoloInteresesSinFecha).
+    Los préstamos se ordenan por cantidad de cuotas, de modo que la cuota i de
+    todos los préstamos que la tienen se calcula con una sola operación sobre
+    un tramo contiguo de los arreglos.
+
+    Args:
+        terminos (TerminosCartera): Préstamos a simular
+        desde (date, opcional): Ignorar las cuotas que vencen antes de esta fecha
+
+    Returns:
+        dict: arreglos 'meses' (datetime64[M]), 'capital', 'interes', 'total' y
+        'cuotas' (cantidad de cuotas que vencen en el mes)
+    """
+    vacio = {'meses': np.array([], dtype='datetime64[M]'), 'capital': np.zeros(0),
+             'interes': np.zeros(0), 'total': np.zeros(0), 'cuotas': np.zeros(0, dtype=np.int64)}
+    if len(terminos) == 0:
+        return vacio
+
+    montos = terminos.montos
+    tasas = terminos.tasas / 100
+    plazos = terminos.plazos
+    frecuencias = terminos.frecuencias
+
+    # Cuotas por préstamo y montos de una cuota normal y de la última
+    periodos = np.zeros(len(terminos), dtype=np.int64)
+    capital_cuota = np.zeros(len(terminos))
+    capital_ultima = np.zeros(len(terminos))
+    interes_cuota = np.zeros(len(terminos))
+    interes_ultima = np.zeros(len(terminos))
+    dias_entre_cuotas = np.zeros(len(terminos), dtype=np.int64)
+
+    for frecuencia, por_mes in PERIODOS_POR_MES.items():
+        es = (frecuencias == frecuencia) & (plazos > 0)
+        periodos[es] = plazos[es] * por_mes
+        capital_cuota[es] = montos[es] / periodos[es]
+        capital_ultima[es] = montos[es] - capital_cuota[es] * (periodos[es] - 1)
+        interes_cuota[es] = interes_ultima[es] = montos[es] * (tasas[es] / por_mes)
+        dias_entre_cuotas[es] = DIAS_ENTRE_CUOTAS.get(frecuencia, 0)
+
+    es = (frecuencias == 'Bullet') & (plazos > 0)
+    periodos[es] = plazos[es]
+    capital_ultima[es] = montos[es]
+    interes_ultima[es] = montos[es] * tasas[es] * plazos[es]
+
+    es = (frecuencias == 'SoloInteresesSinFecha') & (plazos > 0)
+    periodos[es] = plazos[es]
+    interes_cuota[es] = interes_ultima[es] = montos[es] * tasas[es]
+
+    # Ordenar de más a menos cuotas: en la cuota i participan los primeros 'activos[i]'
+    orden = np.argsort(-periodos, kind='stable')
+    periodos = periodos[orden]
+    capital_cuota, capital_ultima = capital_cuota[orden], capital_ultima[orden]
+    interes_cuota, interes_ultima = interes_cuota[orden], interes_ultima[orden]
+    dias_entre_cuotas = dias_entre_cuotas[orden]
+    fechas = terminos.fechas_primera_cuota[orden]
+
+    maximo_periodos = int(periodos[0])
+    if maximo_periodos == 0:
+        return vacio
+    activos = np.searchsorted(-periodos, -np.arange(1, maximo_periodos + 1), side='right')
+
+    # Meses cubiertos: ninguna frecuencia avanza más de un mes calendario por mes de plazo
+    mes_inicial = fechas.min().astype('datetime64[M]')
+    cantidad_meses = int((fechas.max().astype('datetime64[M]') - mes_inicial).astype(np.int64)) \
+        + int(plazos.max()) + 2
+    capital = np.zeros(cantidad_meses)
+    interes = np.zeros(cantidad_meses)
+    cuotas = np.zeros(cantidad_meses, dtype=np.int64)
+    limite = np.datetime64(desde, 'D') if desde is not None else None
+
+    for i in range(maximo_periodos):
+        n = activos[i]
+        fechas = fechas[:n]
+        ultima = periodos[:n] == i + 1
+        capital_i = np.where(ultima, capital_ultima[:n], capital_cuota[:n])
+        interes_i = np.where(ultima, interes_ultima[:n], interes_cuota[:n])
+        mes = (fechas.astype('datetime64[M]') - mes_inicial).astype(np.int64)
+
+        if limite is not None:
+            vigente = fechas >= limite
+            mes, capital_i, interes_i = mes[vigente], capital_i[vigente], interes_i[vigente]
+
+        capital += np.bincount(mes, weights=capital_i, minlength=cantidad_meses)
+        interes += np.bincount(mes, weights=interes_i, minlength=cantidad_meses)
+        cuotas += np.bincount(mes, minlength=cantidad_meses)
+
+        # Vencimiento siguiente de cada préstamo según su frecuencia
+        dias = dias_entre_cuotas[:n]
+        fechas = np.where(dias > 0, fechas + dias, _siguientes_fechas_mensuales(fechas))
+
+    # Recortar los meses sin cuotas al principio y al final
+    con_cuotas = np.flatnonzero(cuotas)
+    if len(con_cuotas) == 0:
+        return vacio
+    tramo = slice(con_cuotas[0], con_cuotas[-1] + 1)
+    return {
+        'meses': mes_inicial + np.arange(cantidad_meses)[tramo],
+        'capital': capital[tramo],
+        'interes': interes[tramo],
+        'total': capital[tramo] + interes[tramo],
+        'cuotas': cuotas[tramo],
+    }
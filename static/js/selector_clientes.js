@@ -0,0 +1,115 @@
+// Selector de clientes con búsqueda mientras se escribe
+// Uso: un contenedor con data-selector-clientes que tenga un input de texto
+// (lo que escribe el usuario), un input hidden con el id del cliente y un div
+// vacío para la lista de resultados. Consulta /api/clientes?q=... y al elegir
+// un cliente guarda su id en el hidden y dispara su evento "change".
+(function() {
+    'use strict';
+
+    const ESPERA_MS = 250;
+    const MINIMO_CARACTERES = 2;
+    const LIMITE_RESULTADOS = 10;
+
+    function iniciarSelector(contenedor) {
+        const texto = contenedor.querySelector('input[type="text"]');
+        const oculto = contenedor.querySelector('input[type="hidden"]');
+        const lista = contenedor.querySelector('.list-group');
+        let temporizador = null;
+        let peticion = 0;
+        let activo = -1;
+
+        function marcarValidez() {
+            texto.setCustomValidity(texto.required && !oculto.value ? 'Seleccione un cliente de la lista' : '');
+        }
+
+        function cerrarLista() {
+            lista.classList.add('d-none');
+            lista.innerHTML = '';
+            activo = -1;
+        }
+
+        function elegir(cliente) {
+            texto.value = `${cliente.nombre} - ${cliente.documento}`;
+            oculto.value = cliente.id;
+            marcarValidez();
+            cerrarLista();
+            oculto.dispatchEvent(new Event('change'));
+        }
+
+        function mostrar(clientes) {
+            lista.innerHTML = '';
+            activo = -1;
+            if (clientes.length === 0) {
+                const vacio = document.createElement('div');
+                vacio.className = 'list-group-item text-muted small';
+                vacio.textContent = 'No se encontraron clientes';
+                lista.appendChild(vacio);
+            }
+            clientes.forEach(cliente => {
+                const opcion = document.createElement('button');
+                opcion.type = 'button';
+                opcion.className = 'list-group-item list-group-item-action';
+                opcion.textContent = `${cliente.nombre} - ${cliente.documento}`;
+                // mousedown para elegir antes de que el input pierda el foco
+                opcion.addEventListener('mousedown', function(e) {
+                    e.preventDefault();
+                    elegir(cliente);
+                });
+                lista.appendChild(opcion);
+            });
+            lista.classList.remove('d-none');
+        }
+
+        function buscar() {
+            const consulta = texto.value.trim();
+            if (consulta.length < MINIMO_CARACTERES) {
+                cerrarLista();
+                return;
+            }
+            const numero = ++peticion;
+            fetch(`/api/clientes?q=${encodeURIComponent(consulta)}&limite=${LIMITE_RESULTADOS}`)
+                .then(response => response.json())
+                .then(clientes => {
+                    // Ignorar respuestas de búsquedas que ya se reemplazaron
+                    if (numero === peticion) {
+                        mostrar(clientes);
+                    }
+                })
+                .catch(error => console.error('Error al buscar clientes:', error));
+        }
+
+        texto.addEventListener('input', function() {
+            if (oculto.value) {
+                oculto.value = '';
+                oculto.dispatchEvent(new Event('change'));
+            }
+            marcarValidez();
+            clearTimeout(temporizador);
+            temporizador = setTimeout(buscar, ESPERA_MS);
+        });
+
+        texto.addEventListener('keydown', function(e) {
+            const opciones = lista.querySelectorAll('button');
+            if (!opciones.length) {
+                return;
+            }
+            if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+                e.preventDefault();
+                activo = (activo + (e.key === 'ArrowDown' ? 1 : -1) + opciones.length) % opciones.length;
+                opciones.forEach((opcion, i) => opcion.classList.toggle('active', i === activo));
+            } else if (e.key === 'Enter' && activo >= 0) {
+                e.preventDefault();
+                opciones[activo].dispatchEvent(new Event('mousedown'));
+            } else if (e.key === 'Escape') {
+                cerrarLista();
+            }
+        });
+
+        texto.addEventListener('blur', cerrarLista);
+        marcarValidez();
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('[data-selector-clientes]').forEach(iniciarSelector);
+    });
+})();
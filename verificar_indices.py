@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para verificar que las consultas frecuentes usan índices
+Muestra el plan de ejecución (EXPLAIN) de las consultas de cuotas atrasadas
+y de las búsquedas por llave foránea de cuotas, pagos y préstamos, y avisa
+cuando alguna recorre completa una de esas tablas.
+
+En PostgreSQL se desactiva el recorrido secuencial durante la verificación
+para que una tabla con pocas filas no oculte un índice faltante; en MySQL
+con tablas casi vacías el plan puede mostrar un recorrido completo aunque
+el índice exista.
+
+Uso: python verificar_indices.py
+"""
+
+import os
+import re
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import text
+from app import app, db, Cliente, Prestamo, Cuota, Pago, _condicion_cuota_atrasada
+
+# Tablas grandes que ninguna consulta frecuente debería recorrer completas
+TABLAS_VIGILADAS = ('cuota', 'pago', 'prestamo')
+
+def consultas_frecuentes():
+    """(nombre, consulta) de las consultas a verificar, con las mismas condiciones que usa la aplicación"""
+    hoy = datetime.now().date()
+    return [
+        ('Cuotas atrasadas (dashboard, atrasados, notificaciones)',
+         db.select(Cuota.id, Cuota.fecha_vencimiento).where(_condicion_cuota_atrasada(hoy))),
+        ('Cuotas atrasadas con préstamo y cliente (reporte de atrasos)',
+         db.select(Cuota.id, Prestamo.id, Cliente.nombre)
+         .join(Prestamo, Cuota.prestamo_id == Prestamo.id)
+         .join(Cliente, Prestamo.cliente_id == Cliente.id)
+         .where(_condicion_cuota_atrasada(hoy))),
+        ('Cuotas de un préstamo',
+         db.select(Cuota.id).where(Cuota.prestamo_id == 1).order_by(Cuota.numero_cuota)),
+        ('Pagos de una cuota',
+         db.select(Pago.id).where(Pago.cuota_id == 1)),
+        ('Pagos de las cuotas de un préstamo (saldos, distribución de pagos)',
+         db.select(db.func.sum(Pago.monto_capital))
+         .join(Cuota, Pago.cuota_id == Cuota.id)
+         .where(Cuota.prestamo_id == 1)),
+        ('Préstamos activos de un cliente',
+         db.select(Prestamo.id).where(Prestamo.cliente_id == 1, Prestamo.estado == 'Activo')),
+    ]
+
+def explicar(conexion, consulta):
+    """Líneas del plan de ejecución de la consulta y las que recorren completa una tabla vigilada"""
+    dialecto = conexion.dialect.name
+    sql = str(consulta.compile(dialect=conexion.dialect, compile_kwargs={'literal_binds': True}))
+
+    if dialecto == 'sqlite':
+        lineas = [fila.detail for fila in conexion.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+        recorridos = [linea for linea in lineas
+                      if re.match(rf"SCAN ({'|'.join(TABLAS_VIGILADAS)})\b", linea) and 'INDEX' not in linea]
+    elif dialecto == 'postgresql':
+        lineas = [fila[0] for fila in conexion.execute(text(f'EXPLAIN {sql}'))]
+        recorridos = [linea for linea in lineas
+                      if re.search(rf"Seq Scan on ({'|'.join(TABLAS_VIGILADAS)})\b", linea)]
+    else:
+        filas = [dict(fila._mapping) for fila in conexion.execute(text(f'EXPLAIN {sql}'))]
+        lineas = [f"{fila.get('table')}: type={fila.get('type')} key={fila.get('key')} rows={fila.get('rows')}"
+                  for fila in filas]
+        recorridos = [linea for linea, fila in zip(lineas, filas)
+                      if fila.get('type') == 'ALL' and fila.get('table') in TABLAS_VIGILADAS]
+    return lineas, recorridos
+
+def verificar_indices():
+    """Imprime el plan de cada consulta frecuente; False si alguna recorre una tabla completa"""
+    with app.app_context():
+        try:
+            print(f"🗄️  Base de datos: {db.engine.dialect.name}")
+            consultas = consultas_frecuentes()
+            con_recorridos = 0
+            with db.engine.connect() as conexion:
+                if conexion.dialect.name == 'postgresql':
+                    conexion.execute(text('SET enable_seqscan = off'))
+
+                for nombre, consulta in consultas:
+                    lineas, recorridos = explicar(conexion, consulta)
+                    print(f"\n🔍 {nombre}")
+                    for linea in lineas:
+                        print(f"   {linea}")
+                    if recorridos:
+                        con_recorridos += 1
+                        print("   ⚠️  Recorre la tabla completa; revise que se aplicaron las migraciones")
+
+            print(f"\n📋 {len(consultas)} consultas revisadas, {con_recorridos} sin índice")
+            return con_recorridos == 0
+
+        except Exception as e:
+            print(f"❌ Error al verificar los índices: {e}")
+            return False
+
+if __name__ == "__main__":
+    print("🚀 Verificando el uso de índices en las consultas frecuentes...")
+    load_dotenv()
+
+    if verificar_indices():
+        print("\n🎉 ¡Todas las consultas usan índices!")
+    else:
+        print("\n💥 Hay consultas que recorren tablas completas")
+        sys.exit(1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para verificar los saldos guardados en los préstamos
+Recalcula los saldos de cada préstamo desde sus cuotas y pagos, los compara
+con las columnas guardadas y muestra las diferencias. Con --corregir
+guarda los valores recalculados de los préstamos que no coinciden.
+
+Uso: python verificar_saldos_prestamos.py [--corregir]
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Agregar el directorio actual al path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import (app, db, Prestamo, Cuota, CAMPOS_SALDOS_PRESTAMO, calcular_saldos_prestamos,
+                 saldos_prestamo_sin_cuotas, recalcular_saldos_prestamos, sincronizar_atrasos_prestamos)
+
+CAMPOS_MONTO = ('monto_cuotas', 'capital_pendiente', 'interes_pendiente')
+
+def es_igual(campo, guardado, calculado):
+    """Compara un saldo guardado con el recalculado (los montos a centavos)"""
+    if campo in CAMPOS_MONTO:
+        return guardado is not None and abs(float(guardado) - float(calculado)) < 0.005
+    return guardado == calculado
+
+def verificar_saldos(corregir=False):
+    """Recorre los préstamos por lotes y reporta (o corrige) los saldos que no coinciden"""
+    with app.app_context():
+        try:
+            db.create_all()
+            sincronizar_atrasos_prestamos()
+
+            columnas = [getattr(Prestamo, campo) for campo in CAMPOS_SALDOS_PRESTAMO]
+            revisados = 0
+            con_diferencias = []
+            ultimo_id = 0
+            while True:
+                filas = db.session.execute(
+                    db.select(Prestamo.id, *columnas).where(Prestamo.id > ultimo_id).order_by(Prestamo.id).limit(500)
+                ).all()
+                if not filas:
+                    break
+
+                ids = [fila.id for fila in filas]
+                saldos = calcular_saldos_prestamos(Cuota.prestamo_id.in_(ids))
+                for fila in filas:
+                    calculados = saldos.get(fila.id, saldos_prestamo_sin_cuotas())
+                    diferencias = [(campo, getattr(fila, campo), calculados[campo])
+                                   for campo in CAMPOS_SALDOS_PRESTAMO
+                                   if not es_igual(campo, getattr(fila, campo), calculados[campo])]
+                    if diferencias:
+                        con_diferencias.append(fila.id)
+                        print(f"   ⚠️  Préstamo {fila.id}: " +
+                              ", ".join(f"{campo} {guardado} -> {calculado}" for campo, guardado, calculado in diferencias))
+
+                revisados += len(filas)
+                ultimo_id = ids[-1]
+
+            print(f"\n📋 {revisados} préstamos revisados, {len(con_diferencias)} con diferencias")
+            if con_diferencias and corregir:
+                for inicio in range(0, len(con_diferencias), 500):
+                    recalcular_saldos_prestamos(con_diferencias[inicio:inicio + 500])
+                db.session.commit()
+                print(f"✅ Se corrigieron {len(con_diferencias)} préstamos")
+            elif con_diferencias:
+                print("ℹ️  Ejecute con --corregir para guardar los saldos recalculados")
+                return False
+            else:
+                print("✅ Los saldos están conciliados")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error al verificar los saldos: {e}")
+            return False
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Verificando saldos de los préstamos...")
+    load_dotenv()
+
+    if verificar_saldos(corregir='--corregir' in sys.argv[1:]):
+        print("\n🎉 ¡Verificación terminada!")
+    else:
+        print("\n💥 Hay saldos sin conciliar")
+        sys.exit(1)